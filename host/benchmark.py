@@ -0,0 +1,124 @@
+"""
+Benchmarks for the mailbox firmware, on top of the simulator.
+Runs every trace against a set of configurations and reports what a detector or power
+change does to:
+- loop cost: host cpu time the firmware spends per sample (compare runs with each other,
+  it says little about the absolute cost on a Pico)
+- allocations: bytes allocated per busy event loop iteration (CPython bytes, same caveat)
+- detection latency: from the marked delivery to the detection, plus missed and false detections
+- energy: share of the time awake and with the radio on, and the number of wake-ups
+
+    python host/benchmark.py
+    python host/benchmark.py host/traces/delivery.csv --duration 3600 --json results.json
+"""
+import argparse
+import json
+import os
+import random
+
+from simulator import Simulation, Trace, HOST_DIRECTORY, parse_overrides
+
+CONFIGURATIONS = {
+    'poll': {},
+    'irq': {'sensor_capture_mode': 'irq'},
+    'timer': {'sampling_clock': 'timer'},
+    'dual core': {'runtime_mode': 'dual_core'},
+    'poll duty cycled': {'power_mode': 'duty_cycled'},
+    'irq duty cycled': {'sensor_capture_mode': 'irq', 'power_mode': 'duty_cycled'},
+    'irq duty cycled mqtt': {'sensor_capture_mode': 'irq', 'power_mode': 'duty_cycled', 'telemetry_transport': 'mqtt'},
+}
+
+
+def wind_trace(duration: float = 1800, seed: int = 1) -> Trace:
+    """
+    No deliveries, just a windy day: the lid rattles and the mailbox sways now and then.
+    """
+    generator = random.Random(seed)
+    trace = Trace()
+    at = 10.0
+    while at < duration:
+        signal = generator.choice(('lid', 'lid', 'tilt'))
+        length = generator.uniform(0.05, 1.5)
+        trace.set(at, signal, 1)
+        trace.set(at + length, signal, 0)
+        at += length + generator.expovariate(1 / 30)
+    return trace
+
+
+def load_traces(file_names: list) -> dict:
+    if not file_names:
+        directory = os.path.join(HOST_DIRECTORY, 'traces')
+        file_names = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.csv'))
+        traces = {'wind (synthetic)': wind_trace()}
+    else:
+        traces = {}
+    for file_name in file_names:
+        traces[os.path.splitext(os.path.basename(file_name))[0]] = Trace.load(file_name)
+    return traces
+
+
+def benchmark(trace: Trace, settings: dict, duration: float, repeat: int) -> dict:
+    # timing and allocations are measured in separate runs, tracing allocations slows everything down
+    timed = [Simulation(trace, duration, settings).run() for _ in range(repeat)]
+    result = min(timed, key=lambda timed_result: timed_result.busy_seconds)
+    allocations = Simulation(trace, duration, settings, measure_allocations=True).run().peak_bytes
+    latencies = result.detection_latencies()
+    found = [latency for latency in latencies if latency is not None]
+    energy = result.energy
+    uptime = max(energy.get('uptime_ms', 0), 1)
+    return {
+        'samples': result.samples,
+        'us_per_sample': result.busy_seconds / max(result.samples, 1) * 1e6,
+        'bytes_per_iteration': sum(allocations) / len(allocations) if allocations else 0,
+        'deliveries': len(latencies),
+        'missed': len(latencies) - len(found),
+        'false_detections': result.false_detections(),
+        'mean_latency': sum(found) / len(found) if found else None,
+        'max_latency': max(found) if found else None,
+        'awake': energy.get('awake_ms', 0) / uptime,
+        'radio_on': energy.get('radio_on_ms', 0) / uptime,
+        'wake_ups': energy.get('wake_ups', 0),
+        'requests': len(result.requests) + len(result.published),
+        'speed_up': result.simulated_seconds / max(result.wall_seconds, 1e-9),
+    }
+
+
+def _seconds(value) -> str:
+    return '-' if value is None else f"{value:.1f}"
+
+
+def print_table(results: dict) -> None:
+    header = (f"{'trace':<18} {'configuration':<22} {'samples':>7} {'us/sample':>9} {'B/iter':>7} {'latency':>7} "
+              f"{'max':>5} {'missed':>6} {'false':>5} {'awake':>6} {'radio':>6} {'wakes':>6} {'sent':>4} {'speed':>6}")
+    print(header)
+    print('-' * len(header))
+    for (trace_name, configuration), row in results.items():
+        print(f"{trace_name:<18} {configuration:<22} {row['samples']:>7} {row['us_per_sample']:>9.0f} "
+              f"{row['bytes_per_iteration']:>7.0f} {_seconds(row['mean_latency']):>7} {_seconds(row['max_latency']):>5} "
+              f"{row['missed']:>6} {row['false_detections']:>5} {row['awake']:>6.1%} {row['radio_on']:>6.1%} "
+              f"{row['wake_ups']:>6} {row['requests']:>4} {row['speed_up']:>5.0f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('traces', nargs='*', help="trace files (default: host/traces/*.csv and a synthetic one)")
+    parser.add_argument('--duration', type=float, help="simulated seconds per run (default: a minute past the trace)")
+    parser.add_argument('--configuration', action='append', choices=sorted(CONFIGURATIONS),
+                        help="only these configurations (default: all of them)")
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE', help="override a setting in every run")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per benchmark, the fastest one counts")
+    parser.add_argument('--json', help="also write the results to this file")
+    arguments = parser.parse_args()
+
+    overrides = parse_overrides(arguments.set)
+    results = {}
+    for trace_name, trace in load_traces(arguments.traces).items():
+        for configuration in arguments.configuration or CONFIGURATIONS:
+            settings = dict(CONFIGURATIONS[configuration])
+            settings.update(overrides)
+            results[(trace_name, configuration)] = benchmark(trace, settings, arguments.duration, arguments.repeat)
+    print_table(results)
+    if arguments.json:
+        with open(arguments.json, 'w') as file:
+            json.dump([dict(trace=trace_name, configuration=configuration, **row)
+                       for (trace_name, configuration), row in results.items()], file, indent=2)
@@ -0,0 +1,503 @@
+"""
+Gateway between many mailboxes and Home Assistant / ntfy.sh.
+Runs on the host (CPython, one asyncio loop). Mailboxes with telemetry_transport: gateway
+send it small events over the LAN instead of talking to Home Assistant and ntfy.sh
+themselves, which keeps their radio time short and the Home Assistant token off the devices.
+
+An event is a JSON object with short keys:
+
+    {"d": device (unique id), "b": boot id, "n": sequence number, "k": 0 ntfy / 1 Home Assistant,
+     "s": mail has been delivered (0 / 1), "m": ntfy message, "t": ntfy topic, "e": entity id,
+     "a": Home Assistant attributes}
+
+sent either as a UDP datagram (answered with {"d": ..., "n": ...}) or POSTed to /events
+over HTTP (one event per line, answered with 202). An event is acknowledged as soon as it
+has been queued, the gateway takes care of getting it upstream from there.
+
+Events are deduplicated (a mailbox resends an event until it sees the acknowledgement, and
+the sequence number only moves on once it has) and collected for batch_interval seconds.
+Each batch then goes upstream over pooled keep-alive connections:
+- Home Assistant only gets the newest state per entity
+- ntfy gets one message per topic, listing every message of every mailbox which had something
+  to say, in order (only the same message twice in a row from one mailbox is sent once)
+Whatever doesn't make it is retried with exponential backoff (unless a newer state replaced it),
+failed ntfy messages go out ahead of the ones which came in since.
+
+    python host/gateway.py --home-assistant-url http://homeassistant.local:8123/ --token-file token.txt
+"""
+import argparse
+import asyncio
+import json
+import socket
+import ssl
+import time
+from urllib.parse import urlsplit
+
+TARGET_NTFY = 0
+TARGET_HOME_ASSISTANT = 1
+UDP_RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024  # the kernel may cap this (net.core.rmem_max)
+
+
+class Event:
+    __slots__ = ('device', 'boot', 'sequence', 'target', 'delivered', 'message', 'topic', 'entity', 'attributes',
+                 'received_at')
+
+    def __init__(self, fields: dict):
+        """
+        :param fields: a decoded event (see the module docstring), raises ValueError if it isn't one
+        """
+        try:
+            self.device = str(fields['d'])
+            self.boot = int(fields['b'])
+            self.sequence = int(fields['n'])
+            self.target = int(fields['k'])
+            self.delivered = bool(fields['s'])
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Not an event: {e}")
+        self.message = fields.get('m')
+        self.topic = fields.get('t')
+        self.entity = fields.get('e')
+        self.attributes = fields.get('a') or {}
+        if self.target == TARGET_NTFY and not self.topic:
+            raise ValueError(f"ntfy event from {self.device} without a topic")
+        if self.target == TARGET_HOME_ASSISTANT and not self.entity:
+            raise ValueError(f"Home Assistant event from {self.device} without an entity id")
+        if self.target not in (TARGET_NTFY, TARGET_HOME_ASSISTANT):
+            raise ValueError(f"Unknown target {self.target} from {self.device}")
+        self.received_at = time.monotonic()
+
+    def ntfy_message(self) -> str:
+        if self.message:
+            return self.message
+        return "Mail has been delivered" if self.delivered else "Mail has not been delivered"
+
+
+class HttpPool:
+    """
+    Keep-alive HTTP/1.1 connections to a handful of upstream servers, at most connections_per_host
+    requests in flight per server.
+    """
+
+    def __init__(self, connections_per_host: int = 8, timeout: float = 10, verify_tls: bool = True):
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self._ssl_context = ssl.create_default_context()
+        if not verify_tls:
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+        self._idle = {}  # (scheme, host, port) -> [(reader, writer)]
+        self._limits = {}  # (scheme, host, port) -> asyncio.Semaphore
+        # counters
+        self.connects = 0
+        self.requests = 0
+
+    async def _connect(self, key: tuple) -> tuple:
+        scheme, host, port = key
+        self.connects += 1
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl_context if scheme == 'https' else None), self.timeout)
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader) -> tuple:
+        """
+        :return: (status code, body, keep alive)
+        """
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed before a response was received")
+        parts = status_line.split(None, 2)
+        status_code = int(parts[1])
+        keep_alive = parts[0] == b'HTTP/1.1'
+        content_length = -1
+        chunked = False
+        while True:
+            line = await reader.readline()
+            if not line or line == b'\r\n':
+                break
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == b'content-length':
+                content_length = int(value)
+            elif name == b'transfer-encoding':
+                chunked = value == b'chunked'
+            elif name == b'connection':
+                keep_alive = value == b'keep-alive' or (keep_alive and value != b'close')
+        if chunked:
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif content_length >= 0:
+            body = await reader.readexactly(content_length)
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return status_code, body, keep_alive
+
+    async def request(self, method: str, url: str, body: bytes = b'', headers: dict = None) -> tuple:
+        """
+        :return: (status code, body), raises OSError or asyncio.TimeoutError when the server can't be reached
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported URL (only http:// and https:// are supported): {url}")
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        head = f"{method} {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nContent-Length: {len(body)}\r\n"
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        request = head.encode('utf-8') + b'\r\n' + body
+
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = asyncio.Semaphore(self.connections_per_host)
+        async with limit:
+            idle = self._idle.setdefault(key, [])
+            while True:
+                reused = bool(idle)
+                reader, writer = idle.pop() if reused else await self._connect(key)
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    status_code, response_body, keep_alive = await asyncio.wait_for(self._read_response(reader),
+                                                                                    self.timeout)
+                    break
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if not reused:
+                        raise
+                    # the server most likely closed the idle connection, try again
+            self.requests += 1
+            if keep_alive:
+                idle.append((reader, writer))
+            else:
+                writer.close()
+        return status_code, response_body
+
+    def close_all(self) -> None:
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle = {}
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, gateway: 'Gateway'):
+        self.gateway = gateway
+        self.transport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address) -> None:
+        try:
+            event = Event(json.loads(data))
+        except ValueError as e:
+            self.gateway.rejected += 1
+            self.gateway.log(f"Rejected a datagram from {address[0]}: {e}")
+            return
+        self.gateway.receive(event)
+        self.transport.sendto(json.dumps({"d": event.device, "n": event.sequence}).encode('utf-8'), address)
+
+
+class Gateway:
+    def __init__(self,
+                 home_assistant_url: str = None,
+                 home_assistant_token: str = None,
+                 ntfy_url: str = 'https://ntfy.sh/',
+                 batch_interval: float = 0.25,
+                 connections_per_host: int = 8,
+                 retry_min_seconds: float = 1,
+                 retry_max_seconds: float = 60,
+                 pool: HttpPool = None,
+                 verbose: bool = False):
+        """
+        :param home_assistant_url: e.g. http://homeassistant.local:8123/, None to drop Home Assistant events
+        :param ntfy_url: server the ntfy topics live on
+        :param batch_interval: seconds events are collected for before they go upstream
+        :param connections_per_host: upstream requests in flight per server
+        """
+        self.home_assistant_url = home_assistant_url.rstrip('/') + '/' if home_assistant_url else None
+        self.home_assistant_token = home_assistant_token
+        self.ntfy_url = ntfy_url.rstrip('/') + '/'
+        self.batch_interval = batch_interval
+        self.retry_min_seconds = retry_min_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.pool = pool or HttpPool(connections_per_host)
+        self.verbose = verbose
+        self._last_sequence = {}  # device -> (boot id, highest sequence number seen)
+        self._states = {}  # entity -> newest Event waiting for Home Assistant
+        self._messages = {}  # topic -> {device: [Event, ...] oldest first} waiting for ntfy
+        self._ready = asyncio.Event()
+        self._in_flight = 0  # events in the batch being sent right now
+        self._retry_in = retry_min_seconds
+        # counters
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.states_sent = 0
+        self.notifications_sent = 0
+        self.upstream_failures = 0
+        self.max_queue_seconds = 0.0  # longest an event waited before it went upstream
+
+    def log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+
+    def receive(self, event: Event) -> bool:
+        """
+        Queue an event for the next batch.
+        :return: False if it was a resend of an event we already have
+        """
+        last = self._last_sequence.get(event.device)
+        if last is not None and last[0] == event.boot and event.sequence <= last[1]:
+            self.duplicates += 1
+            return False
+        self._last_sequence[event.device] = (event.boot, event.sequence)
+        self.received += 1
+        if event.target == TARGET_HOME_ASSISTANT:
+            if event.entity in self._states:
+                self.coalesced += 1
+            self._states[event.entity] = event
+        else:
+            queued = self._messages.setdefault(event.topic, {}).setdefault(event.device, [])
+            if queued and queued[-1].ntfy_message() == event.ntfy_message():
+                self.coalesced += 1
+            else:
+                queued.append(event)
+        self._ready.set()
+        return True
+
+    def pending(self) -> int:
+        """
+        :return: events which haven't made it upstream yet (including the ones on their way)
+        """
+        return len(self._states) + self._waiting_messages(self._messages) + self._in_flight
+
+    @staticmethod
+    def _waiting_messages(messages: dict) -> int:
+        return sum(len(queued) for waiting in messages.values() for queued in waiting.values())
+
+    async def _send_state(self, event: Event) -> bool:
+        if self.home_assistant_url is None:
+            return True
+        attributes = dict(event.attributes)
+        attributes["gateway_queue_ms"] = round((time.monotonic() - event.received_at) * 1000)
+        body = json.dumps({"state": 1 if event.delivered else 0, "attributes": attributes}).encode('utf-8')
+        headers = {
+            "Authorization": f"Bearer {self.home_assistant_token}",
+            "Content-Type": "application/json; charset=utf-8"
+        }
+        status_code, _ = await self.pool.request('POST', f"{self.home_assistant_url}api/states/{event.entity}",
+                                                 body, headers)
+        if status_code >= 500:
+            return False
+        if status_code >= 400:
+            # retrying won't make a bad request any better
+            self.log(f"Home Assistant rejected the state of {event.entity} ({status_code}), dropping it")
+        self.states_sent += 1
+        return True
+
+    async def _send_notification(self, topic: str, events: list) -> bool:
+        if len(events) == 1:
+            message = events[0].ntfy_message()
+        else:
+            message = '\n'.join(f"{event.device}: {event.ntfy_message()}" for event in events)
+        status_code, _ = await self.pool.request('POST', f"{self.ntfy_url}{topic}", message.encode('utf-8'))
+        if status_code >= 500:
+            return False
+        if status_code >= 400:
+            self.log(f"ntfy rejected the message for {topic} ({status_code}), dropping it")
+        self.notifications_sent += 1
+        return True
+
+    async def _attempt(self, sending) -> bool:
+        try:
+            return await sending
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            self.log(f"Upstream request failed: {e}")
+            return False
+
+    async def flush(self) -> bool:
+        """
+        Send everything that is waiting upstream, in parallel (within the connection limits).
+        :return: whether all of it went through, anything that didn't is put back
+        """
+        states = self._states
+        messages = self._messages
+        self._states = {}
+        self._messages = {}
+        if not states and not messages:
+            return True
+        self.batches += 1
+        now = time.monotonic()
+        for event in states.values():
+            self.max_queue_seconds = max(self.max_queue_seconds, now - event.received_at)
+        jobs = [self._attempt(self._send_state(event)) for event in states.values()]
+        topics = list(messages)
+        jobs += [self._attempt(self._send_notification(
+            topic, [event for queued in messages[topic].values() for event in queued])) for topic in topics]
+        self._in_flight = len(states) + self._waiting_messages(messages)
+        try:
+            results = await asyncio.gather(*jobs)
+        finally:
+            self._in_flight = 0
+
+        for event, sent in zip(list(states.values()), results):
+            # put it back unless a newer state came in while we were at it
+            if not sent and event.entity not in self._states:
+                self._states[event.entity] = event
+        for topic, sent in zip(topics, results[len(states):]):
+            if not sent:
+                # ahead of whatever came in while we were at it, nothing gets dropped
+                waiting = self._messages.setdefault(topic, {})
+                for device, failed in messages[topic].items():
+                    newer = waiting.get(device, [])
+                    if newer and newer[0].ntfy_message() == failed[-1].ntfy_message():
+                        newer = newer[1:]
+                        self.coalesced += 1
+                    waiting[device] = failed + newer
+        failures = results.count(False)
+        self.upstream_failures += failures
+        return failures == 0
+
+    async def run(self) -> None:
+        """
+        Send a batch every batch_interval seconds (if there is anything to send), backing off
+        while upstream is having trouble.
+        """
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            await asyncio.sleep(self.batch_interval)
+            if await self.flush():
+                self._retry_in = self.retry_min_seconds
+                continue
+            self.log(f"Upstream trouble, retrying in {self._retry_in} seconds")
+            await asyncio.sleep(self._retry_in)
+            self._retry_in = min(self._retry_in * 2, self.retry_max_seconds)
+            self._ready.set()
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        POST /events with one event per line, GET /stats for the counters. Connections are kept alive.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                content_length = 0
+                keep_alive = request_line.rstrip().endswith(b'HTTP/1.1')
+                while True:
+                    line = await reader.readline()
+                    if not line or line == b'\r\n':
+                        break
+                    name, _, value = line.partition(b':')
+                    name = name.strip().lower()
+                    if name == b'content-length':
+                        content_length = int(value)
+                    elif name == b'connection':
+                        keep_alive = value.strip().lower() != b'close'
+                body = await reader.readexactly(content_length) if content_length else b''
+                method, path = request_line.decode('latin-1').split(' ', 2)[:2]
+                status, response = self._respond(method, path, body)
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Length: {len(response)}\r\n"
+                             f"Content-Type: application/json\r\n\r\n".encode('latin-1') + response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, method: str, path: str, body: bytes) -> tuple:
+        if method == 'GET' and path == '/stats':
+            return '200 OK', json.dumps(self.stats()).encode('utf-8')
+        if method != 'POST' or path != '/events':
+            return '404 Not Found', b'{}'
+        try:
+            events = [Event(json.loads(line)) for line in body.splitlines() if line.strip()]
+        except ValueError as e:
+            self.rejected += 1
+            return '400 Bad Request', json.dumps({"error": str(e)}).encode('utf-8')
+        for event in events:
+            self.receive(event)
+        return '202 Accepted', json.dumps({"accepted": len(events)}).encode('utf-8')
+
+    async def start(self, host: str = '0.0.0.0', http_port: int = 8125, udp_port: int = 8125) -> tuple:
+        """
+        :return: (HTTP server, UDP transport), the batches go out once run() is running as well
+        """
+        server = await asyncio.start_server(self.handle_http, host, http_port)
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # a few thousand mailboxes waking up at once overflow the default receive buffer in no time
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER_SIZE)
+        udp_socket.bind((host, udp_port))
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _UdpProtocol(self), sock=udp_socket)
+        return server, transport
+
+    def stats(self) -> dict:
+        return {
+            "devices": len(self._last_sequence),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "coalesced": self.coalesced,
+            "pending": self.pending(),
+            "batches": self.batches,
+            "states_sent": self.states_sent,
+            "notifications_sent": self.notifications_sent,
+            "upstream_failures": self.upstream_failures,
+            "upstream_connects": self.pool.connects,
+            "upstream_requests": self.pool.requests,
+            "max_queue_ms": round(self.max_queue_seconds * 1000)
+        }
+
+
+async def serve(gateway: Gateway, host: str, http_port: int, udp_port: int) -> None:
+    server, transport = await gateway.start(host, http_port, udp_port)
+    print(f"Listening for mailboxes on {host} (http {http_port}, udp {udp_port})")
+    try:
+        await gateway.run()
+    finally:
+        transport.close()
+        server.close()
+        gateway.pool.close_all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0', help="address to listen on")
+    parser.add_argument('--http-port', type=int, default=8125)
+    parser.add_argument('--udp-port', type=int, default=8125)
+    parser.add_argument('--home-assistant-url', help="e.g. http://homeassistant.local:8123/ (default: no Home Assistant)")
+    parser.add_argument('--token-file', help="file holding the Home Assistant long-lived access token")
+    parser.add_argument('--ntfy-url', default='https://ntfy.sh/')
+    parser.add_argument('--batch-interval', type=float, default=0.25, help="seconds to collect events for")
+    parser.add_argument('--connections', type=int, default=8, help="upstream connections per server")
+    parser.add_argument('--verbose', action='store_true')
+    arguments = parser.parse_args()
+
+    token = None
+    if arguments.token_file:
+        with open(arguments.token_file, 'r') as file:
+            token = file.read().strip()
+    try:
+        asyncio.run(serve(Gateway(arguments.home_assistant_url, token, arguments.ntfy_url, arguments.batch_interval,
+                                  arguments.connections, verbose=arguments.verbose),
+                          arguments.host, arguments.http_port, arguments.udp_port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,216 @@
+"""
+Load test for the gateway (host/gateway.py), entirely on localhost.
+Starts stand-in Home Assistant and ntfy servers, a gateway pointing at them and a crowd of
+simulated mailboxes, each of which has mail delivered (and reset) a few times. Half of them
+talk UDP, the other half HTTP, and some of the datagrams are "lost" so resends (and the
+deduplication) get a workout. Reports how quickly the mailboxes got their acknowledgements
+and how few upstream requests it took.
+
+    python host/gateway_load.py --devices 2000 --rounds 3
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from gateway import Gateway, HttpPool, TARGET_NTFY, TARGET_HOME_ASSISTANT
+
+RESEND_AFTER_SECONDS = 1  # same as the firmware
+
+
+class StandInUpstream:
+    """
+    Stands in for Home Assistant and ntfy.sh: answers every request with status (after latency
+    seconds) and counts what it was sent.
+    """
+
+    def __init__(self, status: int = 200, latency: float = 0.02):
+        self.status = status
+        self.latency = latency
+        self.requests = 0
+        self.states = {}  # entity -> last state
+        self.notifications = 0
+        self.notification_lines = 0  # one per mailbox message, however they were batched
+        self.connections = 0
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                content_length = 0
+                while True:
+                    line = await reader.readline()
+                    if not line or line == b'\r\n':
+                        break
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        content_length = int(value)
+                body = await reader.readexactly(content_length) if content_length else b''
+                path = request_line.split()[1].decode()
+                self.requests += 1
+                if self.status >= 400:
+                    pass
+                elif '/api/states/' in path:
+                    self.states[path.rsplit('/', 1)[1]] = json.loads(body)["state"]
+                else:
+                    self.notifications += 1
+                    self.notification_lines += len(body.splitlines())
+                await asyncio.sleep(self.latency)
+                writer.write(f"HTTP/1.1 {self.status} OK\r\nContent-Length: 2\r\n\r\nok".encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class _MailboxProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.acknowledged = {}  # sequence number -> asyncio.Event
+
+    def datagram_received(self, data: bytes, address) -> None:
+        waiting = self.acknowledged.get(json.loads(data)["n"])
+        if waiting is not None:
+            waiting.set()
+
+
+class Mailbox:
+    """
+    Does what the firmware does with telemetry_transport: gateway, minus the sensors.
+    """
+
+    def __init__(self, number: int, generator: random.Random, loss: float):
+        self.device = f"mailbox-{number:05d}"
+        self.boot = generator.getrandbits(32)
+        self.sequence = 0
+        self.generator = generator
+        self.loss = loss
+        self.ack_latencies = []
+        self.resends = 0
+
+    def events(self, delivered: bool) -> list:
+        ntfy = {"d": self.device, "b": self.boot, "k": TARGET_NTFY, "s": int(delivered), "t": "mailboxes"}
+        if not delivered:
+            ntfy["m"] = "Mailbox has been reset"
+        home_assistant = {"d": self.device, "b": self.boot, "k": TARGET_HOME_ASSISTANT, "s": int(delivered),
+                          "e": f"sensor.{self.device.replace('-', '_')}", "a": {"latency_ha_sent_ms": 4100.0}}
+        return [ntfy, home_assistant]
+
+    async def send_udp(self, transport, protocol: _MailboxProtocol, event: dict) -> None:
+        event["n"] = self.sequence
+        acknowledged = protocol.acknowledged[self.sequence] = asyncio.Event()
+        datagram = json.dumps(event).encode('utf-8')
+        started = time.perf_counter()
+        while True:
+            if self.generator.random() >= self.loss:
+                transport.sendto(datagram)
+            try:
+                await asyncio.wait_for(acknowledged.wait(), RESEND_AFTER_SECONDS)
+                break
+            except asyncio.TimeoutError:
+                self.resends += 1
+        del protocol.acknowledged[self.sequence]
+        self.ack_latencies.append(time.perf_counter() - started)
+        self.sequence += 1
+
+    async def send_http(self, pool: HttpPool, url: str, event: dict) -> None:
+        event["n"] = self.sequence
+        started = time.perf_counter()
+        status_code, _ = await pool.request('POST', url, json.dumps(event).encode('utf-8'))
+        if status_code != 202:
+            raise OSError(f"The gateway answered {status_code}")
+        self.ack_latencies.append(time.perf_counter() - started)
+        self.sequence += 1
+
+    async def run(self, rounds: int, port: int, use_udp: bool, pool: HttpPool) -> None:
+        await asyncio.sleep(self.generator.uniform(0, 1))
+        if use_udp:
+            loop = asyncio.get_running_loop()
+            transport, protocol = await loop.create_datagram_endpoint(_MailboxProtocol,
+                                                                      remote_addr=('127.0.0.1', port))
+        for _ in range(rounds):
+            for delivered in (True, False):
+                for event in self.events(delivered):
+                    if use_udp:
+                        await self.send_udp(transport, protocol, event)
+                    else:
+                        await self.send_http(pool, f"http://127.0.0.1:{port}/events", event)
+                await asyncio.sleep(self.generator.uniform(0.1, 1))
+        if use_udp:
+            transport.close()
+
+
+def _percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+async def load_test(devices: int, rounds: int, loss: float, upstream_status: int, batch_interval: float,
+                    seed: int) -> dict:
+    upstream = StandInUpstream(upstream_status)
+    upstream_server = await asyncio.start_server(upstream.handle_client, '127.0.0.1', 0)
+    upstream_url = f"http://127.0.0.1:{upstream_server.sockets[0].getsockname()[1]}/"
+    gateway = Gateway(upstream_url, 'token', upstream_url, batch_interval, retry_max_seconds=2)
+    server, transport = await gateway.start('127.0.0.1', 0, 0)
+    http_port = server.sockets[0].getsockname()[1]
+    udp_port = transport.get_extra_info('sockname')[1]
+    flusher = asyncio.ensure_future(gateway.run())
+
+    generator = random.Random(seed)
+    mailboxes = [Mailbox(number, random.Random(generator.getrandbits(32)), loss) for number in range(devices)]
+    # the HTTP mailboxes share a pool, connecting thousands of them at once would only test the OS
+    device_pool = HttpPool(connections_per_host=64)
+    started = time.perf_counter()
+    await asyncio.gather(*(mailbox.run(rounds, udp_port if number % 2 else http_port, bool(number % 2), device_pool)
+                           for number, mailbox in enumerate(mailboxes)))
+    acknowledged_after = time.perf_counter() - started
+    # with a failing upstream it never gets there, give it a while and report what is left
+    give_up_at = time.perf_counter() + 30
+    while gateway.pending() and time.perf_counter() < give_up_at:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(batch_interval * 2)
+    upstream_after = time.perf_counter() - started
+    stats = gateway.stats()
+
+    flusher.cancel()
+    transport.close()
+    device_pool.close_all()
+    gateway.pool.close_all()
+    # let the servers see the connections go before they are closed themselves
+    await asyncio.sleep(0.1)
+    server.close()
+    upstream_server.close()
+    latencies = [latency for mailbox in mailboxes for latency in mailbox.ack_latencies]
+    stats.update({
+        "events": len(latencies),
+        "events_per_second": len(latencies) / acknowledged_after,
+        "ack_p50_ms": _percentile(latencies, 0.5) * 1000,
+        "ack_p99_ms": _percentile(latencies, 0.99) * 1000,
+        "resends": sum(mailbox.resends for mailbox in mailboxes),
+        "upstream_http_requests": upstream.requests,
+        "upstream_http_connections": upstream.connections,
+        "final_states_right": sum(state == 0 for state in upstream.states.values()) == devices,
+        # every delivery and every reset, none of them replaced by the next one
+        "notifications_right": upstream.notification_lines == devices * rounds * 2,
+        "seconds": upstream_after,
+    })
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=2, help="deliveries (and resets) per mailbox")
+    parser.add_argument('--loss', type=float, default=0.05, help="share of the datagrams that get lost")
+    parser.add_argument('--upstream-status', type=int, default=200, help="what the stand-in servers answer")
+    parser.add_argument('--batch-interval', type=float, default=0.25)
+    parser.add_argument('--seed', type=int, default=1)
+    arguments = parser.parse_args()
+    results = asyncio.run(load_test(arguments.devices, arguments.rounds, arguments.loss, arguments.upstream_status,
+                                    arguments.batch_interval, arguments.seed))
+    for name, value in results.items():
+        print(f"{name:<28} {value:.1f}" if isinstance(value, float) else f"{name:<28} {value}")
@@ -0,0 +1,152 @@
+"""
+Reads the event journal (mailbox/journal.py) copied off a mailbox.
+The segment files are memory-mapped and viewed as a NumPy record array, so there is no
+parsing to speak of, however many of them there are. Segments are put in order by their
+sequence number, and the times of records made before the clock was set (after a
+reboot, until the first NTP sync) are corrected by how far off the clock turned out to be.
+
+    mpremote cp :journal0.bin :journal1.bin :journal2.bin :journal3.bin .
+    python host/journal_reader.py journal*.bin
+    python host/journal_reader.py journal*.bin --trace mailbox.csv  # for host/simulator.py and host/tuner.py
+
+The trace has the sensor changes as signals and every detection as a "detected" mark,
+relabel the real ones to "delivery" to tune the thresholds against them.
+"""
+import argparse
+import mmap
+import struct
+import time
+
+import numpy as np
+
+from simulator import Trace, FIRMWARE_DIRECTORY  # noqa, puts the firmware on the path
+import journal
+from journal import MAGIC, HEADER_FORMAT, RECORD_SIZE, ERASED
+from samples import LID_OPEN, BOTTOM_SENSOR_ACTIVE, TILT_SENSOR_ACTIVE, RESET_SENSOR_ACTIVE
+
+RECORD_DTYPE = np.dtype([('seconds', '<u4'), ('milliseconds', '<u2'), ('event', 'u1'), ('sample', 'u1'),
+                         ('value', '<i4')])
+assert RECORD_DTYPE.itemsize == RECORD_SIZE
+
+# trace signal -> (sample bit, pin level when active, pin level when not)
+SIGNAL_BITS = {
+    'lid': (LID_OPEN, 1, 0),
+    'bottom': (BOTTOM_SENSOR_ACTIVE, 0, 1),
+    'tilt': (TILT_SENSOR_ACTIVE, 1, 0),
+    'reset': (RESET_SENSOR_ACTIVE, 0, 1),
+}
+SAMPLE_LETTERS = ((LID_OPEN, 'L'), (BOTTOM_SENSOR_ACTIVE, 'B'), (TILT_SENSOR_ACTIVE, 'T'), (RESET_SENSOR_ACTIVE, 'R'))
+
+
+def read_segment(file_name: str) -> tuple:
+    """
+    :return: (sequence number, records) of a segment file, the records are a view of the mapped file.
+        The sequence number is 0 for a segment which was never written (or isn't one).
+    """
+    with open(file_name, 'rb') as file:
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return 0, np.empty(0, dtype=RECORD_DTYPE)
+    if len(mapped) < RECORD_SIZE or mapped[:len(MAGIC)] != MAGIC:
+        return 0, np.empty(0, dtype=RECORD_DTYPE)
+    sequence = struct.unpack_from(HEADER_FORMAT, mapped)[1]
+    records = np.frombuffer(mapped, dtype=RECORD_DTYPE, count=len(mapped) // RECORD_SIZE - 1, offset=RECORD_SIZE)
+    erased = np.flatnonzero(records['event'] == ERASED)
+    if len(erased):
+        records = records[:erased[0]]
+    return sequence, records
+
+
+def read_journal(file_names: list) -> tuple:
+    """
+    :return: (all records oldest first, sequence numbers of the segments they came from)
+    """
+    segments = sorted((sequence, records) for sequence, records in map(read_segment, file_names) if sequence)
+    if not segments:
+        return np.empty(0, dtype=RECORD_DTYPE), []
+    return np.concatenate([records for _, records in segments]), [sequence for sequence, _ in segments]
+
+
+def timestamps(records: np.ndarray) -> np.ndarray:
+    """
+    :return: seconds since 1970 of every record, corrected for the clock not being set yet
+    """
+    times = records['seconds'] + records['milliseconds'] / 1000
+    boots = np.flatnonzero(records['event'] == journal.BOOT).tolist()
+    syncs = np.flatnonzero(records['event'] == journal.TIME_SYNCED).tolist()
+    # a record can only be corrected by the first sync after the boot it belongs to
+    start = 0
+    for boot in boots + [len(records)]:
+        first_sync = next((sync for sync in syncs if start <= sync < boot), None)
+        if first_sync is not None:
+            times[start:first_sync] += records['value'][first_sync]
+        start = boot
+    return times
+
+
+def describe_sample(sample: int) -> str:
+    return ''.join(letter if sample & bit else '-' for bit, letter in SAMPLE_LETTERS)
+
+
+def to_trace(records: np.ndarray, times: np.ndarray) -> Trace:
+    """
+    The sensor changes as a trace (seconds since the first record), detections as "detected" marks.
+    A reboot starts with every sensor inactive, like the firmware does.
+    """
+    trace = Trace()
+    if not len(records):
+        return trace
+    relative = times - times[0]
+    changes = np.isin(records['event'], (journal.BOOT, journal.SENSORS))
+    change_times = relative[changes]
+    samples = np.where(records['event'][changes] == journal.BOOT, 0, records['sample'][changes])
+    for signal, (bit, active_level, idle_level) in SIGNAL_BITS.items():
+        levels = np.where(samples & bit, active_level, idle_level)
+        changed = np.flatnonzero(np.diff(levels, prepend=idle_level))
+        for index in changed:
+            trace.set(float(change_times[index]), signal, int(levels[index]))
+    for at in relative[records['event'] == journal.DELIVERED]:
+        trace.mark(float(at), 'detected')
+    return trace
+
+
+def print_records(records: np.ndarray, times: np.ndarray) -> None:
+    for record, at in zip(records.tolist(), times.tolist()):
+        _, _, event, sample, value = record
+        moment = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(at)) + f".{int(at * 1000) % 1000:03d}"
+        name = journal.EVENT_NAMES.get(event, f"event {event}")
+        print(f"{moment}  {name:<12} {describe_sample(sample)}" + (f"  {value}" if value else ''))
+
+
+def print_summary(records: np.ndarray, times: np.ndarray, sequences: list) -> None:
+    if not len(records):
+        print("no records")
+        return
+    span = times[-1] - times[0]
+    print(f"{len(records)} records over {span / 86400:.1f} days "
+          f"({time.strftime('%Y-%m-%d %H:%M', time.gmtime(times[0]))} to "
+          f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(times[-1]))} UTC)")
+    events, counts = np.unique(records['event'], return_counts=True)
+    for event, count in zip(events.tolist(), counts.tolist()):
+        print(f"  {journal.EVENT_NAMES.get(event, f'event {event}'):<12} {count}")
+    if sequences[0] > 1:
+        print(f"{sequences[0] - 1} older segments have been overwritten")
+    missing = sorted(set(range(sequences[0], sequences[-1] + 1)) - set(sequences))
+    if missing:
+        print(f"segments {', '.join(map(str, missing))} are missing, were all the files copied?")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('files', nargs='+', help="the journal*.bin segment files")
+    parser.add_argument('--summary', action='store_true', help="only count the events")
+    parser.add_argument('--trace', metavar='FILE', help="write the sensor changes to a trace (csv)")
+    arguments = parser.parse_args()
+    all_records, all_sequences = read_journal(arguments.files)
+    all_times = timestamps(all_records)
+    if not arguments.summary:
+        print_records(all_records, all_times)
+    print_summary(all_records, all_times, all_sequences)
+    if arguments.trace:
+        to_trace(all_records, all_times).save(arguments.trace)
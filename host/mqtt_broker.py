@@ -0,0 +1,94 @@
+"""
+Tiny stand-in MQTT broker for trying out the mqtt telemetry transport without a real broker.
+Runs on the host (CPython), accepts any client, acknowledges CONNECT / QoS 1 PUBLISH /
+PINGREQ, keeps retained messages and prints everything that gets published.
+
+    python host/mqtt_broker.py --port 1883
+"""
+import argparse
+import asyncio
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+class StandInBroker:
+    def __init__(self, verbose: bool = True):
+        self.verbose = verbose
+        self.retained = {}  # topic -> payload
+        self.published = []  # (topic, payload, qos, retain) in the order they arrived
+        self.connects = 0
+        self.pings = 0
+        self.bytes_received = 0
+
+    async def _read_packet(self, reader: asyncio.StreamReader) -> tuple:
+        header = await reader.readexactly(1)
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = await reader.readexactly(length) if length else b''
+        self.bytes_received += 2 + length
+        return header[0], body
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                header, body = await self._read_packet(reader)
+                packet_type = header & 0xF0
+                if packet_type == CONNECT:
+                    self.connects += 1
+                    writer.write(bytes((CONNACK, 2, 0, 0)))
+                elif packet_type == PUBLISH:
+                    qos = (header >> 1) & 0x03
+                    retain = bool(header & 0x01)
+                    topic_length = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + topic_length].decode('utf-8')
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        writer.write(bytes((PUBACK, 2)) + packet_id)
+                    payload = body[offset:]
+                    self.published.append((topic, payload, qos, retain))
+                    if retain:
+                        self.retained[topic] = payload
+                    if self.verbose:
+                        print(f"{topic} (qos {qos}{', retained' if retain else ''}): {payload.decode('utf-8')}")
+                elif packet_type == PINGREQ:
+                    self.pings += 1
+                    writer.write(bytes((PINGRESP, 0)))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 1883) -> asyncio.Server:
+        return await asyncio.start_server(self.handle_client, host, port)
+
+
+async def main(host: str, port: int) -> None:
+    server = await StandInBroker().start(host, port)
+    print(f"Stand-in MQTT broker listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments.host, arguments.port))
@@ -0,0 +1,1046 @@
+"""
+Deterministic simulator for the mailbox firmware.
+Runs the unmodified firmware (mailbox/main.py, app.py and friends) on the host (CPython) against
+stand-ins for the MicroPython modules it uses (machine, network, time, uasyncio, ...).
+Everything runs on a virtual clock which jumps ahead whenever the firmware sleeps, so
+hours of mailbox time take seconds, and the same trace always gives the same result.
+
+The sensors are driven from a trace: a csv file with "time, signal, value" rows, where
+time is in seconds, signal is one of lid, bottom, tilt, reset or wake and value is the
+pin level (what pin.value() reads: the lid and tilt sensors are active high, the bottom
+and reset buttons pull the pin low). A signal keeps its value until the next row for it.
+"mark" rows (time, mark, label) don't drive anything, they note what really happened (e.g.
+a delivery) so detection latency can be measured against it.
+
+    python host/simulator.py host/traces/delivery.csv --duration 900 --set power_mode=duty_cycled
+"""
+import _thread as _cpython_thread
+import argparse
+import asyncio
+import bisect
+import contextlib
+import errno
+import gc as _gc
+import io
+import json
+import os
+import selectors
+import shutil
+import ssl  # noqa, imported before the socket stand-in is installed
+import struct
+import sys
+import tempfile
+import threading
+import time as _time
+import tracemalloc
+import types
+
+HOST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE_DIRECTORY = os.path.join(os.path.dirname(HOST_DIRECTORY), 'mailbox')
+sys.path.insert(0, HOST_DIRECTORY)
+sys.path.insert(0, FIRMWARE_DIRECTORY)
+
+import config  # noqa: E402
+import mock  # noqa: E402
+from mqtt_broker import StandInBroker  # noqa: E402
+
+# the firmware modules, forgotten between runs so every run starts from a fresh boot
+FIRMWARE_MODULES = ('main', 'config', 'log', 'detector', 'samples', 'edges', 'hardware', 'http_client', 'mqtt',
+                    'outbox', 'power', 'wifi', 'timesync', 'latency', 'journal', 'heap', 'indicator',
+                    'startup', 'sampleclock', 'dualcore', 'hastate',
+                    'statusserver', 'app')
+STUBBED_MODULES = ('machine', 'network', 'time', 'uasyncio', 'ujson', 'ustruct', 'micropython', 'gc', 'socket',
+                   '_thread')
+
+TICKS_PERIOD = 1 << 30
+EPOCH_AT_BOOT = 1767225600  # 2026-01-01 00:00:00 UTC, until NTP says otherwise
+NTP_DELTA = 2208988800  # 1900-01-01 to 1970-01-01 in seconds
+HEAP_SIZE = 192 * 1024  # what a Pico W has left for Python, give or take
+
+# the setting holding the pin number of each trace signal, and its level when nothing is going on
+SIGNALS = {
+    'lid': ('sensor_lid_pin', 0),
+    'bottom': ('sensor_bottom_pin', 1),
+    'tilt': ('sensor_tilt_pin', 0),
+    'reset': ('sensor_reset_pin', 1),
+    'wake': ('wake_source_pin', 0),
+}
+
+# so a run has something to talk to
+DEFAULT_SETTINGS = {
+    'wifi_ssid': 'simulated_ssid',
+    'wifi_password': 'simulated_password',
+    'ntfy_topic': 'simulated_topic',
+    'home_assistant_bearer_token': 'simulated_' + 'x' * 40,
+    'home_assistant_entity_id': 'sensor.smart_mailbox',
+    'home_assistant_unique_id': 'simulated_mailbox',
+}
+
+
+class SimulationFinished(BaseException):
+    """
+    Unwinds the firmware when the simulated time is up (a BaseException, so the firmware's
+    own except Exception handlers leave it alone).
+    """
+
+
+class SimulatedReset(BaseException):
+    """
+    The firmware called machine.reset().
+    """
+
+
+class Trace:
+    def __init__(self):
+        self.changes = {}  # signal -> ([times], [values])
+        self.marks = []  # (time, label)
+
+    def set(self, at: float, signal: str, value: int) -> None:
+        if signal not in SIGNALS:
+            raise ValueError(f"Unknown signal: {signal} (should be one of {', '.join(SIGNALS)} or mark)")
+        times, values = self.changes.setdefault(signal, ([], []))
+        index = bisect.bisect_right(times, at)
+        times.insert(index, at)
+        values.insert(index, value)
+
+    def mark(self, at: float, label: str) -> None:
+        bisect.insort(self.marks, (at, label))
+
+    def value_at(self, signal: str, at: float) -> int:
+        times, values = self.changes.get(signal, ((), ()))
+        index = bisect.bisect_right(times, at)
+        if index == 0:
+            return SIGNALS[signal][1]
+        return values[index - 1]
+
+    def edges_between(self, signal: str, after: float, until: float) -> list:
+        """
+        :return: (time, value) of every change in (after, until]
+        """
+        times, values = self.changes.get(signal, ((), ()))
+        edges = []
+        previous = self.value_at(signal, after)
+        for index in range(bisect.bisect_right(times, after), bisect.bisect_right(times, until)):
+            if values[index] != previous:
+                edges.append((times[index], values[index]))
+                previous = values[index]
+        return edges
+
+    def end(self) -> float:
+        last = max([times[-1] for times, _ in self.changes.values() if times] + [at for at, _ in self.marks] + [0])
+        return last
+
+    @classmethod
+    def load(cls, file_name: str) -> 'Trace':
+        trace = cls()
+        with open(file_name, 'r') as file:
+            for line_number, line in enumerate(file, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                fields = [field.strip() for field in line.split(',')]
+                if len(fields) != 3:
+                    raise ValueError(f"{file_name}:{line_number}: expected time, signal, value")
+                at, signal, value = float(fields[0]), fields[1], fields[2]
+                if signal == 'mark':
+                    trace.mark(at, value)
+                else:
+                    trace.set(at, signal, int(value))
+        return trace
+
+    def save(self, file_name: str) -> None:
+        rows = [(at, 'mark', label) for at, label in self.marks]
+        for signal, (times, values) in self.changes.items():
+            rows.extend(zip(times, [signal] * len(times), values))
+        rows.sort(key=lambda row: row[0])
+        with open(file_name, 'w') as file:
+            file.write("# time (s), signal, value\n")
+            for at, signal, value in rows:
+                file.write(f"{at:g}, {signal}, {value}\n")
+
+
+class VirtualClock:
+    def __init__(self, trace: Trace, ticks_start_ms: int = 0):
+        self.now = 0.0  # seconds since boot
+        self.trace = trace
+        self.ticks_start_ms = ticks_start_ms
+        self.epoch_offset = EPOCH_AT_BOOT
+        self.irq_pins = []  # pins with an IRQ handler
+        self.timers = []  # running machine.Timers (and the second core while it sleeps)
+        self.core1 = None  # the second core, once the firmware starts a thread
+
+    def ticks_ms(self) -> int:
+        return (self.ticks_start_ms + int(self.now * 1000)) % TICKS_PERIOD
+
+    def ticks_us(self) -> int:
+        return (self.ticks_start_ms * 1000 + int(self.now * 1000000)) % TICKS_PERIOD
+
+    def advance_to(self, target: float, stop_on_interrupt: bool = False) -> bool:
+        """
+        Move time forward, firing the pin IRQs of every edge and the timers on the way.
+        :return: whether an IRQ fired (when stop_on_interrupt, time stops right there)
+        """
+        if target < self.now:
+            return False
+        edges = []
+        for pin in self.irq_pins:
+            for at, value in self.trace.edges_between(pin.signal, self.now, target):
+                if (value and pin.trigger & pin.IRQ_RISING) or (not value and pin.trigger & pin.IRQ_FALLING):
+                    edges.append((at, pin))
+        edges.sort(key=lambda edge: edge[0])
+        fired = False
+        while True:
+            timer = self.next_timer()
+            if timer is not None and timer.due > target:
+                timer = None
+            if edges and (timer is None or edges[0][0] <= timer.due):
+                at, pin = edges.pop(0)
+                self.now = at
+                pin.handler(pin)
+            elif timer is not None:
+                self.now = timer.due
+                timer.fire()
+            else:
+                break
+            fired = True
+            if stop_on_interrupt:
+                return True
+        self.now = target
+        return fired
+
+    def next_timer(self) -> 'SimulatedTimer':
+        """
+        :return: the timer that fires next, None if none is running
+        """
+        return min(self.timers, key=lambda timer: timer.due, default=None)
+
+    def sleep(self, seconds: float) -> None:
+        if self.core1 is not None and self.core1.is_current():
+            self.core1.sleep(seconds)
+        else:
+            self.advance_to(self.now + seconds)
+
+    def lightsleep(self, ms: int = None, until: float = None) -> None:
+        target = until if ms is None else min(self.now + ms / 1000, until)
+        self.advance_to(target, stop_on_interrupt=True)
+
+    def time(self) -> float:
+        return self.epoch_offset + self.now
+
+
+class SimulatedTimer:
+    """
+    machine.Timer, fired by the virtual clock.
+    """
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    clock = None
+
+    def __init__(self, id=-1, **kwargs):  # noqa
+        self.due = 0.0
+        self.period = 0.0
+        self.mode = self.PERIODIC
+        self.callback = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode: int = PERIODIC, freq: float = None, period: int = None, callback=None, hard=None):  # noqa
+        self.deinit()
+        self.mode = mode
+        self.period = 1 / freq if freq is not None else period / 1000
+        self.callback = callback
+        self.due = self.clock.now + self.period
+        self.clock.timers.append(self)
+
+    def deinit(self) -> None:
+        if self in self.clock.timers:
+            self.clock.timers.remove(self)
+
+    def fire(self) -> None:
+        if self.mode == self.PERIODIC:
+            self.due += self.period
+        else:
+            self.deinit()
+        self.callback(self)
+
+
+class _CoreStopped(Exception):
+    pass
+
+
+class VirtualCore:
+    """
+    The second core (_thread.start_new_thread): a real thread, run in lockstep with the
+    virtual clock so that a run stays deterministic. Only one of the two threads runs at a
+    time: the second core runs until it sleeps, and the clock hands over to it again once
+    the time it sleeps until has come around, like it fires a timer.
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.due = 0.0
+        self.thread = None
+        self.error = None
+        self._turn = threading.Condition()
+        self._running = False  # whether it is the second core's turn
+        self._stopped = False
+
+    def start(self, function, args: tuple) -> int:
+        if self.thread is not None:
+            raise OSError("core1 in use")
+        self.thread = threading.Thread(target=self._run, args=(function, args), name='core1', daemon=True)
+        with self._turn:
+            self._running = True
+            self.thread.start()
+            self._turn.wait_for(lambda: not self._running)
+        self._raise_error()
+        return self.thread.ident
+
+    def _run(self, function, args: tuple) -> None:
+        try:
+            function(*args)
+        except _CoreStopped:
+            pass
+        except BaseException as e:  # noqa, handed over to the first core
+            self.error = e
+        finally:
+            with self._turn:
+                if self in self.clock.timers:
+                    self.clock.timers.remove(self)
+                self._running = False
+                self._turn.notify_all()
+
+    def _raise_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def is_current(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    def sleep(self, seconds: float) -> None:
+        # on the second core, hands the turn back to the first one
+        with self._turn:
+            self.due = self.clock.now + seconds
+            self.clock.timers.append(self)
+            self._running = False
+            self._turn.notify_all()
+            self._turn.wait_for(lambda: self._running or self._stopped)
+            if self._stopped:
+                raise _CoreStopped()
+
+    def fire(self) -> None:
+        # on the first core, runs the second one until it sleeps again
+        with self._turn:
+            self.clock.timers.remove(self)
+            self._running = True
+            self._turn.notify_all()
+            self._turn.wait_for(lambda: not self._running)
+        self._raise_error()
+
+    def stop(self) -> None:
+        with self._turn:
+            self._stopped = True
+            self._turn.notify_all()
+        self.thread.join()
+
+
+class VirtualSelector(selectors.SelectSelector):
+    """
+    Instead of waiting for the next timer, jump the clock to it.
+    """
+
+    def __init__(self, simulation: 'Simulation'):
+        super().__init__()
+        self.simulation = simulation
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready:
+            return ready
+        clock = self.simulation.clock
+        timer = clock.next_timer()
+        if timer is not None and (timeout is None or clock.now + timeout > timer.due):
+            # a timer will wake something up before then
+            if timer.due >= self.simulation.duration:
+                clock.advance_to(self.simulation.duration)
+                self.simulation.finished = True
+            else:
+                clock.advance_to(timer.due)
+        elif timeout is None:
+            # nothing will ever happen again (everything is waiting on everything else)
+            clock.advance_to(self.simulation.duration)
+            self.simulation.finished = True
+        elif timeout > 0:
+            clock.advance_to(min(clock.now + timeout, self.simulation.duration))
+        return []
+
+
+class ThreadSafeFlag:
+    """
+    uasyncio.ThreadSafeFlag. The second core only ever runs while the event loop is waiting
+    for it (see VirtualCore), so a plain asyncio.Event will do.
+    """
+
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def set(self) -> None:
+        self._event.set()
+
+    def clear(self) -> None:
+        self._event.clear()
+
+    async def wait(self) -> None:
+        await self._event.wait()
+        self._event.clear()
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, simulation: 'Simulation'):
+        super().__init__(VirtualSelector(simulation))
+        self.simulation = simulation
+
+    def time(self) -> float:
+        return self.simulation.clock.now
+
+    def _run_once(self) -> None:
+        self.simulation.before_iteration()
+        super()._run_once()
+        self.simulation.after_iteration()
+
+
+class _PipeWriter:
+    """
+    The writing end of an in memory connection, feeds the reader on the other end.
+    """
+
+    def __init__(self, peer: asyncio.StreamReader):
+        self._peer = peer
+        self._closed = False
+
+    def write(self, data) -> None:
+        if self._closed:
+            raise OSError("Connection closed")
+        self._peer.feed_data(bytes(data))
+
+    async def drain(self) -> None:
+        await asyncio.sleep(0)
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._peer.feed_eof()
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+class _StandInServer:
+    """
+    What uasyncio.start_server() hands back, the simulator connects to the handler directly.
+    """
+
+    def close(self) -> None:
+        pass
+
+    async def wait_closed(self) -> None:
+        pass
+
+
+class StandInHttpServer:
+    """
+    Answers every request with status (after latency seconds) and keeps what it was sent.
+    A GET of a Home Assistant state gets the state last POSTed to it, like Home Assistant would.
+    """
+
+    def __init__(self, simulation: 'Simulation', status: int = 200, latency: float = 0.05):
+        self.simulation = simulation
+        self.status = status
+        self.latency = latency
+        self.requests = []  # (time, host, method, path, body)
+        self.states = {}  # path -> the state last POSTed to it
+
+    async def handle_client(self, host: str, reader: asyncio.StreamReader, writer: _PipeWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                content_length = 0
+                while True:
+                    line = await reader.readline()
+                    if not line or line == b'\r\n':
+                        break
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        content_length = int(value)
+                body = await reader.readexactly(content_length) if content_length else b''
+                method, path, _ = request_line.decode().split(' ', 2)
+                self.requests.append((self.simulation.clock.now, host, method, path, body))
+                await asyncio.sleep(self.latency)
+                status, content = self.status, b'ok'
+                if '/api/states/' in path:
+                    if method == 'POST' and status < 300:
+                        self.states[path] = str(json.loads(body).get('state'))
+                    elif method == 'GET':
+                        if path in self.states:
+                            content = json.dumps({"state": self.states[path]}).encode()
+                        else:
+                            status, content = 404, b'{"message": "Entity not found."}'
+                writer.write(f"HTTP/1.1 {status} OK\r\nContent-Length: {len(content)}\r\n\r\n".encode() + content)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+
+
+class ScriptedPin(mock.Pin):
+    """
+    Input pins read the trace (at the current virtual time), output pins just remember.
+    """
+    simulation = None
+
+    def __init__(self, id, mode: str = None, value: int = None, pull: str = None):  # noqa
+        super().__init__(id, mode, value, pull)
+        self.signal = self.simulation.signal_of_pin.get(id)
+        self.handler = None
+        self.trigger = 0
+        self.changes = 0
+        if mode == self.OUT:
+            self._value = value or 0
+
+    def value(self, value: int = None) -> int:
+        if value is not None:
+            self._set(1 if value else 0)
+            return None
+        if self.mode == self.IN:
+            if self.signal is None:
+                return 1 if self.pull == self.PULL_UP else 0
+            return self.simulation.trace.value_at(self.signal, self.simulation.clock.now)
+        return self._value
+
+    def _set(self, value: int) -> None:
+        if value != self._value:
+            self.changes += 1
+        self._value = value
+
+    def high(self) -> None:
+        self._set(1)
+
+    def low(self) -> None:
+        self._set(0)
+
+    def on(self) -> None:
+        self._set(1)
+
+    def off(self) -> None:
+        self._set(0)
+
+    def toggle(self) -> None:
+        self._set(0 if self._value else 1)
+
+    def irq(self, handler=None, trigger=None, wake=None, hard=False):  # noqa
+        clock = self.simulation.clock
+        if self in clock.irq_pins:
+            clock.irq_pins.remove(self)
+        self.handler = handler
+        self.trigger = trigger or 0
+        if handler is not None and self.signal is not None:
+            clock.irq_pins.append(self)
+
+
+class SimulatedWLAN:
+    def __init__(self, simulation: 'Simulation'):
+        self.simulation = simulation
+        self._active = False
+        self._connected_at = None
+        self._static = None
+
+    def active(self, *is_active):
+        if is_active:
+            self._active = bool(is_active[0])
+            if not self._active:
+                self._connected_at = None
+        return self._active
+
+    def scan(self) -> list:
+        self.simulation.clock.sleep(2.0)  # a scan keeps the Pico W busy for a couple of seconds
+        return [(self.simulation.ssid.encode(), b'\x02\x00\x00\x00\x00\x01', 6, -60, 3, 0)]
+
+    def connect(self, ssid: str, password: str, bssid: bytes = None) -> None:
+        # pinning the access point skips the scan, a static address skips DHCP
+        delay = 3.0 if bssid is None else 1.0
+        if self._static is None:
+            delay += 1.0
+        self._connected_at = self.simulation.clock.now + delay
+        self.simulation.wifi_connects += 1
+
+    def isconnected(self) -> bool:
+        return self._active and self._connected_at is not None and self.simulation.clock.now >= self._connected_at
+
+    def disconnect(self) -> None:
+        self._connected_at = None
+
+    def ifconfig(self, configuration: tuple = None):
+        if configuration == 'dhcp':
+            self._static = None
+            return None
+        if configuration is not None:
+            self._static = tuple(configuration)
+            return None
+        return self._static or ('192.168.1.50', '255.255.255.0', '192.168.1.1', '192.168.1.1')
+
+    def config(self, *args, **kwargs):
+        return None
+
+    def status(self, *args):
+        return 3 if self.isconnected() else 0
+
+
+class SimulatedNtpSocket:
+    def __init__(self, simulation: 'Simulation', *args):
+        self.simulation = simulation
+        self._blocking = True
+        self._answer_at = None
+
+    def setblocking(self, flag: bool) -> None:
+        self._blocking = flag
+
+    def sendto(self, data: bytes, address) -> None:
+        self._answer_at = self.simulation.clock.now + 0.02
+
+    def recv(self, size: int) -> bytes:
+        if self._answer_at is None or self.simulation.clock.now < self._answer_at:
+            if not self._blocking:
+                raise BlockingIOError(errno.EAGAIN, "no answer yet")
+            self.simulation.clock.sleep(0.02)
+        reply = bytearray(48)
+        # the simulated world runs on the simulated boot time, whatever the RTC says
+        struct.pack_into('!I', reply, 40, int(EPOCH_AT_BOOT + self.simulation.clock.now) + NTP_DELTA)
+        return bytes(reply)
+
+    def close(self) -> None:
+        pass
+
+
+class Simulation:
+    def __init__(self,
+                 trace: Trace,
+                 duration: float = None,
+                 settings: dict = None,
+                 http_status: int = 200,
+                 network_latency: float = 0.05,
+                 measure_allocations: bool = False,
+                 verbose: bool = False,
+                 keep_files: str = None,
+                 status_requests: list = None):
+        """
+        :param trace: drives the sensor pins
+        :param duration: simulated seconds (defaults to a minute past the end of the trace)
+        :param settings: settings.yaml overrides, on top of mailbox/settings.yaml and DEFAULT_SETTINGS
+        :param http_status: what the stand-in Home Assistant and ntfy servers answer
+        :param network_latency: seconds every request takes to be answered
+        :param measure_allocations: trace allocations per event loop iteration (slower)
+        :param verbose: show the firmware's output
+        :param keep_files: copy what the firmware left on its flash (journal, outbox, log) to this directory
+        :param status_requests: times (seconds) at which to ask the firmware's status server for /status
+        """
+        self.trace = trace
+        self.duration = duration if duration is not None else trace.end() + 60
+        self.settings = dict(DEFAULT_SETTINGS)
+        if not verbose:
+            # printing is most of the cost of a tick otherwise
+            self.settings['log_print_level'] = '-2'
+        self.settings.update(settings or {})
+        self.network_latency = network_latency
+        self.measure_allocations = measure_allocations
+        self.verbose = verbose
+        self.keep_files = keep_files
+        self.status_requests = status_requests or []
+        self.status_handler = None  # the firmware's status server, once it listens
+        self.status_responses = []  # (time, response) per status request
+        self.clock = VirtualClock(trace)
+        self.http_server = StandInHttpServer(self, http_status, network_latency)
+        self.broker = StandInBroker(verbose=False)
+        self.ssid = self.settings['wifi_ssid']
+        self.signal_of_pin = {}
+        self.wlan = None
+        self.finished = False
+        self.firmware = None
+        self.reset_at = None
+        # results
+        self.wifi_connects = 0
+        self.iterations = 0
+        self.busy_seconds = 0.0  # host CPU time spent in the firmware
+        self.peak_bytes = []  # per event loop iteration that allocated anything
+        self.detections = []  # times has_mail_been_delivered went up
+        self.published_at = []  # time of every message the stand-in broker received
+        self._iteration_started = 0.0
+        self._delivered = False
+
+    # -- the stand-in modules --
+
+    def _machine_module(self) -> types.ModuleType:
+        machine = types.ModuleType('machine')
+        ScriptedPin.simulation = self
+        machine.Pin = ScriptedPin
+
+        class RTC:
+            def datetime(rtc, value=None):  # noqa
+                if value is None:
+                    tm = _time.gmtime(self.clock.time())
+                    return tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0
+                year, month, day, _, hour, minute, second, _ = value
+                epoch = _calendar_timegm((year, month, day, hour, minute, second))
+                self.clock.epoch_offset = epoch - self.clock.now
+
+        def reset():
+            raise SimulatedReset()
+
+        SimulatedTimer.clock = self.clock
+        machine.RTC = RTC
+        machine.Timer = SimulatedTimer
+        machine.PWRON_RESET = 1
+        machine.WDT_RESET = 3
+        machine.reset_cause = lambda: machine.PWRON_RESET
+        machine.reset = reset
+        machine.soft_reset = reset
+        machine.lightsleep = lambda ms=None: self.clock.lightsleep(ms, self.duration)
+        machine.deepsleep = lambda ms=None: reset()
+        machine.idle = lambda: self.clock.sleep(0.001)
+        machine.disable_irq = lambda: 0
+        machine.enable_irq = lambda state: None
+        machine.freq = lambda *args: 125000000
+        machine.Machine = mock.Machine
+        return machine
+
+    def _time_module(self) -> types.ModuleType:
+        clock = self.clock
+        module = types.ModuleType('time')
+        module.ticks_ms = clock.ticks_ms
+        module.ticks_us = clock.ticks_us
+        module.ticks_cpu = clock.ticks_us
+        module.ticks_add = lambda ticks, delta: (ticks + delta) % TICKS_PERIOD
+        module.ticks_diff = lambda end, start: ((end - start + TICKS_PERIOD // 2) % TICKS_PERIOD) - TICKS_PERIOD // 2
+        module.sleep = clock.sleep
+        module.sleep_ms = lambda ms: clock.sleep(ms / 1000)
+        module.sleep_us = lambda us: clock.sleep(us / 1000000)
+        module.time = lambda: int(clock.time())
+        module.time_ns = lambda: int(clock.time() * 1000000000)
+        module.gmtime = lambda seconds=None: _time.gmtime(clock.time() if seconds is None else seconds)
+        module.localtime = lambda seconds=None: _time.gmtime(clock.time() if seconds is None else seconds)
+        module.mktime = lambda tm: _calendar_timegm(tm[:6])
+        return module
+
+    def _network_module(self) -> types.ModuleType:
+        network = types.ModuleType('network')
+        network.STA_IF = 0
+        network.AP_IF = 1
+        self.wlan = SimulatedWLAN(self)
+        network.WLAN = lambda interface=0: self.wlan
+        return network
+
+    def _socket_module(self) -> types.ModuleType:
+        socket = types.ModuleType('socket')
+        socket.AF_INET = 2
+        socket.SOCK_STREAM = 1
+        socket.SOCK_DGRAM = 2
+        socket.getaddrinfo = lambda host, port, *args: [(2, 1, 0, '', ('10.0.0.2', port))]
+        socket.socket = lambda *args: SimulatedNtpSocket(self, *args)
+        return socket
+
+    def _uasyncio_module(self) -> types.ModuleType:
+        module = types.ModuleType('uasyncio')
+        module.__dict__.update({name: getattr(asyncio, name) for name in dir(asyncio) if not name.startswith('_')})
+        module.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+        module.ThreadSafeFlag = ThreadSafeFlag
+        module.open_connection = self._open_connection
+        module.start_server = self._start_server
+        module.run = self._run_firmware
+        return module
+
+    def _thread_module(self) -> types.ModuleType:
+        module = types.ModuleType('_thread')
+        module.allocate_lock = _cpython_thread.allocate_lock
+        module.get_ident = _cpython_thread.get_ident
+        self.clock.core1 = VirtualCore(self.clock)
+        module.start_new_thread = self.clock.core1.start
+        return module
+
+    def _gc_module(self) -> types.ModuleType:
+        module = types.ModuleType('gc')
+        module.collect = _gc.collect
+        module.enable = _gc.enable
+        module.disable = _gc.disable
+        module.isenabled = _gc.isenabled
+        module.threshold = lambda *args: -1
+        module.mem_alloc = lambda: min(HEAP_SIZE, tracemalloc.get_traced_memory()[0]) if tracemalloc.is_tracing() else 0
+        module.mem_free = lambda: HEAP_SIZE - module.mem_alloc()
+        return module
+
+    def _micropython_module(self) -> types.ModuleType:
+        module = types.ModuleType('micropython')
+        module.const = lambda value: value
+        module.alloc_emergency_exception_buf = lambda size: None
+        module.opt_level = lambda *args: 0
+        module.mem_info = lambda *args: None
+        module.schedule = lambda function, argument: function(argument)
+        module.native = module.viper = lambda function: function
+        return module
+
+    async def _open_connection(self, host: str, port: int, ssl=None, server_hostname: str = None):  # noqa
+        await asyncio.sleep(self.network_latency)
+        if not self.wlan.isconnected():
+            raise OSError("Network is unreachable")
+        to_firmware = asyncio.StreamReader()
+        to_server = asyncio.StreamReader()
+        server_writer = _PipeWriter(to_firmware)
+        if port == 1883:
+            asyncio.ensure_future(self.broker.handle_client(to_server, server_writer))
+        else:
+            asyncio.ensure_future(self.http_server.handle_client(server_hostname or host, to_server, server_writer))
+        return to_firmware, _PipeWriter(to_server)
+
+    async def _start_server(self, callback, host: str, port: int, backlog: int = 5):  # noqa
+        self.status_handler = callback
+        return _StandInServer()
+
+    async def _request_status(self) -> None:
+        """
+        A client on the LAN asking the firmware's status server for /status.
+        """
+        if self.status_handler is None:
+            self.status_responses.append((self.clock.now, None))
+            return
+        to_firmware = asyncio.StreamReader()
+        to_client = asyncio.StreamReader()
+        handled = asyncio.ensure_future(self.status_handler(to_firmware, _PipeWriter(to_client)))
+        _PipeWriter(to_firmware).write(b"GET /status HTTP/1.1\r\nHost: mailbox\r\n\r\n")
+        response = await to_client.read(-1)
+        await handled
+        self.status_responses.append((self.clock.now, response))
+
+    # -- running --
+
+    def _write_settings(self, directory: str) -> None:
+        with open(os.path.join(FIRMWARE_DIRECTORY, 'settings.yaml'), 'r') as file:
+            lines = file.read().splitlines()
+        overridden = set()
+        for index, line in enumerate(lines):
+            key = line.split(':', 1)[0].strip()
+            if not line.startswith('#') and key in self.settings:
+                lines[index] = f"{key}: {self.settings[key]}"
+                overridden.add(key)
+        lines.extend(f"{key}: {value}" for key, value in self.settings.items() if key not in overridden)
+        with open(os.path.join(directory, 'settings.yaml'), 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        values = config.validate(config.parse_yaml(os.path.join(directory, 'settings.yaml')))
+        for signal, (setting, _) in SIGNALS.items():
+            if values[setting] != config.NOT_SET:
+                self.signal_of_pin.setdefault(values[setting], signal)
+
+    def _install_modules(self) -> dict:
+        saved = {name: sys.modules.get(name) for name in STUBBED_MODULES + FIRMWARE_MODULES}
+        for name in FIRMWARE_MODULES:
+            sys.modules.pop(name, None)
+        sys.modules['machine'] = self._machine_module()
+        sys.modules['network'] = self._network_module()
+        sys.modules['time'] = self._time_module()
+        sys.modules['uasyncio'] = self._uasyncio_module()
+        sys.modules['ujson'] = json
+        sys.modules['ustruct'] = struct
+        sys.modules['micropython'] = self._micropython_module()
+        sys.modules['gc'] = self._gc_module()
+        sys.modules['socket'] = self._socket_module()
+        sys.modules['_thread'] = self._thread_module()
+        return saved
+
+    @staticmethod
+    def _restore_modules(saved: dict) -> None:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def _run_firmware(self, coroutine) -> None:
+        """
+        Stands in for uasyncio.run(), runs the firmware's event loop on the virtual clock.
+        """
+        self.firmware = sys.modules.get('app')
+        loop = VirtualEventLoop(self)
+        asyncio.set_event_loop(loop)
+        task = loop.create_task(coroutine)
+        task.add_done_callback(lambda _: loop.stop())
+        loop.call_at(self.duration, loop.stop)
+        for at in self.status_requests:
+            loop.call_at(at, lambda: loop.create_task(self._request_status()))
+        try:
+            loop.run_forever()
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+        finally:
+            for pending in asyncio.all_tasks(loop):
+                pending.cancel()
+            loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop), return_exceptions=True))
+            loop.close()
+            asyncio.set_event_loop(None)
+        raise SimulationFinished()
+
+    def before_iteration(self) -> None:
+        if self.finished:
+            asyncio.get_event_loop().stop()
+        if self.measure_allocations:
+            tracemalloc.reset_peak()
+            self._traced_before = tracemalloc.get_traced_memory()[0]
+        self._iteration_started = _time.perf_counter()
+
+    def after_iteration(self) -> None:
+        self.busy_seconds += _time.perf_counter() - self._iteration_started
+        self.iterations += 1
+        if self.measure_allocations:
+            allocated = tracemalloc.get_traced_memory()[1] - self._traced_before
+            if allocated > 0:
+                self.peak_bytes.append(allocated)
+        while len(self.published_at) < len(self.broker.published):
+            self.published_at.append(self.clock.now)
+        firmware = self.firmware
+        if firmware is not None:
+            delivered = getattr(firmware, 'has_mail_been_delivered', False)
+            if delivered and not self._delivered:
+                self.detections.append(self.clock.now)
+            self._delivered = delivered
+
+    def run(self) -> 'SimulationResult':
+        directory = tempfile.mkdtemp(prefix='mailbox-simulation-')
+        previous_directory = os.getcwd()
+        self._write_settings(directory)
+        saved = self._install_modules()
+        output = contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+        if self.measure_allocations:
+            tracemalloc.start()
+        started = _time.perf_counter()
+        try:
+            os.chdir(directory)
+            with output:
+                import main  # noqa, runs the firmware until the simulated time is up
+        except SimulationFinished:
+            pass
+        except SimulatedReset:
+            self.reset_at = self.clock.now
+        finally:
+            wall_seconds = _time.perf_counter() - started
+            if self.clock.core1.thread is not None:
+                self.clock.core1.stop()
+            if self.measure_allocations:
+                tracemalloc.stop()
+            os.chdir(previous_directory)
+            self._restore_modules(saved)
+            if self.keep_files is not None:
+                shutil.copytree(directory, self.keep_files, dirs_exist_ok=True)
+            shutil.rmtree(directory, ignore_errors=True)
+        return SimulationResult(self, wall_seconds)
+
+
+class SimulationResult:
+    def __init__(self, simulation: Simulation, wall_seconds: float):
+        firmware = simulation.firmware
+        self.simulated_seconds = simulation.clock.now
+        self.wall_seconds = wall_seconds
+        self.reset_at = simulation.reset_at
+        self.iterations = simulation.iterations
+        self.busy_seconds = simulation.busy_seconds
+        self.samples = firmware.past_samples.total if firmware is not None else 0
+        self.detections = simulation.detections
+        self.requests = simulation.http_server.requests
+        self.published = simulation.broker.published
+        self.wifi_connects = simulation.wifi_connects
+        self.energy = firmware.power.budget() if firmware is not None else {}
+        # the firmware's own end to end trace of the last delivery (see latency.py)
+        self.latency = firmware.tracer.attributes() if firmware is not None else {}
+        self.peak_bytes = simulation.peak_bytes
+        self.marks = simulation.trace.marks
+        self.status_responses = simulation.status_responses
+        self.notifications = [at for at, host, method, path, body in self.requests
+                              if method == 'POST' and '/api/states/' in path and json.loads(body).get('state') == 1]
+        # telemetry_transport: gateway, the gateway passes it on from there
+        self.notifications += [at for at, host, method, path, body in self.requests
+                               if path == '/events' and json.loads(body).get('k') == 1 and json.loads(body).get('s') == 1]
+        self.notifications += [at for at, (topic, payload, qos, retain) in zip(simulation.published_at, self.published)
+                               if topic.endswith('/state') and payload == b'1']
+        self.notifications.sort()
+
+    def detection_latencies(self, label: str = 'delivery') -> list:
+        """
+        :return: seconds from each marked delivery to the detection that followed it (None if missed)
+        """
+        latencies = []
+        for at, mark_label in self.marks:
+            if mark_label != label:
+                continue
+            after = [detected for detected in self.detections if detected >= at]
+            latencies.append(after[0] - at if after else None)
+        return latencies
+
+    def false_detections(self, label: str = 'delivery', window: float = 120) -> int:
+        deliveries = [at for at, mark_label in self.marks if mark_label == label]
+        return len([detected for detected in self.detections
+                    if not any(0 <= detected - at <= window for at in deliveries)])
+
+    def summary(self) -> str:
+        lines = [
+            f"simulated {self.simulated_seconds:.0f} s in {self.wall_seconds:.2f} s "
+            f"({self.simulated_seconds / max(self.wall_seconds, 1e-9):.0f}x real time)",
+            f"samples: {self.samples}, event loop iterations: {self.iterations}, "
+            f"firmware cpu time per sample: {self.busy_seconds / max(self.samples, 1) * 1e6:.0f} us (host)",
+            f"detections at: {', '.join(f'{at:.1f} s' for at in self.detections) or 'none'}",
+            f"detection latencies: {self.detection_latencies()}, false detections: {self.false_detections()}",
+            f"home assistant notified at: {', '.join(f'{at:.1f} s' for at in self.notifications) or 'never'}",
+            f"requests: {len(self.requests)}, mqtt publishes: {len(self.published)}, wifi connects: {self.wifi_connects}",
+            f"energy: {self.energy}",
+            f"delivery latency (firmware trace): {self.latency}",
+        ]
+        if self.peak_bytes:
+            lines.append(f"allocated per busy iteration: {sum(self.peak_bytes) / len(self.peak_bytes):.0f} bytes "
+                         f"on average, {max(self.peak_bytes)} at most")
+        if self.reset_at is not None:
+            lines.append(f"the firmware reset the device at {self.reset_at:.1f} s")
+        for at, response in self.status_responses:
+            lines.append(f"status at {at:.1f} s: {response.decode() if response is not None else 'no status server'}")
+        return '\n'.join(lines)
+
+
+def _calendar_timegm(fields: tuple) -> int:
+    import calendar
+    return calendar.timegm(tuple(fields[:6]) + (0, 0, 0))
+
+
+def parse_overrides(overrides: list) -> dict:
+    settings = {}
+    for override in overrides or []:
+        key, separator, value = override.partition('=')
+        if not separator:
+            raise ValueError(f"Expected key=value, got: {override}")
+        settings[key.strip()] = value.strip()
+    return settings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('trace', help="csv file with time, signal, value rows")
+    parser.add_argument('--duration', type=float, help="simulated seconds (default: a minute past the trace)")
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE', help="override a setting")
+    parser.add_argument('--http-status', type=int, default=200)
+    parser.add_argument('--allocations', action='store_true', help="measure allocations (slower)")
+    parser.add_argument('--verbose', action='store_true', help="show the firmware's output")
+    parser.add_argument('--keep-files', metavar='DIRECTORY', help="copy the firmware's flash here afterwards")
+    parser.add_argument('--get-status', action='append', type=float, metavar='SECONDS',
+                        help="ask the status server (status_server_port) for /status at this time")
+    arguments = parser.parse_args()
+    simulation = Simulation(Trace.load(arguments.trace), arguments.duration, parse_overrides(arguments.set),
+                            http_status=arguments.http_status, measure_allocations=arguments.allocations,
+                            verbose=arguments.verbose, keep_files=arguments.keep_files,
+                            status_requests=arguments.get_status)
+    print(simulation.run().summary())
@@ -0,0 +1,411 @@
+"""
+Offline tuner for the delivery detector thresholds.
+Replays recorded sensor data against every combination of consecutive_*_needed_to_trigger
+and sliding_window_size in a grid, and reports for each one how many deliveries it
+missed, how many false detections it made (per day) and how long it took to notice.
+
+The input is either a trace (host/traces/*.csv, sampled every sampling_interval the way
+the firmware does it) or a sample log: one packed sample (see mailbox/samples.py) per byte,
+with the marked deliveries in a trace file next to it (mailbox.samples -> mailbox.marks).
+
+Rather than feeding every sample to every detector, the runs of each sensor are worked
+out once with NumPy, which is all the detector looks at: a sensor with a run of L active
+samples from sample a counts as active long enough (count > needed) from sample
+a + needed + 1 on, if L >= needed + 2. All settings are then stepped from one detection
+(and reset button press) to the next together, so months of samples take seconds.
+The rules are those of DeliveryDetector and detector_task() in app.py:
+- the run counter is capped at window size - 1, and nothing triggers until 10 samples
+  have been seen since the last reset (so never with a window smaller than that)
+- once triggered, everything is ignored until the reset button shows up in a sample, and
+  the detector starts from scratch with the sample after that
+--check replays a few settings through the real DeliveryDetector to make sure the two agree.
+
+    python host/tuner.py host/traces/*.csv
+    python host/tuner.py --synthetic-days 90 --lid 0:20 --tilt 0:20 --bottom 0:30 --window 10,30,60,120
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from simulator import Trace, FIRMWARE_DIRECTORY
+from benchmark import wind_trace
+import config
+from detector import DeliveryDetector, threshold_rules
+from samples import LID_OPEN, BOTTOM_SENSOR_ACTIVE, TILT_SENSOR_ACTIVE, RESET_SENSOR_ACTIVE
+
+MIN_SAMPLES = 10  # DeliveryDetector's default, app.py doesn't change it
+NEVER = np.iinfo(np.int64).max
+CHECK_SAMPLES = 500000  # the real detector takes a few µs per sample, --check replays this many (about 3 days)
+
+# trace signal -> (sample bit, pin level when active, pin level when nothing is going on)
+SIGNAL_BITS = {
+    'lid': (LID_OPEN, 1, 0),
+    'bottom': (BOTTOM_SENSOR_ACTIVE, 0, 1),
+    'tilt': (TILT_SENSOR_ACTIVE, 1, 0),
+    'reset': (RESET_SENSOR_ACTIVE, 0, 1),
+}
+# in the order of the thresholds in a setting: (tilt, lid, bottom, window size)
+SENSOR_BITS = (TILT_SENSOR_ACTIVE, LID_OPEN, BOTTOM_SENSOR_ACTIVE)
+
+
+class Recording:
+    def __init__(self, name: str, samples: np.ndarray, sampling_interval: float, marks: list):
+        """
+        :param samples: packed samples (uint8), one per sampling_interval
+        :param marks: seconds (since the first sample) at which a delivery really happened
+        """
+        self.name = name
+        self.samples = samples
+        self.sampling_interval = sampling_interval
+        self.marks = np.array(sorted(marks), dtype=np.float64)
+
+    @property
+    def days(self) -> float:
+        return len(self.samples) * self.sampling_interval / 86400
+
+
+def sample_trace(trace: Trace, sampling_interval: float, irq: bool = False, duration: float = None) -> np.ndarray:
+    """
+    :param irq: also count a sensor as active if it went active between two samples (sensor_capture_mode: irq)
+    :return: the packed samples the firmware would have seen
+    """
+    if duration is None:
+        duration = trace.end() + 60
+    times = np.arange(int(duration / sampling_interval) + 1) * sampling_interval
+    samples = np.zeros(len(times), dtype=np.uint8)
+    for signal, (bit, active_level, idle_level) in SIGNAL_BITS.items():
+        change_times, values = trace.changes.get(signal, ([], []))
+        change_times = np.asarray(change_times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.int8)
+        index = np.searchsorted(change_times, times, side='right') - 1
+        levels = np.where(index < 0, idle_level, values[np.maximum(index, 0)] if len(values) else idle_level)
+        active = levels == active_level
+        if irq and len(values):
+            # went active: the level becomes active_level and wasn't before
+            previous = np.concatenate(([idle_level], values[:-1]))
+            went_active_at = change_times[(values == active_level) & (previous != active_level)]
+            seen = np.searchsorted(went_active_at, times, side='right')
+            active[1:] |= seen[1:] > seen[:-1]
+        samples[active] |= bit
+    return samples
+
+
+def load_recording(file_name: str, sampling_interval: float, irq: bool) -> Recording:
+    name, extension = os.path.splitext(file_name)
+    if extension == '.samples':
+        samples = np.fromfile(file_name, dtype=np.uint8)
+        marks_file_name = name + '.marks'
+        marks = Trace.load(marks_file_name).marks if os.path.exists(marks_file_name) else []
+    else:
+        trace = Trace.load(file_name)
+        samples = sample_trace(trace, sampling_interval, irq)
+        marks = trace.marks
+    return Recording(os.path.basename(name), samples, sampling_interval,
+                     [at for at, label in marks if label == 'delivery'])
+
+
+def synthetic_recording(days: float, sampling_interval: float, irq: bool, seed: int = 1) -> Recording:
+    """
+    A windy mailbox (see benchmark.wind_trace) which gets mail most days, in all sorts of ways,
+    and is emptied (with the reset button) in the evening.
+    """
+    generator = random.Random(seed)
+    duration = days * 86400
+    trace = wind_trace(duration, seed)
+    for day in range(int(days)):
+        if generator.random() < 0.8:
+            at = day * 86400 + generator.uniform(9, 15) * 3600
+            trace.mark(at, 'delivery')
+            lid_open = generator.uniform(0.8, 6)
+            trace.set(at, 'lid', 1)
+            trace.set(at + lid_open, 'lid', 0)
+            if generator.random() < 0.7:
+                trace.set(at + 0.3, 'tilt', 1)
+                trace.set(at + 0.3 + generator.uniform(0.5, 4), 'tilt', 0)
+            if generator.random() < 0.6:
+                # the bottom sensor stays down until the mail is taken out
+                trace.set(at + generator.uniform(0.5, 2), 'bottom', 0)
+        emptied = day * 86400 + generator.uniform(17, 21) * 3600
+        trace.set(emptied, 'bottom', 1)
+        trace.set(emptied + 5, 'reset', 0)
+        trace.set(emptied + 5.5, 'reset', 1)
+    return Recording(f"synthetic ({days:g} days)", sample_trace(trace, sampling_interval, irq, duration),
+                     sampling_interval, [at for at, label in trace.marks if label == 'delivery'])
+
+
+def _runs(active: np.ndarray) -> tuple:
+    """
+    :return: (start, end) sample index (end exclusive) of every run of active samples
+    """
+    edges = np.diff(np.concatenate(([0], active.view(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+class RunIndex:
+    """
+    The runs of one sensor, and for every threshold the next run which is long enough for it.
+    """
+
+    def __init__(self, active: np.ndarray, thresholds: np.ndarray):
+        self.starts, self.ends = _runs(active)
+        lengths = self.ends - self.starts
+        count = len(self.starts)
+        self.thresholds = thresholds
+        # next_long[i, j]: first run at or after run j which is at least thresholds[i] + 2 samples long
+        self.next_long = np.empty((len(thresholds), count + 1), dtype=np.int64)
+        positions = np.arange(count + 1)
+        for i, needed in enumerate(thresholds):
+            candidates = np.where(np.concatenate((lengths >= needed + 2, [True])), positions, count)
+            self.next_long[i] = np.minimum.accumulate(candidates[::-1])[::-1]
+
+    def next_trigger(self, threshold_index: np.ndarray, start: np.ndarray) -> np.ndarray:
+        """
+        :param threshold_index: per setting, index into thresholds
+        :param start: per setting, the first sample the detector sees after a reset (run counting starts there)
+        :return: per setting, the first sample at which this sensor has been active for long enough, or NEVER
+        """
+        needed = self.thresholds[threshold_index]
+        if not len(self.starts):
+            return np.full(len(start), NEVER)
+        # a run going on at the start only counts from the start
+        run = np.searchsorted(self.starts, start, side='right') - 1
+        ongoing = (run >= 0) & (self.ends[np.maximum(run, 0)] > start)
+        ongoing_end = self.ends[np.maximum(run, 0)]
+        trigger = np.where(ongoing & (ongoing_end - start >= needed + 2), start + needed + 1, NEVER)
+        # or the first long enough run starting after it
+        following = self.next_long[threshold_index, run + 1]
+        found = following < len(self.starts)
+        later = np.where(found, self.starts[np.minimum(following, len(self.starts) - 1)] + needed + 1, NEVER)
+        return np.minimum(trigger, later)
+
+
+def detect(samples: np.ndarray, settings: np.ndarray, thresholds: np.ndarray) -> tuple:
+    """
+    :param settings: (settings, 4) int array of (tilt, lid, bottom, window size) with the thresholds given
+        as indices into thresholds
+    :return: (setting index, sample index) of every detection, in order of time per setting
+    """
+    indexes = [RunIndex((samples & bit) != 0, thresholds) for bit in SENSOR_BITS]
+    resets = np.flatnonzero(samples & RESET_SENSOR_ACTIVE)
+    window = settings[:, 3]
+    alive = np.flatnonzero(window >= MIN_SAMPLES)
+    start = np.zeros(len(alive), dtype=np.int64)
+    found_settings = []
+    found_samples = []
+    while len(alive):
+        trigger = np.full(len(alive), NEVER)
+        for sensor, index in enumerate(indexes):
+            threshold_index = settings[alive, sensor]
+            # the run counter is capped at window size - 1, so it never gets past a threshold of that or more
+            usable = thresholds[threshold_index] < window[alive] - 1
+            trigger = np.minimum(trigger, np.where(usable, index.next_trigger(threshold_index, start), NEVER))
+        detected = np.maximum(trigger, start + MIN_SAMPLES - 1)
+        hit = (trigger != NEVER) & (detected < len(samples))
+        alive, start, detected = alive[hit], start[hit], detected[hit]
+        found_settings.append(alive)
+        found_samples.append(detected)
+        # nothing counts until the reset button shows up, the detector starts over with the sample after that
+        reset = np.searchsorted(resets, detected, side='right')
+        pressed = reset < len(resets)
+        alive = alive[pressed]
+        start = resets[reset[pressed]] + 1
+    if not found_settings:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(found_settings), np.concatenate(found_samples)
+
+
+def detect_reference(samples: np.ndarray, tilt: int, lid: int, bottom: int, window: int) -> list:
+    """
+    The same thing the slow way, through the firmware's own DeliveryDetector.
+    :return: sample index of every detection
+    """
+    detector = DeliveryDetector(threshold_rules(tilt, lid, bottom), window_size=window)
+    delivered = False
+    detections = []
+    for index, sample in enumerate(samples.tolist()):
+        if not delivered:
+            if detector.update(sample):
+                delivered = True
+                detections.append(index)
+        elif sample & RESET_SENSOR_ACTIVE:
+            delivered = False
+            detector.reset()
+    return detections
+
+
+def evaluate(recording: Recording, settings: np.ndarray, thresholds: np.ndarray, match_seconds: float) -> dict:
+    """
+    :param match_seconds: a detection within this long after a marked delivery counts as detecting it
+    :return: per setting arrays of detections, detected deliveries, false detections and latencies (seconds)
+    """
+    setting_index, sample_index = detect(recording.samples, settings, thresholds)
+    count = len(settings)
+    marks = recording.marks
+    at = sample_index * recording.sampling_interval
+    mark = np.searchsorted(marks, at, side='right') - 1
+    matched = (mark >= 0) & (at - marks[np.maximum(mark, 0)] <= match_seconds)
+    # only the first detection after a delivery counts, anything after that is a false one
+    key = setting_index[matched] * max(len(marks), 1) + mark[matched]
+    _, first = np.unique(key, return_index=True)
+    true_setting = setting_index[matched][first]
+    latency = (at[matched] - marks[np.maximum(mark, 0)][matched])[first]
+    detected = np.bincount(true_setting, minlength=count)
+    latency_sum = np.bincount(true_setting, weights=latency, minlength=count)
+    latency_max = np.zeros(count)
+    np.maximum.at(latency_max, true_setting, latency)
+    detections = np.bincount(setting_index, minlength=count)
+    return {
+        "detections": detections,
+        "detected": detected,
+        "false": detections - detected,
+        "latency_sum": latency_sum,
+        "latency_max": latency_max,
+    }
+
+
+def parse_values(text: str) -> list:
+    """
+    :param text: "5", "0:20" (inclusive) or "10,30,60"
+    """
+    values = []
+    for part in text.split(','):
+        if ':' in part:
+            low, high = part.split(':', 1)
+            values.extend(range(int(low), int(high) + 1))
+        else:
+            values.append(int(part))
+    return sorted(set(values))
+
+
+def current_settings() -> tuple:
+    values = config.validate(config.parse_yaml(os.path.join(FIRMWARE_DIRECTORY, 'settings.yaml')))
+    return (values['consecutive_tilt_sensor_active_needed_to_trigger'],
+            values['consecutive_lid_open_needed_to_trigger'],
+            values['consecutive_bottom_sensor_active_needed_to_trigger'],
+            values['sliding_window_size'],
+            values['sampling_interval'])
+
+
+def tune(recordings: list, tilt: list, lid: list, bottom: list, windows: list, match_seconds: float) -> list:
+    thresholds = np.array(sorted(set(tilt) | set(lid) | set(bottom)), dtype=np.int64)
+    position = {value: index for index, value in enumerate(thresholds.tolist())}
+    grid = np.array(np.meshgrid([position[value] for value in tilt], [position[value] for value in lid],
+                                [position[value] for value in bottom], windows, indexing='ij')).reshape(4, -1).T
+    totals = None
+    for recording in recordings:
+        result = evaluate(recording, grid, thresholds, match_seconds)
+        if totals is None:
+            totals = result
+        else:
+            for key in totals:
+                totals[key] = np.maximum(totals[key], result[key]) if key == 'latency_max' else totals[key] + result[key]
+    deliveries = sum(len(recording.marks) for recording in recordings)
+    days = sum(recording.days for recording in recordings)
+    rows = []
+    for index in range(len(grid)):
+        detected = int(totals['detected'][index])
+        rows.append({
+            "tilt": int(thresholds[grid[index, 0]]),
+            "lid": int(thresholds[grid[index, 1]]),
+            "bottom": int(thresholds[grid[index, 2]]),
+            "window": int(grid[index, 3]),
+            "deliveries": deliveries,
+            "missed": deliveries - detected,
+            "false": int(totals['false'][index]),
+            "false_per_day": totals['false'][index] / days if days else 0.0,
+            "mean_latency": totals['latency_sum'][index] / detected if detected else None,
+            "max_latency": float(totals['latency_max'][index]) if detected else None,
+        })
+    return rows
+
+
+def check(recordings: list, rows: list, count: int, seed: int = 1) -> int:
+    """
+    Replay a few settings through the real DeliveryDetector (over the first CHECK_SAMPLES samples).
+    :return: how many of them disagreed
+    """
+    generator = random.Random(seed)
+    disagreements = 0
+    for row in generator.sample(rows, min(count, len(rows))):
+        thresholds = np.array(sorted({row['tilt'], row['lid'], row['bottom']}), dtype=np.int64)
+        position = {value: index for index, value in enumerate(thresholds.tolist())}
+        setting = np.array([[position[row['tilt']], position[row['lid']], position[row['bottom']], row['window']]])
+        for recording in recordings:
+            samples = recording.samples[:CHECK_SAMPLES]
+            fast = detect(samples, setting, thresholds)[1].tolist()
+            slow = detect_reference(samples, row['tilt'], row['lid'], row['bottom'], row['window'])
+            if fast != slow:
+                disagreements += 1
+                print(f"{recording.name}: tilt {row['tilt']} lid {row['lid']} bottom {row['bottom']} "
+                      f"window {row['window']}: {fast[:5]} != {slow[:5]}")
+    return disagreements
+
+
+def _seconds(value) -> str:
+    return '-' if value is None else f"{value:.1f}"
+
+
+def print_table(rows: list, current: tuple) -> None:
+    header = (f"{'tilt':>4} {'lid':>4} {'bottom':>6} {'window':>6} {'missed':>6} {'false':>5} {'false/day':>9} "
+              f"{'latency':>7} {'max':>5}")
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        marker = '  <- settings.yaml' if (row['tilt'], row['lid'], row['bottom'], row['window']) == current else ''
+        print(f"{row['tilt']:>4} {row['lid']:>4} {row['bottom']:>6} {row['window']:>6} {row['missed']:>6} "
+              f"{row['false']:>5} {row['false_per_day']:>9.2f} {_seconds(row['mean_latency']):>7} "
+              f"{_seconds(row['max_latency']):>5}{marker}")
+
+
+if __name__ == '__main__':
+    tilt_default, lid_default, bottom_default, window_default, interval_default = current_settings()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('recordings', nargs='*', help="traces (.csv) or sample logs (.samples)")
+    parser.add_argument('--synthetic-days', type=float, help="also tune against this many days of made up data")
+    parser.add_argument('--tilt', default='0:20', help="consecutive_tilt_sensor_active_needed_to_trigger values, "
+                                                       "e.g. 5, 0:20 or 3,5,8")
+    parser.add_argument('--lid', default='0:20', help="consecutive_lid_open_needed_to_trigger values")
+    parser.add_argument('--bottom', default='0:20', help="consecutive_bottom_sensor_active_needed_to_trigger values")
+    parser.add_argument('--window', default=f"10,30,{window_default},120", help="sliding_window_size values")
+    parser.add_argument('--sampling-interval', type=float, default=interval_default,
+                        help="seconds between samples (default: from settings.yaml)")
+    parser.add_argument('--irq', action='store_true', help="sample the traces like sensor_capture_mode: irq")
+    parser.add_argument('--match-seconds', type=float, default=120,
+                        help="a detection this long after a delivery still counts as detecting it")
+    parser.add_argument('--top', type=int, default=20, help="show the best this many settings")
+    parser.add_argument('--check', type=int, default=0, metavar='COUNT',
+                        help="replay COUNT random settings through the real DeliveryDetector as well")
+    parser.add_argument('--json', help="write every setting's results to this file")
+    arguments = parser.parse_args()
+
+    loaded = [load_recording(file_name, arguments.sampling_interval, arguments.irq)
+              for file_name in arguments.recordings]
+    if arguments.synthetic_days:
+        loaded.append(synthetic_recording(arguments.synthetic_days, arguments.sampling_interval, arguments.irq))
+    if not loaded:
+        parser.error("nothing to tune against, give it recordings or --synthetic-days")
+    started = time.perf_counter()
+    results = tune(loaded, parse_values(arguments.tilt), parse_values(arguments.lid), parse_values(arguments.bottom),
+                   parse_values(arguments.window), arguments.match_seconds)
+    elapsed = time.perf_counter() - started
+    total_samples = sum(len(recording.samples) for recording in loaded)
+    print(f"{len(results)} settings against {total_samples} samples ({sum(r.days for r in loaded):.1f} days, "
+          f"{sum(len(r.marks) for r in loaded)} deliveries) in {elapsed:.2f} s")
+    results.sort(key=lambda row: (row['missed'], row['false_per_day'],
+                                  row['mean_latency'] if row['mean_latency'] is not None else float('inf')))
+    current = (tilt_default, lid_default, bottom_default, window_default)
+    shown = results[:arguments.top]
+    shown += [row for row in results[arguments.top:]
+              if (row['tilt'], row['lid'], row['bottom'], row['window']) == current]
+    print_table(shown, current)
+    if arguments.check:
+        failed = check(loaded, results, arguments.check)
+        print(f"checked {arguments.check} settings against DeliveryDetector: "
+              f"{'all agree' if not failed else f'{failed} disagreements'}")
+    if arguments.json:
+        with open(arguments.json, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,1215 @@
+import os
+import time
+import _thread
+from machine import Pin, reset, idle, reset_cause, PWRON_RESET
+import ujson
+import config
+import log
+from config import Settings, NOT_SET
+import uasyncio as asyncio
+import http_client
+from http_client import HttpClient
+from mqtt import MQTTPublisher
+from outbox import Outbox, TARGET_NTFY, TARGET_HOME_ASSISTANT
+from detector import DeliveryDetector, parse_rules, threshold_rules
+from samples import SampleRing, LID_OPEN, BOTTOM_SENSOR_ACTIVE, TILT_SENSOR_ACTIVE, RESET_SENSOR_ACTIVE
+from edges import EdgeCapture
+from hardware import HardwareProfile
+from power import PowerManager
+from wifi import WifiManager
+from hastate import StateCache
+from statusserver import StatusServer
+from timesync import TimeService, seconds_left_in_window
+import latency
+from latency import LatencyTracer
+import journal
+from journal import Journal
+from indicator import IndicatorQueue
+from heap import HeapMonitor
+from sampleclock import SampleClock
+import dualcore
+from dualcore import CoreChannel
+import startup
+
+# Define error codes
+ERROR_CODE_WIFI_NOT_CONNECTED = 2
+ERROR_CODE_HOME_ASSISTANT_NOT_CONNECTED = 4
+ERROR_CODE_KEYBOARD_INTERRUPT = 6
+ERROR_CODE_WIFI_NOT_CONFIGURED = 8
+ERROR_CODE_NO_SENSORS_CONNECTED = 12
+GOING_TO_SLEEP = 10
+RESETTING = 1
+TIME_SYNC_RETRY_SECONDS = 600
+QUIET_HOURS_CHECK_MS = 60 * 1000
+DELIVERY_SENSORS = LID_OPEN | BOTTOM_SENSOR_ACTIVE | TILT_SENSOR_ACTIVE
+
+# Potentially useful globals
+has_mail_been_delivered: bool = False
+
+# Queues between the tasks, see main()
+INDICATOR_QUEUE_SIZE = 16
+indicator_queue: IndicatorQueue = IndicatorQueue(INDICATOR_QUEUE_SIZE)
+indicator_ready: asyncio.Event = asyncio.Event()
+telemetry_ready: asyncio.Event = asyncio.Event()
+sample_ready: asyncio.Event = asyncio.Event()
+
+
+settings_file_name: str = 'settings.yaml'
+settings: Settings = config.load(settings_file_name)
+log.configure(settings.log_print_level, settings.log_ring_level, settings.log_ring_size)
+if settings.from_snapshot:
+    log.info("Loaded settings from the snapshot of %s", settings_file_name)
+for unknown_key in settings.unknown_keys:
+    log.info("Unknown setting in %s: %s", settings_file_name, unknown_key)
+startup.mark('settings')
+
+# set the SSID and password of your WiFi along with other useful settings
+ssid: str = settings.wifi_ssid
+password: str = settings.wifi_password
+ntfy_topic: str = settings.ntfy_topic
+if ntfy_topic == 'not_set':
+    log.info("Please set your NTFY topic in %s", settings_file_name)
+    log.info("Will run mailbox without NTFY integration")
+else:
+    log.info("ntfy_topic: %s", ntfy_topic)
+home_assistant_url: str = settings.home_assistant_url
+home_assistant_token: str = settings.home_assistant_bearer_token
+home_assistant_is_configured = True
+if home_assistant_token == 'not_set' or home_assistant_token == 'your_home_assistant_bearer_token' or len(
+        home_assistant_token) < 40:
+    log.info("Please set your Home Assistant Bearer Token in %s", settings_file_name)
+    log.info("Will run mailbox without Home Assistant integration")
+    home_assistant_is_configured = False
+home_assistant_unique_id: str = settings.home_assistant_unique_id
+home_assistant_entity_id: str = settings.home_assistant_entity_id
+home_assistant_state_url: str = f"{home_assistant_url}api/states/{home_assistant_entity_id}"
+home_assistant_headers: bytes = http_client.render_headers({
+    "Authorization": f"Bearer {home_assistant_token}",
+    "Content-Type": "application/json; charset=utf-8"
+})
+home_assistant_static_attributes: dict = {
+    "device_class": "enum",
+    "friendly_name": "Smart Mailbox",
+    "unit_of_measurement": "Mail in box",
+    "state_class": None,
+    "unique_id": home_assistant_unique_id
+}
+# both state bodies up to where the attributes which change go, serialized once
+home_assistant_payloads: tuple = tuple(
+    f'{{"state": {state}, "attributes": {ujson.dumps(home_assistant_static_attributes)[:-1]}'.encode('utf-8')
+    for state in (0, 1))
+# what Home Assistant acknowledged last, so the same state isn't sent again (see hastate.py)
+ha_state: StateCache = StateCache(home_assistant_state_url, settings.home_assistant_state_file,
+                                  settings.home_assistant_state_max_age_hours * 3600)
+consecutive_tilt_sensor_active_needed_to_trigger: int = settings.consecutive_tilt_sensor_active_needed_to_trigger
+consecutive_lid_open_needed_to_trigger: int = settings.consecutive_lid_open_needed_to_trigger
+consecutive_bottom_sensor_active_needed_to_trigger: int = settings.consecutive_bottom_sensor_active_needed_to_trigger
+max_wifi_connect_attempts_before_resetting_device: int = settings.max_wifi_connect_attempts_before_resetting_device
+sliding_window_size: int = settings.sliding_window_size
+sampling_interval: float = settings.sampling_interval
+# "loop" samples from the sampler task, "timer" from a machine.Timer at a fixed rate (see sampleclock.py)
+sampling_clock: str = settings.sampling_clock
+sample_clock: SampleClock = SampleClock(int(sampling_interval * 1000), settings.sample_buffer_size)
+log_file_name: str = settings.log_file_name
+# detection_rules (see detector.py) if there are any, one rule per consecutive_*_needed_to_trigger otherwise
+detection_rules: list = threshold_rules(consecutive_tilt_sensor_active_needed_to_trigger,
+                                        consecutive_lid_open_needed_to_trigger,
+                                        consecutive_bottom_sensor_active_needed_to_trigger)
+if settings.detection_rules:
+    detection_rules = parse_rules(settings.detection_rules, sampling_interval)
+    log.info("Detection rules: %s", settings.detection_rules)
+detector: DeliveryDetector = DeliveryDetector(detection_rules, window_size=sliding_window_size,
+                                              cooldown_samples=int(settings.detection_cooldown_seconds /
+                                                                   sampling_interval))
+past_samples: SampleRing = SampleRing(sliding_window_size)
+# "poll" only looks at the sensors once per sampling_interval,
+# "irq" also records every edge in between so short events are not missed
+sensor_capture_mode: str = settings.sensor_capture_mode
+edge_buffer_size: int = settings.edge_buffer_size
+edge_capture: EdgeCapture = None
+# telemetry waits in a small queue on flash until it has been delivered
+telemetry_outbox_file: str = settings.telemetry_outbox_file
+telemetry_outbox_size: int = settings.telemetry_outbox_size
+telemetry_retry_min_seconds: float = settings.telemetry_retry_min_seconds
+telemetry_retry_max_seconds: float = settings.telemetry_retry_max_seconds
+outbox: Outbox = Outbox(telemetry_outbox_file, telemetry_outbox_size)
+# connections to Home Assistant and ntfy.sh are kept open (and reused) for this long
+http_keep_alive_seconds: float = settings.http_keep_alive_seconds
+http_session: HttpClient = HttpClient(keep_alive_seconds=http_keep_alive_seconds)
+# "rest" posts the state to the Home Assistant REST API, "mqtt" publishes it to an MQTT broker
+# (Home Assistant picks the mailbox up through MQTT discovery)
+telemetry_transport: str = settings.telemetry_transport
+mqtt_broker: str = settings.mqtt_broker
+mqtt_port: int = settings.mqtt_port
+mqtt_user: str = settings.mqtt_user
+mqtt_password: str = settings.mqtt_password
+mqtt_keepalive_seconds: int = settings.mqtt_keepalive_seconds
+mqtt_topic_prefix: str = settings.mqtt_topic_prefix
+mqtt_discovery_prefix: str = settings.mqtt_discovery_prefix
+mqtt_publisher: MQTTPublisher = None
+if telemetry_transport == 'mqtt':
+    log.info("Publishing to MQTT broker %s:%s", mqtt_broker, mqtt_port)
+    mqtt_publisher = MQTTPublisher(mqtt_broker, home_assistant_unique_id, port=mqtt_port, user=mqtt_user,
+                                   password=mqtt_password, keepalive_seconds=mqtt_keepalive_seconds,
+                                   topic_prefix=mqtt_topic_prefix, discovery_prefix=mqtt_discovery_prefix)
+# "gateway" sends small events to host/gateway.py, which passes them on to Home Assistant and ntfy.sh
+gateway_url: str = settings.gateway_url
+# lets the gateway tell a resent event (same boot, same sequence number) from a new one after a reboot
+gateway_boot_id: int = int.from_bytes(os.urandom(4), 'big')
+if telemetry_transport == 'gateway':
+    log.info("Sending telemetry through the gateway at %s", gateway_url)
+
+hardware: HardwareProfile = HardwareProfile(settings)
+startup.mark('hardware')
+for pin_setting in ('led_green_pin', 'led_yellow_pin', 'led_red_pin', 'buzzer_pin', 'sensor_bottom_pin',
+                    'sensor_tilt_pin', 'sensor_lid_pin', 'sensor_reset_pin', 'wake_source_pin', 'proximity_sensor_pin'):
+    if getattr(settings, pin_setting) != NOT_SET:
+        log.info("%s: %s", pin_setting, getattr(settings, pin_setting))
+    else:
+        log.info("No %s set in %s", pin_setting, settings_file_name)
+# (sample bit, called while active, called when it goes inactive) per sensor, see build_sensor_feedback()
+sensor_feedback: tuple = ()
+
+# "always_on" keeps the CPU and radio running, "duty_cycled" sleeps between samples and transmissions
+power_mode: str = settings.power_mode
+idle_sampling_interval: float = settings.idle_sampling_interval
+radio_idle_seconds: float = settings.radio_idle_seconds
+power: PowerManager = PowerManager()
+if hardware.has_wake_source:
+    # cuts goto_sleep() (quiet hours, after a reset) short whatever the power mode, and duty cycled sleeps too
+    hardware.wake_source.irq(handler=power.on_wake_pin, trigger=Pin.IRQ_RISING)
+# the full (scan and DHCP) connection gets max_wifi_connect_attempts_before_resetting_device seconds,
+# a failed connection is retried with the telemetry instead of resetting the device
+wifi: WifiManager = WifiManager(ssid, password, settings.wifi_cache_file,
+                                timeout=max_wifi_connect_attempts_before_resetting_device)
+
+# wall clock time (for the quiet hours), kept in sync with NTP
+ntp_servers: list = [server.strip() for server in settings.ntp_servers.split(',') if server.strip()]
+clock: TimeService = TimeService(ntp_servers, timeout=settings.ntp_timeout,
+                                 max_error_seconds=settings.time_max_error_seconds,
+                                 utc_offset_hours=settings.utc_offset_hours)
+quiet_hours_start: int = settings.quiet_hours_start
+quiet_hours_end: int = settings.quiet_hours_end
+quiet_hours_enabled: bool = quiet_hours_start != NOT_SET and quiet_hours_end != NOT_SET
+if quiet_hours_enabled:
+    log.info("Quiet hours (sleeping) from %s:00 to %s:00", quiet_hours_start, quiet_hours_end)
+    if not ntp_servers:
+        log.info("No ntp_servers set in %s, the quiet hours need the time", settings_file_name)
+duty_cycled: bool = power_mode == 'duty_cycled'
+# with MQTT the connection has to stay up for the broker to keep our session (and availability)
+radio_can_be_switched_off: bool = duty_cycled and telemetry_transport != 'mqtt'
+if duty_cycled:
+    log.info("Duty cycling: sleeping between samples, radio off after %s idle seconds", radio_idle_seconds)
+    if sampling_clock == 'timer':
+        # the timer would wake us up for every sample, idle or not
+        log.info("Duty cycling needs sampling_clock: loop, sampling from the loop")
+        sampling_clock = 'loop'
+    if not hardware.wake_source_sees_delivery and sensor_capture_mode != 'irq':
+        # nothing would wake us up for a delivery in between idle samples
+        log.info("Sampling every sampling_interval, idle_sampling_interval needs sensor_capture_mode: irq "
+                 "or a wake_source_pin on a delivery sensor")
+    if not radio_can_be_switched_off:
+        log.info("The radio stays on, the %s transport needs a connection", telemetry_transport)
+# how long a delivery takes from the first sample to Home Assistant (and ntfy) acknowledging it
+tracer: LatencyTracer = LatencyTracer(settings.latency_history_size)
+# LED cycles at power on (not after a reset), the sensors aren't looked at until they are done
+boot_light_cycles: int = settings.boot_light_cycles
+# what happened when, kept on flash for looking back at later (see journal.py)
+event_journal: Journal = None
+if settings.journal_segments:
+    event_journal = Journal(settings.journal_file_prefix, settings.journal_segments,
+                            settings.journal_segment_records, settings.journal_buffer_records)
+# "auto" leaves garbage collection to MicroPython, "scheduled" collects between samples (see heap.py)
+gc_mode: str = settings.gc_mode
+heap: HeapMonitor = HeapMonitor(gc_mode == 'scheduled', settings.gc_collect_after_bytes)
+# "single_core" runs everything on one core, "dual_core" samples and detects on the second one (see dualcore.py)
+runtime_mode: str = settings.runtime_mode
+dual_core: bool = runtime_mode == 'dual_core'
+if dual_core and duty_cycled:
+    # lightsleep stops both cores, the second one would be stopped in the middle of a sample
+    log.info("Duty cycling needs runtime_mode: single_core, running on one core")
+    dual_core = False
+core_channel: CoreChannel = None
+core1_ready: asyncio.ThreadSafeFlag = asyncio.ThreadSafeFlag()
+if dual_core:
+    core_channel = CoreChannel(settings.core_channel_size)
+    if sampling_clock == 'timer':
+        log.info("The second core samples on its own, sampling_clock: timer isn't used")
+        sampling_clock = 'loop'
+    if quiet_hours_enabled:
+        log.info("The second core keeps sampling, the quiet hours aren't slept through with runtime_mode: dual_core")
+# the state as JSON on the local network, for a quick look without Home Assistant (see statusserver.py)
+status_server: StatusServer = None
+if settings.status_server_port:
+    status_server = StatusServer(settings.status_server_port, settings.status_max_age_seconds)
+    if radio_can_be_switched_off:
+        log.info("The status server can only be reached while the radio is on")
+
+"""
+assert ssid != 'your_ssid', f"Please set your WiFi SSID in {settings_file_name}" # noqa
+assert password != 'your_password', f"Please set your WiFi password in {settings_file_name}"  # noqa
+assert home_assistant_token != 'your_token', f"Please set your Home Assistant Bearer Token in {settings_file_name}" # noqa
+assert home_assistant_unique_id != 'net_set', f"Please set your Home Assistant Unique ID in {settings_file_name}" # noqa
+assert home_assistant_entity_id != 'not_set', f"Please set your Home Assistant Entity ID in {settings_file_name}" # noqa
+"""
+
+
+def set_all_output_pins(to_low: bool = True, to_high: bool = False) -> None:
+    for pin in hardware.output_pins:
+        if to_low:
+            pin.low()
+        elif to_high:
+            pin.high()
+
+
+def flash_green_led(flashes: int = 5, flash_duration: float = 0.1) -> None:
+    if hardware.has_led_green:
+        flash_led(hardware.led_green, flashes, flash_duration)
+    else:
+        log.info("No green led connected/configured")
+
+
+def flash_yellow_led(flashes: int = 5, flash_duration: float = 0.1) -> None:
+    if hardware.has_led_yellow:
+        flash_led(hardware.led_yellow, flashes, flash_duration)
+    else:
+        log.info("No yellow led connected/configured")
+
+
+def flash_red_led(flashes: int = 5, flash_duration: float = 0.1) -> None:
+    if hardware.has_led_red:
+        flash_led(hardware.led_red, flashes, flash_duration)
+    else:
+        log.info("No red led connected/configured")
+
+
+def off_green_led() -> None:
+    if hardware.has_led_green:
+        hardware.led_green.low()
+    else:
+        log.info("No green led connected/configured")
+
+
+def off_yellow_led() -> None:
+    if hardware.has_led_yellow:
+        hardware.led_yellow.low()
+    else:
+        log.info("No yellow led connected/configured")
+
+
+def off_red_led() -> None:
+    if hardware.has_led_red:
+        hardware.led_red.low()
+    else:
+        log.info("No red led connected/configured")
+
+
+def flash_led(led: Pin, flashes: int = 5, flash_duration: float = 0.1) -> None:
+    log.info("flashing led: %s times for %s seconds each", flashes, flash_duration)
+    for i in range(flashes):
+        led.high()
+        time.sleep(flash_duration)
+        led.low()
+    log.info('flashing led: done')
+
+
+def slow_flash_led(led: Pin, flashes: int = 5, flash_duration: float = 1) -> None:
+    flash_led(led, flashes, flash_duration)
+
+
+def buzz_buzzer(buzzes: int = 5, buzz_duration: float = 0.1) -> None:
+    if hardware.has_buzzer:
+        log.info("buzzing the buzzer: %s times for %s seconds each", buzzes, buzz_duration)
+        for i in range(buzzes):
+            hardware.buzzer.high()
+            time.sleep(buzz_duration)
+            hardware.buzzer.low()
+        log.info('buzzing the buzzer: done')
+    else:
+        log.info("No buzzer connected")
+
+
+def cycle_lights(cycles: int = 5) -> None:
+    for i in range(cycles):
+        log.info("toggling lights: %s/%s", i, cycles)
+        for led in hardware.output_pins:
+            led.toggle()
+            time.sleep(0.1)
+        leds = hardware.output_pins.copy()
+        leds.reverse()
+        for led in leds:
+            led.toggle()
+            time.sleep(0.1)
+    log.info('toggling lights: done')
+
+
+def signal_error(error_code: int = 1) -> None:
+    log.info("Signaling error code: %s", error_code)
+    buzz_buzzer(5)
+    flash_led(hardware.led_on_board, 5)
+    buzz_buzzer(5)
+    slow_flash_led(hardware.led_on_board, error_code)
+    log.info("Signaling error code: %s done", error_code)
+
+
+def signal_success(success_code: int = 1) -> None:
+    log.info("Signaling success: %s", success_code)
+    buzz_buzzer(2, buzz_duration=0.05)
+    flash_led(hardware.led_on_board, 2)
+    buzz_buzzer(2, buzz_duration=0.05)
+    slow_flash_led(hardware.led_on_board, success_code)
+    log.info("Signaling success: %s done", success_code)
+
+
+def indicate(pin: Pin, flashes: int = 1, flash_duration_ms: int = 100) -> None:
+    # non-blocking version of flash_led, the actual flashing is done by indicator_task
+    if indicator_queue.put(pin, flashes, flash_duration_ms):
+        indicator_ready.set()
+
+
+def indicate_error(error_code: int = 1) -> None:
+    log.info("Signaling error code: %s", error_code)
+    if hardware.has_buzzer:
+        indicate(hardware.buzzer, 5)
+    indicate(hardware.led_on_board, 5)
+    if hardware.has_buzzer:
+        indicate(hardware.buzzer, 5)
+    indicate(hardware.led_on_board, error_code, 1000)
+
+
+def indicate_success(success_code: int = 1) -> None:
+    log.info("Signaling success: %s", success_code)
+    if hardware.has_buzzer:
+        indicate(hardware.buzzer, 2, 50)
+    indicate(hardware.led_on_board, 2)
+    if hardware.has_buzzer:
+        indicate(hardware.buzzer, 2, 50)
+    indicate(hardware.led_on_board, success_code, 1000)
+
+
+def check_wifi_settings() -> None:
+    if ssid == 'ssid_not_set' or password == 'password_not_set':  # noqa
+        signal_error(ERROR_CODE_WIFI_NOT_CONFIGURED)
+        raise ValueError(f"Please set your WiFi SSID and password in {settings_file_name}")
+
+
+async def connect() -> None:
+    """
+    Connect to WiFi (switching the radio on if needed). Raises OSError when that doesn't
+    work out, whatever wanted the connection can try again later.
+    """
+    if wifi.isconnected():
+        return
+    log.info("Connecting to WiFi: %s", ssid)
+    power.radio_switched_on()
+    try:
+        await wifi.connect()
+    except OSError:
+        wifi.disconnect()
+        power.radio_switched_off()
+        indicate_error(ERROR_CODE_WIFI_NOT_CONNECTED)
+        raise
+    log.info("Connected to WiFi: %s in %s ms (%s fast connects so far)",
+             ssid, wifi.last_associate_ms, wifi.fast_connects)
+    log.info("%s", wifi.wlan.ifconfig())
+
+
+def device_attributes() -> dict:
+    """
+    :return: the energy budget, WiFi connection stats, heap stats, delivery latencies and how long the
+        last boot took, sent along with the Home Assistant state
+    """
+    attributes = power.budget()
+    attributes.update(wifi.stats())
+    attributes.update(heap.stats())
+    attributes.update(sample_clock.stats())
+    if core_channel is not None:
+        attributes.update(core_channel.stats())
+    attributes["boot_first_sample_ms"] = startup.elapsed_ms('first_sample')
+    attributes.update(tracer.attributes())
+    if event_journal is not None:
+        attributes.update(event_journal.stats())
+    if telemetry_transport == 'rest':
+        attributes.update(ha_state.stats())
+    if status_server is not None:
+        attributes.update(status_server.stats())
+    return attributes
+
+
+def status() -> dict:
+    """
+    :return: what the status server serves, the state, the last sample and the counters
+    """
+    sample = past_samples.last() if len(past_samples) else 0
+    attributes = {
+        "mail": has_mail_been_delivered,
+        "sample": sample,
+        "lid_open": bool(sample & LID_OPEN),
+        "bottom_sensor_active": bool(sample & BOTTOM_SENSOR_ACTIVE),
+        "tilt_sensor_active": bool(sample & TILT_SENSOR_ACTIVE),
+        "reset_sensor_active": bool(sample & RESET_SENSOR_ACTIVE),
+        "samples": past_samples.total,
+        "outbox": len(outbox),
+    }
+    attributes.update(device_attributes())
+    return attributes
+
+
+def status_changed() -> None:
+    if status_server is not None:
+        status_server.invalidate()
+
+
+def home_assistant_attributes() -> dict:
+    attributes = dict(home_assistant_static_attributes)
+    attributes.update(device_attributes())
+    return attributes
+
+
+async def send_telemetry_to_ha_over_mqtt(mail_has_been_delivered: bool) -> None:
+    log.info("Publishing mailbox state to MQTT: %s", mail_has_been_delivered)
+    attributes = None
+    if len(past_samples):
+        sample = past_samples.last()
+        attributes = {
+            "lid_open": bool(sample & LID_OPEN),
+            "bottom_sensor_active": bool(sample & BOTTOM_SENSOR_ACTIVE),
+            "tilt_sensor_active": bool(sample & TILT_SENSOR_ACTIVE)
+        }
+        attributes.update(device_attributes())
+    await mqtt_publisher.publish_state(mail_has_been_delivered, attributes)
+
+
+async def send_telemetry_to_ha(mail_has_been_delivered: bool) -> http_client.Response:
+    if mqtt_publisher is not None:
+        await send_telemetry_to_ha_over_mqtt(mail_has_been_delivered)
+        return None
+    if not home_assistant_is_configured:
+        log.info("Home Assistant Bearer Token is not set, please set it in %s", settings_file_name)
+        indicate_error(ERROR_CODE_HOME_ASSISTANT_NOT_CONNECTED)
+        return None
+    state = 0
+    if mail_has_been_delivered:
+        state = 1
+    if ha_state.needs_fetch():
+        await fetch_home_assistant_state()
+    if ha_state.is_redundant(state):
+        log.info("Home Assistant shows %s mail in box already, not sending it again", state)
+        return None
+    log.info("Sending telemetry to Home Assistant: %s mail in box", state)
+    # the attributes which change go after the static ones (device_attributes() is never empty)
+    attributes = ujson.dumps(device_attributes()).encode('utf-8')
+    json = home_assistant_payloads[state] + b', ' + attributes[1:] + b'}'
+    response = await http_session.post(home_assistant_state_url, data=json, headers=home_assistant_headers)
+    log.info("Response from Home Assistant: %s", response.status_code)
+    log.info("%s", response.text)
+    if response.status_code < 300:
+        ha_state.acknowledged(state)
+    return response
+
+
+async def fetch_home_assistant_state() -> None:
+    """
+    Ask Home Assistant what it shows for the mailbox (once a boot and whenever the last answer got too old).
+    """
+    log.info("Asking Home Assistant for the state of %s", home_assistant_entity_id)
+    try:
+        response = await http_session.get(home_assistant_state_url, headers=home_assistant_headers)
+    except (OSError, asyncio.TimeoutError):
+        # no second try, the state is simply sent then
+        ha_state.fetched_state(None)
+        raise
+    state = None
+    if response.status_code == 200:
+        try:
+            state = ujson.loads(response.content).get("state")
+        except ValueError:
+            pass
+    log.info("Home Assistant shows: %s (%s)", state, response.status_code)
+    ha_state.fetched_state(state)
+
+
+async def send_telemetry_to_ntfy(mail_has_been_delivered: bool = False,
+                                 optional_message: str = None) -> http_client.Response:
+    log.info("Sending telemetry to NTFY")
+    if ntfy_topic == 'not_set':
+        log.info("Please set your NTFY topic in %s", settings_file_name)
+        return
+    else:
+        log.info("Sending telemetry to NTFY: %s - Mail has been delivered: %s", ntfy_topic, mail_has_been_delivered)
+    url_str = f"https://ntfy.sh/{ntfy_topic}"
+    if optional_message is not None:
+        log.info("Sending telemetry to NTFY: %s", optional_message)
+        response = await http_session.post(url_str, data=optional_message)
+    else:
+        if mail_has_been_delivered:
+            log.info("Sending telemetry to NTFY: Mail has been delivered")
+            response = await http_session.post(url_str, data=b"Mail has been delivered")
+        else:
+            log.info("Sending telemetry to NTFY: Mail has not been delivered")
+            response = await http_session.post(url_str, data=b"Mail has not been delivered")
+    log.info("Response from NTFY: %s", response.status_code)
+    return response
+
+
+async def send_telemetry_to_gateway(target: int, mail_has_been_delivered: bool,
+                                    ntfy_message: str = None) -> http_client.Response:
+    """
+    Hand the oldest outbox entry to the gateway, which answers as soon as it has queued it.
+    Resending the same entry (after a timeout) gets the same sequence number, so it is only passed on once.
+    """
+    event = {
+        "d": home_assistant_unique_id,
+        "b": gateway_boot_id,
+        "n": outbox.acknowledged,
+        "k": target,
+        "s": 1 if mail_has_been_delivered else 0
+    }
+    if target == TARGET_HOME_ASSISTANT:
+        event["e"] = home_assistant_entity_id
+        event["a"] = home_assistant_attributes()
+    else:
+        if ntfy_topic == 'not_set':
+            log.info("Please set your NTFY topic in %s", settings_file_name)
+            return None
+        event["t"] = ntfy_topic
+        if ntfy_message is not None:
+            event["m"] = ntfy_message
+    log.info("Sending telemetry to the gateway: target %s, mail has been delivered: %s (event %s)",
+             target, mail_has_been_delivered, outbox.acknowledged)
+    response = await http_session.post(f"{gateway_url}events", data=ujson.dumps(event),
+                                       headers={"Content-Type": "application/json"})
+    log.info("Response from the gateway: %s", response.status_code)
+    return response
+
+
+def queue_telemetry(mail_has_been_delivered: bool, ntfy_message: str = None) -> None:
+    if mail_has_been_delivered:
+        tracer.mark(latency.ENQUEUED)
+    outbox.put(TARGET_NTFY, mail_has_been_delivered, ntfy_message)
+    outbox.put(TARGET_HOME_ASSISTANT, mail_has_been_delivered)
+    if outbox.dropped:
+        log.info("Telemetry outbox is full, %s messages dropped so far", outbox.dropped)
+    telemetry_ready.set()
+
+
+async def switch_radio_off() -> None:
+    log.info("Switching the radio off")
+    await http_session.close_all()
+    wifi.disconnect()
+    power.radio_switched_off()
+
+
+async def goto_sleep(duration: int = 0) -> None:
+    """
+    Sleep with the radio off for duration seconds, or until the wake source fires.
+    Without a duration we sleep until the wake source fires (or for 20 hours if there is none).
+    :param duration: seconds
+    """
+    if duration > 0:
+        log.info("Going to sleep for %s seconds (%s hours)", duration, duration / 60 / 60)
+        remaining_ms = duration * 1000
+    elif hardware.has_wake_source:
+        log.info("Going to sleep until the wake source fires")
+        remaining_ms = None
+    else:
+        log.info("Going to sleep for 20 hours (since there is no wake source)")
+        remaining_ms = 20 * 60 * 60 * 1000
+    if power.is_radio_on():
+        await switch_radio_off()
+    if remaining_ms is None:
+        power.sleep()
+    else:
+        while remaining_ms > 0:
+            # in chunks, well within what the ticks_ms() arithmetic can handle
+            remaining_ms -= power.sleep(min(remaining_ms, 30 * 60 * 1000))
+            if power.woken_by_pin:
+                log.info("Woken up by the wake source")
+                break
+    log.info("Waking up from sleep")
+    await asyncio.sleep_ms(0)
+
+
+def start_edge_capture() -> EdgeCapture:
+    log.info("Starting edge capture (buffer size: %s)", edge_buffer_size)
+    capture = EdgeCapture(edge_buffer_size)
+    for pin, bit, active_level in hardware.sensors:
+        if bit == hardware.wake_source_sensor:
+            # the wake source's IRQ handler is replaced by this one, so this one has to tell it
+            capture.watch(pin, bit, active_level, also=power.on_wake_pin)
+        else:
+            capture.watch(pin, bit, active_level)
+    return capture
+
+
+def set_leds(on: bool) -> None:
+    for led in hardware.leds:
+        led.value(on)
+
+
+def build_sensor_feedback() -> tuple:
+    """
+    Works out once which sensor has an LED to show it on, so a sample never has to look at
+    sensors or LEDs that aren't there.
+    :return: (sample bit, called while active, called when it goes inactive) per sensor
+    """
+    feedback = []
+    if hardware.has_lid_sensor and hardware.has_led_yellow:
+        feedback.append((LID_OPEN, lambda: indicate(hardware.led_yellow, 1), hardware.led_yellow.low))
+    if hardware.has_bottom_sensor and hardware.has_led_red:
+        feedback.append((BOTTOM_SENSOR_ACTIVE, lambda: indicate(hardware.led_red, 5), hardware.led_red.low))
+    if hardware.has_tilt_sensor and hardware.has_led_green:
+        feedback.append((TILT_SENSOR_ACTIVE, hardware.led_green.high, hardware.led_green.low))
+    if hardware.has_reset_sensor and hardware.leds:
+        feedback.append((RESET_SENSOR_ACTIVE, lambda: set_leds(True), lambda: set_leds(False)))
+    return tuple(feedback)
+
+
+def read_sensors(previous_sample: int) -> int:
+    """
+    :param previous_sample: the sample before this one, LEDs are only switched off on a change
+    :return: the connected sensors packed into a sample (see samples.py)
+    """
+    sample = hardware.read_sample()
+    log.debug("Sensors: %s", sample)
+    show_sensors(sample, previous_sample)
+    return sample
+
+
+def show_sensors(sample: int, previous_sample: int) -> None:
+    """
+    Shows the active sensors on their LEDs.
+    """
+    changed = sample ^ previous_sample
+    for bit, on_active, on_inactive in sensor_feedback:
+        if sample & bit:
+            # flashing on every sample keeps the CPU from ever sleeping, so only on a change when duty cycling
+            if changed & bit or not duty_cycled:
+                on_active()
+        elif changed & bit:
+            on_inactive()
+
+
+def print_sensor_status() -> None:
+    if hardware.has_lid_sensor:
+        log.always("sensor_lid.value(): %s", hardware.sensor_lid.value())
+    if hardware.has_bottom_sensor:
+        log.always("sensor_bottom.value(): %s", hardware.sensor_bottom.value())
+    if hardware.has_tilt_sensor:
+        log.always("sensor_tilt.value(): %s", hardware.sensor_tilt.value())
+    if hardware.has_reset_sensor:
+        log.always("sensor_reset.value(): %s", hardware.sensor_reset.value())
+
+
+def reset_mail_delivery_status(reset_detector: bool = True) -> None:
+    """
+    :param reset_detector: False if the detector has been reset already (by the second core with runtime_mode: dual_core)
+    """
+    global has_mail_been_delivered
+    log.debug("##################################################")
+    log.debug("Resetting mail delivery status")
+    log.debug("##################################################")
+    if hardware.has_led_green:
+        indicate(hardware.led_green, 2)
+    if hardware.has_led_yellow:
+        indicate(hardware.led_yellow, 2)
+    if hardware.has_led_red:
+        indicate(hardware.led_red, 2)
+    indicate_success(RESETTING)
+    has_mail_been_delivered = False
+    status_changed()
+    tracer.abandon()
+    past_samples.clear()
+    if reset_detector:
+        detector.reset()
+    queue_telemetry(False, ntfy_message="Mailbox has been reset")
+
+
+def seconds_until_quiet_hours_end() -> int:
+    """
+    :return: seconds left of the quiet hours, 0 if we are not in them (or don't know what time it is)
+    """
+    if not quiet_hours_enabled or not clock.is_synced():
+        return 0
+    return seconds_left_in_window(clock.second_of_day(), quiet_hours_start, quiet_hours_end)
+
+
+async def sleep_until(deadline: int) -> bool:
+    """
+    Wait for the ticks_ms() deadline, in lightsleep whenever nothing else needs the CPU.
+    :return: whether a pin IRQ ended the wait early
+    """
+    while True:
+        # let the other tasks go first, they hold the CPU awake if they need to
+        await asyncio.sleep_ms(0)
+        remaining = time.ticks_diff(deadline, time.ticks_ms())
+        if remaining <= 0:
+            return False
+        if power.can_sleep(remaining) and not indicator_queue and not telemetry_ready.is_set():
+            if power.sleep(remaining) < remaining:
+                return True
+        else:
+            # something is going on, have another look in a bit
+            await asyncio.sleep_ms(min(remaining, 50))
+
+
+def record_event(event: int, sample: int = 0, value: int = 0) -> None:
+    """
+    Add an event to the journal (if there is one). Sensor changes wait in RAM with the next
+    ones, everything else is written to flash right away (along with them).
+    """
+    if event_journal is not None:
+        event_journal.record(event, sample, value, flush=event != journal.SENSORS)
+
+
+def trace_sample(sample: int, went_active: int, edge_us: int) -> None:
+    """
+    Starts a latency trace at the first sample (or sensor edge) which could turn out to be a
+    delivery, and drops it again if the sensors go quiet before the detector triggers.
+    :param went_active: sensors which went active since the last sample, from the edge capture
+    :param edge_us: ticks_us of the first of those edges
+    """
+    if has_mail_been_delivered:
+        return
+    if sample & DELIVERY_SENSORS:
+        if not tracer.active:
+            if went_active & DELIVERY_SENSORS:
+                tracer.start(edge_us)
+            else:
+                tracer.start()
+    elif tracer.active:
+        tracer.abandon()
+
+
+def process_sample(sample: int, previous_sample: int) -> int:
+    """
+    Everything that comes with a new sample, whichever clock took it: the edges since the
+    last one, the latency trace and the journal, then it is handed to the detector.
+    :return: the sample as the detector sees it
+    """
+    went_active = 0
+    edge_us = 0
+    if edge_capture is not None:
+        # anything that went active between two samples counts as active in this sample
+        went_active = edge_capture.drain()
+        edge_us = edge_capture.first_edge_us
+        sample |= went_active
+    accept_sample(sample, previous_sample, went_active, edge_us)
+    return sample
+
+
+def accept_sample(sample: int, previous_sample: int, went_active: int, edge_us: int) -> None:
+    """
+    The journal, the latency trace and the sample history, for a sample with its edges ORed in already.
+    """
+    if sample != previous_sample:
+        record_event(journal.SENSORS, sample)
+        status_changed()
+    trace_sample(sample, went_active, edge_us)
+    past_samples.append(sample)
+    sample_ready.set()
+    if past_samples.total == 1:
+        startup.mark('first_sample')
+        startup.report()
+    if len(past_samples) > 1 and past_samples.last(1) != past_samples.last(2):
+        print_sensor_status()
+
+
+async def sleep_through_quiet_hours() -> bool:
+    """
+    :return: whether it was quiet hours (and we slept through them)
+    """
+    quiet_seconds = seconds_until_quiet_hours_end()
+    if quiet_seconds and outbox.peek() is None:
+        log.info("Quiet hours, going to sleep until %s:00", quiet_hours_end)
+        await goto_sleep(quiet_seconds)
+        return True
+    return False
+
+
+async def sampler_task() -> None:
+    """
+    Samples the sensors at a fixed cadence. Everything slow (LEDs, buzzer, network)
+    happens in the other tasks, so a tick only costs reading the pins.
+    """
+    interval_ms = int(sampling_interval * 1000)
+    # when nothing is going on and a delivery will wake us up anyway (a pin IRQ), there is no need to look
+    # that often; a wake source which is only the reset button doesn't count
+    idle_interval_ms = int(idle_sampling_interval * 1000)
+    can_be_woken_up = hardware.wake_source_sees_delivery or edge_capture is not None
+    next_sample_at = time.ticks_ms()
+    # working out the time of day allocates, and the quiet hours start on the hour anyway
+    check_quiet_hours_at = next_sample_at
+    sample = 0
+    while True:
+        if quiet_hours_enabled and time.ticks_diff(time.ticks_ms(), check_quiet_hours_at) >= 0:
+            check_quiet_hours_at = time.ticks_add(time.ticks_ms(), QUIET_HOURS_CHECK_MS)
+            if await sleep_through_quiet_hours():
+                next_sample_at = time.ticks_ms()
+                check_quiet_hours_at = next_sample_at
+        sample_clock.note(time.ticks_diff(time.ticks_ms(), next_sample_at) * 1000)
+        previous_sample = sample
+        sample = process_sample(read_sensors(previous_sample), previous_sample)
+
+        if duty_cycled and can_be_woken_up and sample == 0:
+            next_sample_at = time.ticks_add(next_sample_at, idle_interval_ms)
+        else:
+            next_sample_at = time.ticks_add(next_sample_at, interval_ms)
+        delay = time.ticks_diff(next_sample_at, time.ticks_ms())
+        if delay < 0:
+            log.debug("Sampler is %s ms behind schedule", -delay)
+            if -delay >= interval_ms:
+                # a whole sample went missing
+                sample_clock.overruns += 1
+            next_sample_at = time.ticks_ms()
+            delay = 0
+        # a collection now happens while we would be waiting anyway, not in the middle of the next sample
+        heap.idle()
+        if duty_cycled:
+            if await sleep_until(next_sample_at):
+                # woken up early by the wake source or a sensor edge, have a look right away
+                next_sample_at = time.ticks_ms()
+        else:
+            await asyncio.sleep_ms(delay)
+
+
+async def timer_sampler_task() -> None:
+    """
+    The sampler for sampling_clock: timer. The timer takes the samples, this works through
+    them in order, however late it gets to them.
+    """
+    sample_clock.start(hardware.read_sample)
+    check_quiet_hours_at = time.ticks_ms()
+    sample = 0
+    while True:
+        await sample_clock.ready.wait()
+        while sample_clock.pending():
+            previous_sample = sample
+            sample = sample_clock.pop()
+            show_sensors(sample, previous_sample)
+            sample = process_sample(sample, previous_sample)
+        heap.idle()
+        if quiet_hours_enabled and time.ticks_diff(time.ticks_ms(), check_quiet_hours_at) >= 0:
+            check_quiet_hours_at = time.ticks_add(time.ticks_ms(), QUIET_HOURS_CHECK_MS)
+            sample_clock.stop()
+            await sleep_through_quiet_hours()
+            sample_clock.start(hardware.read_sample)
+
+
+def core1_sampler() -> None:
+    """
+    Runs on the second core with runtime_mode: dual_core. Samples the sensors and runs the
+    detector at a fixed cadence, whatever the first core is busy with, and hands both over
+    through core_channel. Nothing in the loop allocates, so a garbage collection on the
+    first core doesn't hold it up.
+    """
+    global edge_capture
+    if sensor_capture_mode == 'irq':
+        # an IRQ is handled by the core which set it up, which had better be the one draining the edges
+        edge_capture = start_edge_capture()
+    interval_ms = int(sampling_interval * 1000)
+    delivered = False
+    next_sample_at = time.ticks_ms()
+    while True:
+        sample_clock.note(time.ticks_diff(time.ticks_ms(), next_sample_at) * 1000)
+        sample = hardware.read_sample()
+        went_active = 0
+        edge_us = 0
+        if edge_capture is not None:
+            went_active = edge_capture.drain()
+            edge_us = edge_capture.first_edge_us
+            sample |= went_active
+        core_channel.put(dualcore.SAMPLE, sample, went_active, edge_us)
+        if not delivered:
+            if detector.update(sample):
+                delivered = True
+                core_channel.put(dualcore.DELIVERED, sample)
+        elif sample & RESET_SENSOR_ACTIVE:
+            delivered = False
+            detector.reset()
+            core_channel.put(dualcore.RESET, sample)
+        core1_ready.set()
+
+        next_sample_at = time.ticks_add(next_sample_at, interval_ms)
+        delay = time.ticks_diff(next_sample_at, time.ticks_ms())
+        if delay < 0:
+            if -delay >= interval_ms:
+                sample_clock.overruns += 1
+            next_sample_at = time.ticks_ms()
+            delay = 0
+        time.sleep_ms(delay)
+
+
+async def core1_events_task() -> None:
+    """
+    The first core's half of runtime_mode: dual_core, everything that comes with the samples
+    and detections the second core hands over (LEDs, journal, latency trace, telemetry).
+    """
+    sample = 0
+    while True:
+        await core1_ready.wait()
+        while core_channel:
+            kind = core_channel.pop()
+            if kind == dualcore.SAMPLE:
+                previous_sample = sample
+                sample = core_channel.sample
+                show_sensors(sample, previous_sample)
+                accept_sample(sample, previous_sample, core_channel.went_active, core_channel.edge_us)
+            elif kind == dualcore.DELIVERED:
+                mail_delivered(core_channel.sample)
+            else:
+                record_event(journal.RESET, core_channel.sample)
+                reset_mail_delivery_status(reset_detector=False)
+        heap.idle()
+
+
+def mail_delivered(sample: int) -> None:
+    global has_mail_been_delivered
+    has_mail_been_delivered = True
+    status_changed()
+    tracer.mark(latency.TRIGGERED)
+    record_event(journal.DELIVERED, sample)
+    log.info("New mail has been delivered")
+    set_all_output_pins(to_low=True)
+    if hardware.has_buzzer:
+        indicate(hardware.buzzer, 5)
+    queue_telemetry(True)
+
+
+async def detector_task() -> None:
+    consumed = past_samples.total
+    while True:
+        await sample_ready.wait()
+        sample_ready.clear()
+        new_samples = min(past_samples.total - consumed, len(past_samples))
+        consumed = past_samples.total
+        # by index, iter_last() would allocate a generator every sample
+        for age in range(new_samples, 0, -1):
+            sample = past_samples.last(age)
+            if not has_mail_been_delivered:
+                if detector.update(sample):
+                    mail_delivered(sample)
+            elif sample & RESET_SENSOR_ACTIVE:
+                record_event(journal.RESET, sample)
+                reset_mail_delivery_status()
+                break
+
+
+async def indicator_task() -> None:
+    while True:
+        await indicator_ready.wait()
+        indicator_ready.clear()
+        power.hold()
+        while indicator_queue:
+            pin = indicator_queue.pop()
+            flash_duration_ms = indicator_queue.flash_duration_ms
+            for i in range(indicator_queue.flashes):
+                pin.high()
+                await asyncio.sleep_ms(flash_duration_ms)
+                pin.low()
+        power.release()
+
+
+async def heartbeat_task() -> None:
+    # flashing on every sample keeps the CPU awake for most of the time, so not when duty cycling
+    heartbeat_interval_ms = int((idle_sampling_interval if duty_cycled else sampling_interval) * 1000)
+    while True:
+        if has_mail_been_delivered:
+            log.info("Mail is in the mailbox")
+            indicate(hardware.led_on_board, 1)
+            await asyncio.sleep(10)
+        else:
+            indicate(hardware.led_on_board, 2)
+            await asyncio.sleep_ms(heartbeat_interval_ms)
+        heap.observe()
+        power.update()
+        if (telemetry_transport == 'rest' and home_assistant_is_configured and ha_state.fetched
+                and ha_state.needs_fetch() and not any(entry[0] == TARGET_HOME_ASSISTANT for entry in outbox.entries)):
+            # Home Assistant might have restarted (and lost the state) since it was last asked
+            outbox.put(TARGET_HOME_ASSISTANT, has_mail_been_delivered)
+            telemetry_ready.set()
+        if duty_cycled and log.enabled(log.DEBUG):
+            log.debug("Energy budget: %s", power.budget())
+
+
+async def time_sync_task() -> None:
+    """
+    Syncs the clock whenever it is predicted to be off by more than time_max_error_seconds,
+    which with a measured drift is rarely more than once every few days.
+    """
+    while True:
+        if clock.needs_sync():
+            radio_was_on = wifi.isconnected()
+            power.hold()
+            try:
+                await connect()
+                await clock.sync()
+                record_event(journal.TIME_SYNCED, value=int(clock.last_offset))
+                log.info("Time synced: %s (the clock was off by %s seconds, drift: %s ppm)",
+                         clock.local_time(), clock.last_offset, clock.drift_ppm)
+            except OSError as e:
+                log.info("Could not sync the time: %s", e)
+            finally:
+                power.release()
+            if radio_can_be_switched_off and not radio_was_on and outbox.peek() is None:
+                await switch_radio_off()
+        if clock.is_synced():
+            wait = clock.seconds_until_resync()
+        else:
+            wait = TIME_SYNC_RETRY_SECONDS
+        # in steps of at most an hour, which ticks_ms() based sleeps can handle
+        await asyncio.sleep(max(1, min(wait, 60 * 60)))
+
+
+async def deliver_telemetry(entry: tuple) -> http_client.Response:
+    power.hold()
+    try:
+        await connect()
+        target, mail_has_been_delivered, ntfy_message = entry
+        if mail_has_been_delivered:
+            tracer.mark(latency.HA_SENT if target == TARGET_HOME_ASSISTANT else latency.NTFY_SENT)
+        if telemetry_transport == 'gateway':
+            return await send_telemetry_to_gateway(target, mail_has_been_delivered, ntfy_message)
+        if target == TARGET_HOME_ASSISTANT:
+            return await send_telemetry_to_ha(mail_has_been_delivered)
+        return await send_telemetry_to_ntfy(mail_has_been_delivered, optional_message=ntfy_message)
+    finally:
+        power.release()
+
+
+async def wait_for_telemetry() -> None:
+    """
+    Wait for something to be put in the outbox, switching the radio off if that takes a while.
+    """
+    if radio_can_be_switched_off and power.is_radio_on():
+        try:
+            await asyncio.wait_for(telemetry_ready.wait(), radio_idle_seconds)
+        except asyncio.TimeoutError:
+            await switch_radio_off()
+    await telemetry_ready.wait()
+    telemetry_ready.clear()
+
+
+def trace_acknowledged(target: int) -> None:
+    """
+    Closes the ntfy or Home Assistant stage of the latency trace, the trace ends with Home Assistant.
+    """
+    if target == TARGET_NTFY:
+        tracer.mark(latency.NTFY_ACKNOWLEDGED)
+        return
+    tracer.mark(latency.HA_ACKNOWLEDGED)
+    breakdown = tracer.finish()
+    if breakdown is not None:
+        log.info("Delivery latency (ms since the first sample): %s", breakdown)
+        log.info("Delivery latency histogram (last %s deliveries): %s", settings.latency_history_size,
+                 tracer.histogram())
+
+
+async def telemetry_task() -> None:
+    """
+    Drains the outbox, oldest message first. A message stays in the outbox until it has
+    been delivered, failed attempts are retried with exponential backoff.
+    """
+    retry_in = telemetry_retry_min_seconds
+    while True:
+        entry = outbox.peek()
+        if entry is None:
+            await wait_for_telemetry()
+            continue
+        try:
+            response = await deliver_telemetry(entry)
+            if response is not None and response.status_code >= 500:
+                raise OSError(f"Server responded with {response.status_code}")
+        except (OSError, asyncio.TimeoutError) as e:
+            log.info("Could not send telemetry: %s, retrying in %s seconds", e, retry_in)
+            if retry_in == telemetry_retry_min_seconds:
+                indicate_error(ERROR_CODE_HOME_ASSISTANT_NOT_CONNECTED)
+            # the outbox is looked at again after the backoff anyway, nothing to wake up for until then
+            telemetry_ready.clear()
+            await asyncio.sleep(retry_in)
+            retry_in = min(retry_in * 2, telemetry_retry_max_seconds)
+            continue
+        if response is not None and response.status_code >= 400:
+            # retrying won't make a bad request any better
+            log.info("Telemetry was rejected (%s), dropping it", response.status_code)
+        retry_in = telemetry_retry_min_seconds
+        outbox.acknowledge(entry)
+        target, mail_has_been_delivered, _ = entry
+        if mail_has_been_delivered:
+            trace_acknowledged(target)
+
+
+async def run() -> None:
+    heap.start()
+    if gc_mode == 'scheduled':
+        log.info("Collecting garbage between samples, every %s bytes allocated", heap.collect_after_bytes)
+    if event_journal is not None:
+        event_journal.open()
+        record_event(journal.BOOT)
+        startup.mark('journal')
+    wifi.load_cache()
+    ha_state.load()
+    outbox.load()
+    if len(outbox):
+        log.info("%s telemetry messages left over from before the last reboot", len(outbox))
+    # resetting the state in Home Assistant, telemetry_task connects to WiFi for it while the sampler gets going
+    outbox.put(TARGET_HOME_ASSISTANT, False)
+    telemetry_ready.set()
+    startup.mark('outbox')
+    if dual_core:
+        log.info("Sampling on the second core")
+        _thread.start_new_thread(core1_sampler, ())
+        tasks = [core1_events_task()]
+    elif sampling_clock == 'timer':
+        log.info("Sampling every %s ms on a timer", sample_clock.period_ms)
+        tasks = [timer_sampler_task(), detector_task()]
+    else:
+        tasks = [sampler_task(), detector_task()]
+    tasks += [indicator_task(), heartbeat_task(), telemetry_task()]
+    if status_server is not None:
+        await status_server.start(status)
+        log.info("Status server listening on port %s", status_server.port)
+    if quiet_hours_enabled and ntp_servers:
+        tasks.append(time_sync_task())
+    if mqtt_publisher is not None:
+        tasks.append(mqtt_publisher.keepalive_task())
+    await asyncio.gather(*tasks)
+
+
+def main():
+    global edge_capture, sensor_feedback
+    log.info("Starting main")
+    set_all_output_pins(to_low=True)
+    # the light show is for whoever just plugged the mailbox in, a reset() shouldn't keep it blind for that long
+    if boot_light_cycles and reset_cause() == PWRON_RESET:
+        cycle_lights(boot_light_cycles)
+        startup.mark('lights')
+
+    if not hardware.has_delivery_sensor:
+        log.info("You need at least one sensor connected in order to run this program")
+        signal_error(ERROR_CODE_NO_SENSORS_CONNECTED)
+        idle()
+    try:
+        check_wifi_settings()
+    except KeyboardInterrupt:
+        log.info("KeyboardInterrupt")
+        signal_error(ERROR_CODE_KEYBOARD_INTERRUPT)
+        reset()
+    except ValueError as e:
+        log.info("ValueError: %s", e)
+        hardware.led_on_board.high()
+        reset()
+
+    sensor_feedback = build_sensor_feedback()
+    if sensor_capture_mode == 'irq' and not dual_core:
+        edge_capture = start_edge_capture()
+    startup.mark('sensors')
+
+    try:
+        asyncio.run(run())
+    except Exception as e:
+        # keep the last moments before the crash around for a post mortem
+        log.always("Crashed: %s", e)
+        log.flush(log_file_name)
+        record_event(journal.CRASHED)
+        raise
@@ -0,0 +1,285 @@
+"""
+Settings loading.
+settings.yaml is parsed (with our own homegrown, quite limited, yaml parser) and checked
+against SCHEMA once. The typed result is then written to a compact binary snapshot
+(settings.bin) which later boots load directly, as long as settings.yaml has not changed
+(same size and modification time), skipping the parsing and all the throwaway strings.
+"""
+import os
+import struct
+
+NOT_SET = -1
+
+# (key, type, default)
+SCHEMA = (
+    # connectivity
+    ('wifi_ssid', str, 'ssid_not_set'),
+    ('wifi_password', str, 'wifi_password_not_set'),
+    ('max_wifi_connect_attempts_before_resetting_device', int, 10),
+    ('wifi_cache_file', str, 'wifi.json'),
+    ('ntfy_topic', str, 'not_set'),
+    ('home_assistant_url', str, 'http://homeassistant.local:8123/'),
+    ('home_assistant_bearer_token', str, 'not_set'),
+    ('home_assistant_entity_id', str, 'not_set'),
+    ('home_assistant_unique_id', str, 'net_set'),
+    ('home_assistant_state_file', str, 'ha_state.json'),
+    ('home_assistant_state_max_age_hours', float, 6.0),
+    # detection
+    ('consecutive_tilt_sensor_active_needed_to_trigger', int, 5),
+    ('consecutive_lid_open_needed_to_trigger', int, 5),
+    ('consecutive_bottom_sensor_active_needed_to_trigger', int, 10),
+    ('detection_rules', str, ''),
+    ('detection_cooldown_seconds', float, 0.0),
+    ('sliding_window_size', int, 60),
+    ('sampling_interval', float, 0.5),
+    ('sampling_clock', str, 'loop'),
+    ('sample_buffer_size', int, 32),
+    ('runtime_mode', str, 'single_core'),
+    ('core_channel_size', int, 64),
+    ('sensor_capture_mode', str, 'poll'),
+    ('edge_buffer_size', int, 64),
+    # power
+    ('power_mode', str, 'always_on'),
+    ('idle_sampling_interval', float, 5.0),
+    ('radio_idle_seconds', float, 30.0),
+    # time
+    ('ntp_servers', str, 'pool.ntp.org,time.google.com,time.cloudflare.com'),
+    ('ntp_timeout', float, 1.0),
+    ('time_max_error_seconds', float, 30.0),
+    ('utc_offset_hours', float, 0.0),
+    ('quiet_hours_start', int, NOT_SET),
+    ('quiet_hours_end', int, NOT_SET),
+    # telemetry
+    ('telemetry_outbox_file', str, 'outbox.json'),
+    ('telemetry_outbox_size', int, 8),
+    ('telemetry_retry_min_seconds', float, 2.0),
+    ('telemetry_retry_max_seconds', float, 300.0),
+    ('http_keep_alive_seconds', float, 60.0),
+    ('latency_history_size', int, 32),
+    ('status_server_port', int, 0),
+    ('status_max_age_seconds', float, 10.0),
+    ('telemetry_transport', str, 'rest'),
+    ('mqtt_broker', str, 'homeassistant.local'),
+    ('mqtt_port', int, 1883),
+    ('mqtt_user', str, ''),
+    ('mqtt_password', str, ''),
+    ('mqtt_keepalive_seconds', int, 60),
+    ('mqtt_topic_prefix', str, 'mailbox'),
+    ('mqtt_discovery_prefix', str, 'homeassistant'),
+    ('gateway_url', str, 'http://mailbox-gateway.local:8125/'),
+    # logging, lower is more important: -1 always, 0 info, 1 debug
+    ('log_print_level', int, 5),
+    ('log_ring_level', int, 1),
+    ('log_ring_size', int, 64),
+    ('log_file_name', str, 'log.txt'),
+    # event journal on flash, 0 segments switches it off
+    ('journal_file_prefix', str, 'journal'),
+    ('journal_segments', int, 4),
+    ('journal_segment_records', int, 341),
+    ('journal_buffer_records', int, 32),
+    # memory
+    ('gc_mode', str, 'auto'),
+    ('gc_collect_after_bytes', int, 16 * 1024),
+    # startup
+    ('boot_light_cycles', int, 5),
+    # pins
+    ('led_green_pin', int, NOT_SET),
+    ('led_yellow_pin', int, NOT_SET),
+    ('led_red_pin', int, NOT_SET),
+    ('buzzer_pin', int, NOT_SET),
+    ('sensor_bottom_pin', int, NOT_SET),
+    ('sensor_tilt_pin', int, NOT_SET),
+    ('sensor_lid_pin', int, NOT_SET),
+    ('sensor_reset_pin', int, NOT_SET),
+    ('wake_source_pin', int, NOT_SET),
+    ('proximity_sensor_pin', int, NOT_SET),
+)
+
+CHOICES = {
+    'sensor_capture_mode': ('poll', 'irq'),
+    'sampling_clock': ('loop', 'timer'),
+    'runtime_mode': ('single_core', 'dual_core'),
+    'telemetry_transport': ('rest', 'mqtt', 'gateway'),
+    'power_mode': ('always_on', 'duty_cycled'),
+    'gc_mode': ('auto', 'scheduled'),
+}
+
+MINIMUMS = {
+    'max_wifi_connect_attempts_before_resetting_device': 1,
+    'consecutive_tilt_sensor_active_needed_to_trigger': 0,
+    'consecutive_lid_open_needed_to_trigger': 0,
+    'consecutive_bottom_sensor_active_needed_to_trigger': 0,
+    'detection_cooldown_seconds': 0.0,
+    'home_assistant_state_max_age_hours': 0.0,
+    'sliding_window_size': 2,
+    'sampling_interval': 0.01,
+    'edge_buffer_size': 1,
+    'sample_buffer_size': 1,
+    'core_channel_size': 3,
+    'status_server_port': 0,
+    'status_max_age_seconds': 0.0,
+    'idle_sampling_interval': 0.01,
+    'ntp_timeout': 0.1,
+    'time_max_error_seconds': 2,
+    'radio_idle_seconds': 0,
+    'telemetry_outbox_size': 2,
+    'telemetry_retry_min_seconds': 0.1,
+    'http_keep_alive_seconds': 0,
+    'latency_history_size': 1,
+    'mqtt_keepalive_seconds': 1,
+    'log_ring_size': 1,
+    'journal_segments': 0,
+    'journal_segment_records': 2,
+    'journal_buffer_records': 1,
+    'gc_collect_after_bytes': 1024,
+    'boot_light_cycles': 0,
+}
+
+SNAPSHOT_MAGIC = b'MBS1'
+
+
+class Settings:
+    def __init__(self, values: dict, from_snapshot: bool = False, unknown_keys: list = None):
+        for key, _, _ in SCHEMA:
+            setattr(self, key, values[key])
+        self.from_snapshot = from_snapshot
+        self.unknown_keys = unknown_keys or []
+
+
+def parse_yaml(file_name: str) -> dict:
+    """
+    Reads "key: value" lines, everything after a " #" is a comment,
+    surrounding quotes are stripped from the values.
+    """
+    parsed = {}
+    with open(file_name, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            key, separator, value = line.partition(':')
+            if not separator:
+                continue
+            value = value.strip()
+            if value and value[0] in '"\'':
+                end = value.find(value[0], 1)
+                if end > 0:
+                    value = value[1:end]
+            else:
+                comment = value.find(' #')
+                if comment >= 0:
+                    value = value[:comment].rstrip()
+            parsed[key.strip()] = value
+    return parsed
+
+
+def _convert(key: str, kind, value: str):
+    try:
+        if kind is bool:
+            lowered = value.lower()
+            if lowered in ('true', 'yes', 'on', '1'):
+                return True
+            if lowered in ('false', 'no', 'off', '0'):
+                return False
+            raise ValueError(value)
+        return kind(value)
+    except ValueError:
+        raise ValueError(f"{key} should be a {kind.__name__}, got: {value}")
+
+
+def validate(parsed: dict) -> dict:
+    values = {}
+    for key, kind, default in SCHEMA:
+        if key in parsed and (parsed[key] != '' or kind is str):
+            value = _convert(key, kind, parsed[key])
+        else:
+            value = default
+        if key in CHOICES and value not in CHOICES[key]:
+            raise ValueError(f"{key} should be one of {CHOICES[key]}, got: {value}")
+        if key in MINIMUMS and value < MINIMUMS[key]:
+            raise ValueError(f"{key} should be at least {MINIMUMS[key]}, got: {value}")
+        values[key] = value
+    return values
+
+
+# how each type is stored in a snapshot, part of the fingerprint so a changed type invalidates it
+_TYPE_TAGS = {str: 1, int: 2, float: 3, bool: 4}
+
+
+def _schema_fingerprint() -> int:
+    fingerprint = len(SCHEMA)
+    for key, kind, _ in SCHEMA:
+        for character in key:
+            fingerprint = (fingerprint * 31 + ord(character)) & 0xFFFFFFFF
+        fingerprint = (fingerprint * 31 + _TYPE_TAGS[kind]) & 0xFFFFFFFF
+    return fingerprint
+
+
+def _source_stamp(file_name: str) -> tuple:
+    stat = os.stat(file_name)
+    return stat[6], stat[8]  # size, modification time
+
+
+def encode_snapshot(values: dict, stamp: tuple) -> bytes:
+    parts = [SNAPSHOT_MAGIC, struct.pack('<III', _schema_fingerprint(), stamp[0], stamp[1])]
+    for key, kind, _ in SCHEMA:
+        value = values[key]
+        if kind is str:
+            encoded = value.encode('utf-8')
+            parts.append(struct.pack('<H', len(encoded)))
+            parts.append(encoded)
+        elif kind is int:
+            parts.append(struct.pack('<i', value))
+        elif kind is float:
+            parts.append(struct.pack('<d', value))
+        else:
+            parts.append(struct.pack('<B', 1 if value else 0))
+    return b''.join(parts)
+
+
+def decode_snapshot(blob: bytes, stamp: tuple) -> dict:
+    """
+    :return: the settings stored in the snapshot or None if it is stale (or not a snapshot at all)
+    """
+    if blob[:4] != SNAPSHOT_MAGIC:
+        return None
+    if struct.unpack_from('<III', blob, 4) != (_schema_fingerprint(), stamp[0], stamp[1]):
+        return None
+    values = {}
+    offset = 16
+    for key, kind, _ in SCHEMA:
+        if kind is str:
+            length = struct.unpack_from('<H', blob, offset)[0]
+            values[key] = str(blob[offset + 2:offset + 2 + length], 'utf-8')
+            offset += 2 + length
+        elif kind is int:
+            values[key] = struct.unpack_from('<i', blob, offset)[0]
+            offset += 4
+        elif kind is float:
+            values[key] = struct.unpack_from('<d', blob, offset)[0]
+            offset += 8
+        else:
+            values[key] = blob[offset] == 1
+            offset += 1
+    return values
+
+
+def load(file_name: str = 'settings.yaml', snapshot_file_name: str = 'settings.bin') -> Settings:
+    stamp = _source_stamp(file_name)
+    try:
+        with open(snapshot_file_name, 'rb') as file:
+            values = decode_snapshot(file.read(), stamp)
+        if values is not None:
+            return Settings(values, from_snapshot=True)
+    except (OSError, ValueError, IndexError):
+        pass  # no usable snapshot, parse settings.yaml instead
+    parsed = parse_yaml(file_name)
+    values = validate(parsed)
+    known_keys = [key for key, _, _ in SCHEMA]
+    unknown_keys = [key for key in parsed if key not in known_keys]
+    try:
+        with open(snapshot_file_name, 'wb') as file:
+            file.write(encode_snapshot(values, stamp))
+    except OSError:
+        pass  # read only filesystem, we'll just parse again next boot
+    return Settings(values, unknown_keys=unknown_keys)
@@ -0,0 +1,167 @@
+from array import array
+from samples import LID_OPEN, BOTTOM_SENSOR_ACTIVE, TILT_SENSOR_ACTIVE
+
+# the sensors a detection rule can name
+SENSOR_NAMES = {
+    'lid': LID_OPEN,
+    'bottom': BOTTOM_SENSOR_ACTIVE,
+    'tilt': TILT_SENSOR_ACTIVE,
+}
+# every combination of the four sensor bits of a packed sample (see samples.py)
+SAMPLE_COMBINATIONS = 16
+# one bit per rule in the lookup table
+MAX_RULES = 8
+
+
+def _condition(text: str) -> int:
+    """
+    :param text: sensors joined by "&" (all of them active), alternatives joined by "|", "!" in front
+        of a sensor means it has to be inactive, e.g. "lid & bottom | tilt & !lid"
+    :return: bit s set for every sample combination s the condition holds for
+    """
+    condition = 0
+    for alternative in text.split('|'):
+        required = 0
+        forbidden = 0
+        for name in alternative.split('&'):
+            name = name.strip()
+            inverted = name.startswith('!')
+            if inverted:
+                name = name[1:].strip()
+            if name not in SENSOR_NAMES:
+                raise ValueError(f"Unknown sensor in detection rule: {name or text} "
+                                 f"(known: {', '.join(SENSOR_NAMES)})")
+            if inverted:
+                forbidden |= SENSOR_NAMES[name]
+            else:
+                required |= SENSOR_NAMES[name]
+        if required & forbidden:
+            raise ValueError(f"Detection rule can never hold: {alternative.strip()}")
+        if not required:
+            raise ValueError(f"Detection rule needs at least one active sensor: {alternative.strip()}")
+        for sample in range(SAMPLE_COMBINATIONS):
+            if sample & required == required and not sample & forbidden:
+                condition |= 1 << sample
+    return condition
+
+
+def parse_rules(text: str, sampling_interval: float) -> list:
+    """
+    Compile the detection_rules setting: rules separated by ";", each a condition (see _condition)
+    and how long it has to hold in a row, either in samples ("lid & bottom > 3": held in more than
+    3 samples in a row after the first one, like consecutive_*_needed_to_trigger) or in seconds
+    ("tilt > 2.5s").
+    :return: (condition, needed) per rule
+    """
+    rules = []
+    for rule in text.split(';'):
+        if not rule.strip():
+            continue
+        condition, separator, duration = rule.rpartition('>')
+        duration = duration.strip()
+        if not separator or not duration:
+            raise ValueError(f"Detection rule should look like \"lid & bottom > 3\", got: {rule.strip()}")
+        try:
+            if duration.endswith('s'):
+                needed = int(float(duration[:-1]) / sampling_interval + 1e-6)
+            else:
+                needed = int(duration)
+        except ValueError:
+            raise ValueError(f"Detection rule duration should be samples or seconds (\"2.5s\"), got: {duration}")
+        if needed < 0:
+            raise ValueError(f"Detection rule duration can't be negative, got: {duration}")
+        rules.append((_condition(condition), needed))
+    if not rules:
+        raise ValueError("detection_rules has no rules in it")
+    if len(rules) > MAX_RULES:
+        raise ValueError(f"At most {MAX_RULES} detection rules, got {len(rules)}")
+    return rules
+
+
+def threshold_rules(consecutive_tilt_needed: int, consecutive_lid_needed: int, consecutive_bottom_needed: int) -> list:
+    """
+    :return: the rules of the consecutive_*_needed_to_trigger settings, any one of the sensors
+        active for long enough
+    """
+    return [(_condition('tilt'), consecutive_tilt_needed),
+            (_condition('lid'), consecutive_lid_needed),
+            (_condition('bottom'), consecutive_bottom_needed)]
+
+
+class DeliveryDetector:
+    """
+    Incremental version of the old check_if_mail_has_been_delivered() scan, driven by rules
+    (see parse_rules). The rules are compiled into a table with an entry for every combination
+    of sensor bits, holding a bit for every rule whose condition that combination satisfies,
+    so a sample costs one lookup, and the run counters are only touched while some rule holds.
+    - a rule's counter is bumped when its condition holds in this sample AND the previous one
+    - a counter is cleared when the condition doesn't hold
+    - a run can never count more than the window can hold (window size - 1)
+    - a rule triggers once its counter gets past what it needs
+    - nothing triggers until at least min_samples samples have been collected
+    - after a reset no condition holds for cooldown_samples samples
+    """
+
+    def __init__(self,
+                 rules: list,
+                 window_size: int = 60,
+                 min_samples: int = 10,
+                 cooldown_samples: int = 0):
+        """
+        :param rules: (condition, needed) per rule, from parse_rules() or threshold_rules()
+        """
+        if not rules or len(rules) > MAX_RULES:
+            raise ValueError(f"DeliveryDetector needs 1 to {MAX_RULES} rules, got {len(rules)}")
+        self.rules = rules
+        self.window_size = window_size
+        self.min_samples = min_samples
+        self.cooldown_samples = cooldown_samples
+        self._table = bytearray(SAMPLE_COMBINATIONS)
+        for index, (condition, _) in enumerate(rules):
+            for sample in range(SAMPLE_COMBINATIONS):
+                if condition & (1 << sample):
+                    self._table[sample] |= 1 << index
+        self._needed = array('H', [min(needed, 0xffff) for _, needed in rules])
+        self._runs = array('H', [0] * len(rules))
+        self.reset()
+        self.cooldown_left = 0
+
+    def reset(self) -> None:
+        self.samples_seen = 0
+        self.cooldown_left = self.cooldown_samples
+        for index in range(len(self._runs)):
+            self._runs[index] = 0
+        self._previous = 0  # the rules which held in the previous sample
+        self._counting = 0  # the rules with a run going
+        self._triggered = False
+
+    def update(self, sample: int) -> bool:
+        """
+        Feed one new packed sample (see samples.py) to the detector.
+        :return: True if the samples seen so far (within the window) count as a mail delivery
+        """
+        holding = self._table[sample & (SAMPLE_COMBINATIONS - 1)]
+        if self.cooldown_left:
+            self.cooldown_left -= 1
+            holding = 0
+        held = holding & self._previous
+        self._previous = holding
+        if held or self._counting:
+            self._counting = held
+            limit = self.window_size - 1
+            for index in range(len(self._runs)):
+                if held & (1 << index):
+                    run = self._runs[index]
+                    if run < limit:
+                        run += 1
+                        self._runs[index] = run
+                    if run > self._needed[index]:
+                        # remembered so that a run which completed before min_samples was reached still counts
+                        self._triggered = True
+                else:
+                    self._runs[index] = 0
+        if self.samples_seen < self.window_size:
+            self.samples_seen += 1
+        if self.samples_seen < self.min_samples:
+            return False
+        return self._triggered
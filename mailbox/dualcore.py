@@ -0,0 +1,93 @@
+"""
+Hand-over between the two cores of the RP2040 for runtime_mode: dual_core.
+The second core samples the sensors and runs the detector on its own, the first one does
+everything which can keep the CPU for a while (WiFi, TLS, telemetry, flash, LEDs). What the
+second core has seen goes to the first one through a CoreChannel: a preallocated ring of
+messages (a sample, a delivery, a reset) behind a lock which is only ever held for a
+handful of assignments, so neither core waits on the other for long and putting a message
+never allocates.
+"""
+import _thread
+from array import array
+
+# message kinds
+SAMPLE = 0
+DELIVERED = 1
+RESET = 2
+
+# slots samples can't take, so a delivery or a reset still goes through while the first core is behind
+EVENT_SLOTS = 2
+
+
+class CoreChannel:
+    def __init__(self, capacity: int = 64):
+        if capacity <= EVENT_SLOTS:
+            raise ValueError(f"CoreChannel needs a capacity of more than {EVENT_SLOTS}, got {capacity}")
+        self.capacity = capacity
+        self._kinds = bytearray(capacity)
+        self._samples = bytearray(capacity)
+        self._went_active = bytearray(capacity)
+        self._edges_us = array('L', [0] * capacity)
+        self._first = 0
+        self._count = 0
+        self._lock = _thread.allocate_lock()
+        # the message pop() took off last
+        self.sample = 0
+        self.went_active = 0
+        self.edge_us = 0
+        # counters
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def put(self, kind: int, sample: int, went_active: int = 0, edge_us: int = 0) -> bool:
+        """
+        :param went_active: sensors which went active since the last sample (edge capture)
+        :param edge_us: ticks_us of the first of those edges
+        :return: False (and the message is dropped) if the channel is full
+        """
+        limit = self.capacity - EVENT_SLOTS if kind == SAMPLE else self.capacity
+        self._lock.acquire()
+        count = self._count
+        if count >= limit:
+            self.dropped += 1
+            self._lock.release()
+            return False
+        index = self._first + count
+        if index >= self.capacity:
+            index -= self.capacity
+        self._kinds[index] = kind
+        self._samples[index] = sample
+        self._went_active[index] = went_active
+        self._edges_us[index] = edge_us
+        self._count = count + 1
+        if self._count > self.high_water:
+            self.high_water = self._count
+        self._lock.release()
+        return True
+
+    def pop(self) -> int:
+        """
+        Take the oldest message off the channel (which must not be empty).
+        :return: its kind, the rest of it is left in sample, went_active and edge_us
+        """
+        self._lock.acquire()
+        index = self._first
+        kind = self._kinds[index]
+        self.sample = self._samples[index]
+        self.went_active = self._went_active[index]
+        self.edge_us = self._edges_us[index]
+        self._first += 1
+        if self._first == self.capacity:
+            self._first = 0
+        self._count -= 1
+        self._lock.release()
+        return kind
+
+    def stats(self) -> dict:
+        return {
+            "core_channel_dropped": self.dropped,
+            "core_channel_high_water": self.high_water,
+        }
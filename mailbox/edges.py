@@ -0,0 +1,86 @@
+"""
+Interrupt driven edge capture for the sensor pins.
+Polling every sampling_interval misses anything shorter than the interval, so in "irq"
+capture mode every sensor pin gets an IRQ handler which stores a ticks_us timestamp and
+the new pin state in a preallocated buffer. The main loop drains the buffer once per
+tick and ORs whatever went active since the previous tick into the sample.
+"""
+import time
+from array import array
+from machine import Pin, disable_irq, enable_irq
+import micropython
+
+# room for a traceback if something goes wrong inside an IRQ handler
+micropython.alloc_emergency_exception_buf(100)
+
+# set in the stored event byte when the pin went to its active level
+EDGE_ACTIVE = 0x80
+
+
+class EdgeCapture:
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self._timestamps = array('L', [0] * capacity)
+        self._events = bytearray(capacity)
+        self._count = 0
+        self.overflows = 0
+        self.first_edge_us = 0  # ticks_us of the first edge in the last drained batch
+        self.last_edge_us = 0  # ticks_us of the last edge in the last drained batch
+        self.pins = []
+
+    def watch(self, pin: Pin, bit: int, active_level: int, also=None) -> None:
+        """
+        Start recording edges on a pin.
+        :param pin: an input pin
+        :param bit: the sample bit (see samples.py) this pin reports
+        :param active_level: pin.value() when the sensor is active
+        :param also: another (non-allocating) IRQ handler for the pin, which this one replaces
+        """
+        if also is None:
+            handler = lambda p: self._record(p, bit, active_level)
+        else:
+            def handler(p):
+                self._record(p, bit, active_level)
+                also(p)
+        pin.irq(handler=handler, trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, hard=True)
+        self.pins.append(pin)
+
+    def stop(self) -> None:
+        for pin in self.pins:
+            pin.irq(handler=None)
+        self.pins = []
+
+    def _record(self, pin: Pin, bit: int, active_level: int) -> None:
+        # runs in (hard) interrupt context, must not allocate
+        index = self._count
+        if index >= self.capacity:
+            self.overflows += 1
+            return
+        self._timestamps[index] = time.ticks_us()
+        if pin.value() == active_level:
+            self._events[index] = bit | EDGE_ACTIVE
+        else:
+            self._events[index] = bit
+        self._count = index + 1
+
+    def pending(self) -> int:
+        return self._count
+
+    def drain(self) -> int:
+        """
+        Consume all recorded edges.
+        :return: packed sample bits of every sensor that went active since the last drain
+        """
+        seen_active = 0
+        state = disable_irq()
+        count = self._count
+        if count:
+            self.first_edge_us = self._timestamps[0]
+            self.last_edge_us = self._timestamps[count - 1]
+            for index in range(count):
+                event = self._events[index]
+                if event & EDGE_ACTIVE:
+                    seen_active |= event & ~EDGE_ACTIVE
+            self._count = 0
+        enable_irq(state)
+        return seen_active
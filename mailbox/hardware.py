@@ -0,0 +1,97 @@
+"""
+Everything that is physically connected, worked out once at startup from the settings.
+Pins that aren't configured are None and the has_* flags say what is available, so the
+rest of the code never has to probe for pins (or catch exceptions) while running.
+"""
+from machine import Pin
+from config import Settings, NOT_SET
+from samples import LID_OPEN, BOTTOM_SENSOR_ACTIVE, TILT_SENSOR_ACTIVE, RESET_SENSOR_ACTIVE
+
+# pin.value() when the sensor is active,
+# the lid and tilt sensors are active high, the bottom and reset buttons pull the pin low
+LID_ACTIVE_LEVEL = 1
+BOTTOM_ACTIVE_LEVEL = 0
+TILT_ACTIVE_LEVEL = 1
+RESET_ACTIVE_LEVEL = 0
+
+
+def _output_pin(pin_number: int) -> Pin:
+    if pin_number == NOT_SET:
+        return None
+    return Pin(pin_number, Pin.OUT)
+
+
+def _input_pin(pin_number: int) -> Pin:
+    if pin_number == NOT_SET:
+        return None
+    return Pin(pin_number, Pin.IN, pull=Pin.PULL_UP)
+
+
+class HardwareProfile:
+    def __init__(self, settings: Settings):
+        self.led_on_board = Pin("LED", Pin.OUT)
+        self.led_green = _output_pin(settings.led_green_pin)
+        self.led_yellow = _output_pin(settings.led_yellow_pin)
+        self.led_red = _output_pin(settings.led_red_pin)
+        self.buzzer = _output_pin(settings.buzzer_pin)
+        self.sensor_lid = _input_pin(settings.sensor_lid_pin)
+        self.sensor_bottom = _input_pin(settings.sensor_bottom_pin)
+        self.sensor_tilt = _input_pin(settings.sensor_tilt_pin)
+        self.sensor_reset = _input_pin(settings.sensor_reset_pin)
+        self.wake_source = _input_pin(settings.wake_source_pin)
+        self.proximity_sensor = _input_pin(settings.proximity_sensor_pin)
+        if self.wake_source is not None:
+            self.wake_source.irq(handler=None, trigger=Pin.IRQ_RISING)
+
+        self.has_led_green = self.led_green is not None
+        self.has_led_yellow = self.led_yellow is not None
+        self.has_led_red = self.led_red is not None
+        self.has_buzzer = self.buzzer is not None
+        self.has_lid_sensor = self.sensor_lid is not None
+        self.has_bottom_sensor = self.sensor_bottom is not None
+        self.has_tilt_sensor = self.sensor_tilt is not None
+        self.has_reset_sensor = self.sensor_reset is not None
+        self.has_wake_source = self.wake_source is not None
+        self.has_delivery_sensor = self.has_lid_sensor or self.has_bottom_sensor or self.has_tilt_sensor
+
+        # the on board LED first, then the external LEDs in order (used for the light show at boot)
+        self.output_pins = [self.led_on_board]
+        self.leds = []
+        for led in (self.led_green, self.led_yellow, self.led_red):
+            if led is not None:
+                self.output_pins.append(led)
+                self.leds.append(led)
+
+        # (pin, sample bit, active level) for every connected sensor
+        self.sensors = []
+        for pin, bit, active_level in ((self.sensor_lid, LID_OPEN, LID_ACTIVE_LEVEL),
+                                       (self.sensor_bottom, BOTTOM_SENSOR_ACTIVE, BOTTOM_ACTIVE_LEVEL),
+                                       (self.sensor_tilt, TILT_SENSOR_ACTIVE, TILT_ACTIVE_LEVEL),
+                                       (self.sensor_reset, RESET_SENSOR_ACTIVE, RESET_ACTIVE_LEVEL)):
+            if pin is not None:
+                self.sensors.append((pin, bit, active_level))
+        # the sensor (sample bit) whose pin is the wake source as well, 0 if it has a pin of its own:
+        # a pin only has one IRQ handler, so the edge capture has to wake us up for it then
+        self.wake_source_sensor = 0
+        for pin_number, bit in ((settings.sensor_lid_pin, LID_OPEN),
+                                (settings.sensor_bottom_pin, BOTTOM_SENSOR_ACTIVE),
+                                (settings.sensor_tilt_pin, TILT_SENSOR_ACTIVE),
+                                (settings.sensor_reset_pin, RESET_SENSOR_ACTIVE)):
+            if self.has_wake_source and pin_number == settings.wake_source_pin:
+                self.wake_source_sensor = bit
+        # whether the wake source goes off for a delivery (and not just for the reset button)
+        self.wake_source_sees_delivery = bool(self.wake_source_sensor & (LID_OPEN | BOTTOM_SENSOR_ACTIVE |
+                                                                         TILT_SENSOR_ACTIVE))
+        # bound value() methods, so reading a sample is one call per connected sensor and nothing else
+        self._readers = tuple((pin.value, bit, active_level) for pin, bit, active_level in self.sensors)
+
+    def read_sample(self) -> int:
+        """
+        :return: the connected sensors packed into a sample (see samples.py)
+        """
+        sample = 0
+        for read, bit, active_level in self._readers:
+            if read() == active_level:
+                sample |= bit
+        return sample
+
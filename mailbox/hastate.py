@@ -0,0 +1,99 @@
+"""
+What Home Assistant shows for the mailbox, as far as we know.
+Every boot used to POST "no mail" to Home Assistant, whether it already showed that or not,
+which for a mailbox that reboots a lot (duty cycling, flaky power, the watchdog) means
+radio time and a state write (recorder, automations) for nothing. The state Home Assistant
+last acknowledged is kept on flash instead, and a POST of that same state is skipped.
+Home Assistant forgets states set over the REST API when it restarts though, so what is on
+flash is only a hint: Home Assistant is asked with a GET once a boot, and again whenever
+that answer is older than max_age_seconds, and when it has nothing (404, "unknown") or
+something else the state is POSTed again.
+"""
+import os
+import time
+import ujson
+
+# ticks_diff() can only tell apart a few days
+MAX_AGE_LIMIT_SECONDS = 3 * 24 * 60 * 60
+
+
+class StateCache:
+    def __init__(self, entity_url: str, file_name: str = 'ha_state.json', max_age_seconds: float = 6 * 60 * 60):
+        """
+        :param entity_url: the entity's /api/states/ URL, a cache for another one doesn't count
+        :param max_age_seconds: ask Home Assistant again after this long, 0 for only once a boot
+        """
+        self.entity_url = entity_url
+        self.file_name = file_name
+        self.max_age_ms = int(min(max_age_seconds, MAX_AGE_LIMIT_SECONDS) * 1000)
+        self.state = None  # what Home Assistant acknowledged last, None if we don't know
+        self.fetched = False  # whether Home Assistant has been asked this boot
+        self._checked_at = 0  # when Home Assistant last told us (GET or POST) what it has
+        # counters
+        self.skipped = 0
+        self.fetches = 0
+
+    def load(self) -> None:
+        try:
+            with open(self.file_name, 'r') as file:
+                cache = ujson.load(file)
+            if cache.get("url") == self.entity_url:
+                self.state = cache.get("state")
+        except (OSError, ValueError):
+            self.state = None
+
+    def _save(self) -> None:
+        temp_file_name = self.file_name + '.tmp'
+        try:
+            with open(temp_file_name, 'w') as file:
+                ujson.dump({"url": self.entity_url, "state": self.state}, file)
+            os.rename(temp_file_name, self.file_name)
+        except OSError:
+            pass  # we'll ask Home Assistant again next boot
+
+    def needs_fetch(self) -> bool:
+        """
+        :return: whether Home Assistant should be asked first (once a boot, and once what it told us gets too old)
+        """
+        if not self.fetched:
+            return True
+        return self.max_age_ms > 0 and time.ticks_diff(time.ticks_ms(), self._checked_at) >= self.max_age_ms
+
+    def fetched_state(self, state: str) -> None:
+        """
+        :param state: the entity's state from a GET, None if Home Assistant doesn't have the entity
+            (or couldn't be asked)
+        """
+        self.fetched = True
+        self.fetches += 1
+        self._checked_at = time.ticks_ms()
+        if state in ('0', '1'):
+            self.acknowledged(int(state))
+        elif self.state is not None:
+            # lost (restarted) or never had it, whatever is on flash doesn't hold anymore
+            self.state = None
+            self._save()
+
+    def is_redundant(self, state: int) -> bool:
+        """
+        :return: True (and it counts as skipped) if Home Assistant shows this state already
+        """
+        if state == self.state:
+            self.skipped += 1
+            return True
+        return False
+
+    def acknowledged(self, state: int) -> None:
+        """
+        Home Assistant has the state, only written to flash when it changes.
+        """
+        self._checked_at = time.ticks_ms()
+        if state != self.state:
+            self.state = state
+            self._save()
+
+    def stats(self) -> dict:
+        return {
+            "ha_posts_skipped": self.skipped,
+            "ha_state_fetches": self.fetches,
+        }
@@ -0,0 +1,90 @@
+"""
+Heap bookkeeping and garbage collection scheduling.
+Left to itself MicroPython only collects once an allocation doesn't fit any more, which
+means a pause (of a few ms, the whole heap is scanned) at whatever moment that happens
+to be, in the middle of a sample or a TLS handshake. With gc_mode: scheduled the
+firmware calls idle() when it has time to spare (a tick is done and it is about to sleep
+until the next one) and the heap is collected there, once collect_after_bytes have been
+allocated since the last collection. The automatic collection stays as a safety net for
+the odd burst (telemetry), at a threshold well above that.
+
+Either way the free heap, the lowest it has been and the collection pauses are tracked
+and sent along with the telemetry. live_bytes (what is left right after a collection)
+creeping up over the days is a leak.
+"""
+import gc
+import time
+
+
+class HeapMonitor:
+    def __init__(self, scheduled: bool = False, collect_after_bytes: int = 16 * 1024):
+        """
+        :param scheduled: collect in idle() instead of leaving it all to the automatic collection
+        :param collect_after_bytes: how much has to have been allocated before idle() collects
+        """
+        if collect_after_bytes < 1:
+            raise ValueError(f"HeapMonitor needs collect_after_bytes of at least 1, got {collect_after_bytes}")
+        self.scheduled = scheduled
+        self.collect_after_bytes = collect_after_bytes
+        self._allocated_after_collect = gc.mem_alloc()
+        self.free = gc.mem_free()
+        self.min_free = self.free
+        self.live_bytes = self._allocated_after_collect
+        # counters
+        self.collections = 0
+        self.pause_last_us = 0
+        self.pause_max_us = 0
+        self.pause_total_us = 0
+
+    def start(self) -> None:
+        """
+        Start from a clean heap, and hand the collecting over to idle() when scheduled.
+        """
+        self.collect()
+        if self.scheduled:
+            gc.threshold(4 * self.collect_after_bytes)
+
+    def collect(self) -> int:
+        """
+        Collect now, timing it.
+        :return: how long it took (us)
+        """
+        # the heap is as full as it gets right before a collection
+        self.observe()
+        started = time.ticks_us()
+        gc.collect()
+        pause = time.ticks_diff(time.ticks_us(), started)
+        self.collections += 1
+        self.pause_last_us = pause
+        self.pause_total_us += pause
+        if pause > self.pause_max_us:
+            self.pause_max_us = pause
+        self._allocated_after_collect = gc.mem_alloc()
+        self.live_bytes = self._allocated_after_collect
+        self.free = gc.mem_free()
+        return pause
+
+    def idle(self) -> None:
+        """
+        Call when there is time to spare, collects (when scheduled) if enough has been allocated.
+        """
+        if self.scheduled and gc.mem_alloc() - self._allocated_after_collect >= self.collect_after_bytes:
+            self.collect()
+
+    def observe(self) -> None:
+        free = gc.mem_free()
+        self.free = free
+        if free < self.min_free:
+            self.min_free = free
+
+    def stats(self) -> dict:
+        self.observe()
+        return {
+            "heap_free": self.free,
+            "heap_min_free": self.min_free,
+            "heap_live_bytes": self.live_bytes,
+            "gc_collections": self.collections,
+            "gc_pause_last_us": self.pause_last_us,
+            "gc_pause_max_us": self.pause_max_us,
+            "gc_pause_avg_us": self.pause_total_us // self.collections if self.collections else 0,
+        }
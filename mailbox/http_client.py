@@ -0,0 +1,280 @@
+"""
+Minimal non-blocking HTTP/1.1 client on top of uasyncio streams.
+urequests blocks the whole device for the duration of a request (DNS, TCP connect, TLS
+handshake and the round trip). This client yields to the other tasks while it waits on
+the network, so sampling keeps going while a notification is in flight. The one exception
+is the DNS lookup: getaddrinfo() blocks, for as long as the lookup takes (mDNS names like
+homeassistant.local can take a while), but it is only done when the cached address expires.
+Connections are kept alive and reused per host, host names are resolved once and cached
+and all TLS connections share one SSL context, so a notification usually only costs a
+single round trip instead of DNS + TCP + TLS + request.
+"""
+import socket
+import time
+import uasyncio as asyncio
+
+try:
+    import ssl
+except ImportError:
+    import ussl as ssl
+
+
+class _NoResponse(OSError):
+    """
+    The connection was closed before the server said anything, so the request can be sent again.
+    """
+
+
+class Response:
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
+
+
+def split_url(url: str) -> tuple:
+    """
+    :return: (use_tls, host, port, path)
+    """
+    if url.startswith('https://'):
+        use_tls = True
+        port = 443
+        url = url[8:]
+    elif url.startswith('http://'):
+        use_tls = False
+        port = 80
+        url = url[7:]
+    else:
+        raise ValueError(f"Unsupported URL (only http:// and https:// are supported): {url}")
+    if '/' in url:
+        host, path = url.split('/', 1)
+        path = '/' + path
+    else:
+        host = url
+        path = '/'
+    if ':' in host:
+        host, port = host.split(':', 1)
+        port = int(port)
+    return use_tls, host, port, path
+
+
+def render_headers(headers: dict) -> bytes:
+    """
+    Header lines for request(), for headers which are the same for every request and are
+    better rendered once than on every request.
+    """
+    lines = ''
+    for key in headers:
+        lines += f"{key}: {headers[key]}\r\n"
+    return lines.encode('utf-8')
+
+
+def _parse_int(value: bytes, base: int) -> int:
+    """
+    :return: a status code, length or chunk size from a response, OSError if it isn't one
+    """
+    try:
+        number = int(value.strip(), base)
+    except ValueError:
+        raise OSError(f"Malformed number in HTTP response: {value[:20]}")
+    if number < 0:
+        raise OSError(f"Negative number in HTTP response: {value[:20]}")
+    return number
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.ticks_ms()
+        self.requests = 0
+
+    async def close(self) -> None:
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class HttpClient:
+    def __init__(self, keep_alive_seconds: float = 60, dns_cache_seconds: float = 3600, timeout: float = 10):
+        self.keep_alive_ms = int(keep_alive_seconds * 1000)
+        self.dns_cache_ms = int(dns_cache_seconds * 1000)
+        self.timeout = timeout
+        self._connections = {}  # (host, port, use_tls) -> _Connection
+        self._addresses = {}  # (host, port) -> (ip, resolved at)
+        self._ssl_context = None
+        # counters, handy for telling how well the reuse is working
+        self.connects = 0
+        self.reused = 0
+        self.dns_lookups = 0
+
+    def _resolve(self, host: str, port: int) -> str:
+        """
+        :return: the host's address, looked up (blocking the event loop) when it isn't cached
+        """
+        cached = self._addresses.get((host, port))
+        if cached is not None and time.ticks_diff(time.ticks_ms(), cached[1]) < self.dns_cache_ms:
+            return cached[0]
+        self.dns_lookups += 1
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][-1]
+        if not isinstance(address, tuple):
+            # older firmware hands back a raw sockaddr, let open_connection() resolve the name itself
+            return host
+        ip = address[0]
+        self._addresses[(host, port)] = (ip, time.ticks_ms())
+        return ip
+
+    def _get_ssl_context(self):
+        if self._ssl_context is None:
+            self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            # same as urequests, there is no certificate store on the device
+            if hasattr(self._ssl_context, 'check_hostname'):
+                self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+        return self._ssl_context
+
+    async def _connect(self, host: str, port: int, use_tls: bool) -> _Connection:
+        ip = self._resolve(host, port)
+        self.connects += 1
+        try:
+            if use_tls:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(ip, port, ssl=self._get_ssl_context(), server_hostname=host),
+                    self.timeout)
+            else:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            # the host might have moved (DHCP, mDNS), look it up again next time
+            self._addresses.pop((host, port), None)
+            raise
+        return _Connection(reader, writer)
+
+    async def _read_response(self, reader) -> tuple:
+        """
+        :return: (response, keep_alive), raises OSError if the response is malformed or cut short
+        """
+        try:
+            return await self._parse_response(reader)
+        except EOFError:
+            # readexactly() ran out (IncompleteReadError on CPython is an EOFError too)
+            raise OSError("Connection closed in the middle of a response")
+
+    async def _parse_response(self, reader) -> tuple:
+        try:
+            status_line = await reader.readline()
+        except OSError as e:
+            # reset, most likely a kept alive connection the server had closed already
+            raise _NoResponse(f"Connection lost before a response was received: {e}")
+        if not status_line:
+            raise _NoResponse("Connection closed before a response was received")
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+            raise OSError(f"Not an HTTP response: {status_line[:40]}")
+        status_code = _parse_int(parts[1], 10)
+        keep_alive = parts[0] == b'HTTP/1.1'
+        content_length = -1
+        chunked = False
+        while True:
+            line = await reader.readline()
+            if not line or line == b'\r\n':
+                break
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == b'content-length':
+                content_length = _parse_int(value, 10)
+            elif name == b'transfer-encoding':
+                chunked = value == b'chunked'
+            elif name == b'connection':
+                keep_alive = value == b'keep-alive' or (keep_alive and value != b'close')
+        if chunked:
+            content = b''
+            while True:
+                size = _parse_int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                content += await reader.readexactly(size)
+                await reader.readline()
+        elif content_length >= 0:
+            content = await reader.readexactly(content_length) if content_length else b''
+        else:
+            # no length, the body ends when the server closes the connection
+            content = await reader.read(-1)
+            keep_alive = False
+        return Response(status_code, content), keep_alive
+
+    async def request(self, method: str, url: str, data=None, headers=None) -> Response:
+        """
+        :param headers: a dict, or header lines from render_headers()
+        """
+        use_tls, host, port, path = split_url(url)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        head = f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n"
+        if data is not None:
+            head += f"Content-Length: {len(data)}\r\n"
+        if isinstance(headers, bytes):
+            head = head.encode('utf-8') + headers + b'\r\n'
+        else:
+            if headers:
+                for key in headers:
+                    head += f"{key}: {headers[key]}\r\n"
+            head = head.encode('utf-8') + b'\r\n'
+
+        key = (host, port, use_tls)
+        connection = self._connections.pop(key, None)
+        if connection is not None and time.ticks_diff(time.ticks_ms(), connection.last_used) > self.keep_alive_ms:
+            await connection.close()
+            connection = None
+        while True:
+            reused = connection is not None
+            if not reused:
+                connection = await self._connect(host, port, use_tls)
+            sent = False
+            try:
+                connection.writer.write(head)
+                if data is not None:
+                    connection.writer.write(data)
+                await connection.writer.drain()
+                sent = True
+                response, keep_alive = await asyncio.wait_for(self._read_response(connection.reader), self.timeout)
+                break
+            except (OSError, asyncio.TimeoutError) as e:
+                await connection.close()
+                connection = None
+                # only sent again if the server can't have acted on it: after a timeout or a cut off
+                # response it might have, and a POST sent twice is a notification sent twice
+                if not reused or (sent and not isinstance(e, _NoResponse)):
+                    raise
+                # the server most likely closed the idle connection, try once more on a fresh one
+        connection.requests += 1
+        if reused:
+            self.reused += 1
+        if keep_alive:
+            connection.last_used = time.ticks_ms()
+            self._connections[key] = connection
+        else:
+            await connection.close()
+        return response
+
+    async def get(self, url: str, headers=None) -> Response:
+        return await self.request('GET', url, headers=headers)
+
+    async def post(self, url: str, data=None, headers=None) -> Response:
+        return await self.request('POST', url, data=data, headers=headers)
+
+    async def close_all(self) -> None:
+        """
+        Close every pooled connection, e.g. before the radio is switched off.
+        """
+        connections = self._connections
+        self._connections = {}
+        for key in connections:
+            await connections[key].close()
+
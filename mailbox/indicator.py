@@ -0,0 +1,56 @@
+"""
+Queue of LED (and buzzer) flashes for indicator_task in app.py.
+A fixed size ring of (pin, flashes, flash duration) with all memory allocated up front,
+so queueing a flash from the sampler (which happens on every sample while a sensor is
+active, and with every heartbeat) doesn't allocate a tuple each time.
+"""
+from array import array
+
+
+class IndicatorQueue:
+    def __init__(self, capacity: int = 16):
+        if capacity < 1:
+            raise ValueError(f"IndicatorQueue needs a capacity of at least 1, got {capacity}")
+        self.capacity = capacity
+        self._pins = [None] * capacity
+        self._flashes = array('H', [0] * capacity)
+        self._durations_ms = array('H', [0] * capacity)
+        self._first = 0
+        self._count = 0
+        # the entry pop() took off last
+        self.flashes = 0
+        self.flash_duration_ms = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def put(self, pin, flashes: int, flash_duration_ms: int) -> bool:
+        """
+        :return: False (and the flash is dropped) if the queue is full
+        """
+        if self._count == self.capacity:
+            return False
+        index = self._first + self._count
+        if index >= self.capacity:
+            index -= self.capacity
+        self._pins[index] = pin
+        self._flashes[index] = flashes
+        self._durations_ms[index] = flash_duration_ms
+        self._count += 1
+        return True
+
+    def pop(self):
+        """
+        Take the oldest entry off the queue (which must not be empty).
+        :return: its pin, its flashes and flash duration are left in flashes and flash_duration_ms
+        """
+        index = self._first
+        pin = self._pins[index]
+        self._pins[index] = None
+        self.flashes = self._flashes[index]
+        self.flash_duration_ms = self._durations_ms[index]
+        self._first += 1
+        if self._first == self.capacity:
+            self._first = 0
+        self._count -= 1
+        return pin
@@ -0,0 +1,191 @@
+"""
+Append-only event journal on flash.
+Fixed-size binary records (what happened, when and which sensors were active) go into a
+few preallocated segment files, which are written one after the other: once the last one
+is full, the oldest one is erased and reused. Every segment is rewritten once per trip
+around the ring, instead of one file being rewritten all the time, and the journal never
+takes more flash than it was given.
+
+Records are collected in RAM and only written when something worth keeping happened
+(a delivery, a reset, a reboot, the clock being set) or the buffer is full, so a windy day
+with the lid rattling costs a flash write every buffer_records changes, not one per change.
+Buffered records are lost when the power goes, the delivery (and the sensor changes which
+led to it) is not.
+
+Segment layout, little endian, RECORD_SIZE bytes per slot:
+
+    slot 0: magic b'MBJ1', sequence number (uint32), 4 bytes padding (0xff)
+    slot n: seconds (uint32, time.time()), milliseconds (uint16), event (uint8), sample (uint8), value (int32)
+
+Unused slots are all 0xff, the newest segment is the one with the highest sequence number.
+Copy the journal*.bin files off the device (mpremote cp :journal0.bin .) and decode them
+with host/journal_reader.py.
+"""
+import struct
+import time
+
+MAGIC = b'MBJ1'
+HEADER_FORMAT = '<4sI'
+RECORD_FORMAT = '<IHBBi'
+RECORD_SIZE = 12
+ERASED = 0xff
+
+# events, value is 0 unless noted
+BOOT = 1
+SENSORS = 2  # the sensors changed, sample is the new sample
+DELIVERED = 3  # the detector triggered
+RESET = 4  # the mail delivery status was reset
+TIME_SYNCED = 5  # value is how far (seconds) the clock was off, records before it may be off by that much
+CRASHED = 6
+EVENT_NAMES = {BOOT: 'boot', SENSORS: 'sensors', DELIVERED: 'delivered', RESET: 'reset', TIME_SYNCED: 'time_synced',
+               CRASHED: 'crashed'}
+
+
+class Journal:
+    def __init__(self, file_prefix: str = 'journal', segments: int = 4, segment_records: int = 341,
+                 buffer_records: int = 32):
+        """
+        :param file_prefix: segment i is <file_prefix><i>.bin
+        :param segments: how many segment files to rotate through
+        :param segment_records: slots per segment, including the header
+        :param buffer_records: records collected in RAM before they have to be written
+        """
+        if segments < 1:
+            raise ValueError(f"Journal needs at least 1 segment, got {segments}")
+        if segment_records < 2:
+            raise ValueError(f"Journal needs at least 2 records per segment, got {segment_records}")
+        if buffer_records < 1:
+            raise ValueError(f"Journal needs a buffer of at least 1 record, got {buffer_records}")
+        self.file_prefix = file_prefix
+        self.segments = segments
+        self.segment_records = segment_records
+        self._buffer = bytearray(buffer_records * RECORD_SIZE)
+        self._buffered = 0
+        self._segment = 0  # the segment being written
+        self._sequence = 0  # its sequence number, 0 before open()
+        self._position = 1  # its first free slot
+        # counters
+        self.records = 0
+        self.writes = 0
+        self.rotations = 0
+        self.lost = 0  # records which could not be written
+
+    def file_name(self, segment: int) -> str:
+        return f"{self.file_prefix}{segment}.bin"
+
+    def _erase(self, segment: int, sequence: int) -> None:
+        """
+        (Re)allocate a segment, empty apart from its header.
+        """
+        slot = bytearray(RECORD_SIZE)
+        with open(self.file_name(segment), 'wb') as file:
+            struct.pack_into(HEADER_FORMAT, slot, 0, MAGIC, sequence)
+            for index in range(struct.calcsize(HEADER_FORMAT), RECORD_SIZE):
+                slot[index] = ERASED
+            file.write(slot)
+            for index in range(RECORD_SIZE):
+                slot[index] = ERASED
+            for _ in range(self.segment_records - 1):
+                file.write(slot)
+
+    def _read_sequence(self, segment: int) -> int:
+        """
+        :return: the sequence number of a segment, 0 if it is missing, the wrong size or corrupt
+        """
+        try:
+            with open(self.file_name(segment), 'rb') as file:
+                header = file.read(RECORD_SIZE)
+                if file.seek(0, 2) != self.segment_records * RECORD_SIZE:
+                    return 0
+        except OSError:
+            return 0
+        if len(header) < RECORD_SIZE or header[:len(MAGIC)] != MAGIC:
+            return 0
+        return struct.unpack_from(HEADER_FORMAT, header)[1]
+
+    def open(self) -> None:
+        """
+        Carry on where the journal left off before the reboot, preallocating any missing segments.
+        """
+        sequences = [self._read_sequence(segment) for segment in range(self.segments)]
+        newest = 0
+        for segment in range(self.segments):
+            if sequences[segment] > sequences[newest]:
+                newest = segment
+        for segment in range(self.segments):
+            if sequences[segment] == 0 and segment != newest:
+                # unused until the rotation gets there, allocated now so the flash is there when it does
+                self._erase(segment, 0)
+        if sequences[newest] == 0:
+            self._segment = newest
+            self._sequence = 1
+            self._erase(newest, self._sequence)
+            self._position = 1
+            return
+        self._segment = newest
+        self._sequence = sequences[newest]
+        # the first slot which has never been written, a record with its event erased was cut short
+        slot = bytearray(RECORD_SIZE)
+        self._position = self.segment_records
+        with open(self.file_name(newest), 'rb') as file:
+            file.seek(RECORD_SIZE)
+            for position in range(1, self.segment_records):
+                if file.readinto(slot) < RECORD_SIZE or slot[6] == ERASED:
+                    self._position = position
+                    break
+
+    def _rotate(self) -> None:
+        self._segment = (self._segment + 1) % self.segments
+        self._sequence += 1
+        self._erase(self._segment, self._sequence)
+        self._position = 1
+        self.rotations += 1
+
+    def record(self, event: int, sample: int = 0, value: int = 0, flush: bool = False) -> None:
+        """
+        Add a record, written to flash right away with flush (or when the buffer is full).
+        """
+        seconds, milliseconds = divmod(time.time_ns() // 1000000, 1000)
+        struct.pack_into(RECORD_FORMAT, self._buffer, self._buffered * RECORD_SIZE, seconds, milliseconds, event,
+                         sample, value)
+        self._buffered += 1
+        self.records += 1
+        if flush or self._buffered * RECORD_SIZE == len(self._buffer):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered records, as few writes as the segment boundaries allow.
+        """
+        if not self._buffered:
+            return
+        if not self._sequence:
+            # not opened (yet)
+            self.lost += self._buffered
+            self._buffered = 0
+            return
+        written = 0
+        buffer = memoryview(self._buffer)
+        try:
+            while written < self._buffered:
+                if self._position == self.segment_records:
+                    self._rotate()
+                count = min(self._buffered - written, self.segment_records - self._position)
+                with open(self.file_name(self._segment), 'r+b') as file:
+                    file.seek(self._position * RECORD_SIZE)
+                    file.write(buffer[written * RECORD_SIZE:(written + count) * RECORD_SIZE])
+                self._position += count
+                written += count
+                self.writes += 1
+        except OSError:
+            # flash full or gone, better to lose the history than to stop looking for mail
+            self.lost += self._buffered - written
+        self._buffered = 0
+
+    def stats(self) -> dict:
+        return {
+            "journal_records": self.records,
+            "journal_writes": self.writes,
+            "journal_rotations": self.rotations,
+            "journal_lost": self.lost,
+        }
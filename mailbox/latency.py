@@ -0,0 +1,144 @@
+"""
+Delivery latency tracing.
+Timestamps (ticks_us) every stage a delivery goes through, from the first sample with
+a delivery sensor active up to Home Assistant acknowledging the new state:
+
+    first_sample -> triggered -> enqueued -> ntfy_sent -> ntfy_acknowledged -> ha_sent -> ha_acknowledged
+
+The time between first_sample and triggered is what the detector thresholds cost, the
+rest is queueing and the network. Stages are reported in ms since the first sample.
+Finished traces go into a small ring of total latencies, which the histogram is built from.
+"""
+import time
+from array import array
+
+FIRST_SAMPLE = 0
+TRIGGERED = 1
+ENQUEUED = 2
+NTFY_SENT = 3
+NTFY_ACKNOWLEDGED = 4
+HA_SENT = 5
+HA_ACKNOWLEDGED = 6
+STAGE_NAMES = ('first_sample', 'triggered', 'enqueued', 'ntfy_sent', 'ntfy_acknowledged', 'ha_sent',
+               'ha_acknowledged')
+
+# upper bounds (ms) of the histogram buckets, the last bucket takes everything slower than that
+HISTOGRAM_BOUNDS_MS = (1000, 2000, 5000, 10000, 30000, 60000, 300000)
+
+# ticks_us() wraps after about 18 minutes and ticks_diff() is only good for half of that,
+# stages further apart than this (a delivery stuck in the outbox) are timed with ticks_ms()
+_MAX_US_SPAN_MS = 5 * 60 * 1000
+
+
+class LatencyTracer:
+    def __init__(self, history_size: int = 32):
+        """
+        :param history_size: how many finished traces the histogram covers
+        """
+        if history_size < 1:
+            raise ValueError(f"LatencyTracer needs a history size of at least 1, got {history_size}")
+        self._stamps_us = array('l', [0] * len(STAGE_NAMES))
+        self._stamps_ms = array('l', [0] * len(STAGE_NAMES))
+        self._marked = 0  # one bit per stage
+        self._history = array('l', [0] * history_size)  # total latencies (ms) of the last finished traces
+        self._history_next = 0
+        self._history_count = 0
+        self.last = {}  # breakdown of the last finished trace
+        # counters
+        self.traces = 0
+        self.abandoned = 0
+
+    @property
+    def active(self) -> bool:
+        return bool(self._marked & (1 << FIRST_SAMPLE))
+
+    def _stamp(self, stage: int, at_us: int, at_ms: int) -> None:
+        self._stamps_us[stage] = at_us
+        self._stamps_ms[stage] = at_ms
+        self._marked |= 1 << stage
+
+    def start(self, at_us: int = None) -> None:
+        """
+        Start a new trace (dropping the one in progress, if any).
+        :param at_us: ticks_us() of the first sample (or sensor edge), default now
+        """
+        now_us = time.ticks_us()
+        now_ms = time.ticks_ms()
+        if at_us is None:
+            at_us = now_us
+        self._marked = 0
+        self._stamp(FIRST_SAMPLE, at_us, time.ticks_add(now_ms, -(time.ticks_diff(now_us, at_us) // 1000)))
+
+    def mark(self, stage: int) -> None:
+        """
+        Timestamp a stage of the trace in progress, only the first time it is reached counts.
+        """
+        if self._marked & (1 << FIRST_SAMPLE) and not self._marked & (1 << stage):
+            self._stamp(stage, time.ticks_us(), time.ticks_ms())
+
+    def abandon(self) -> None:
+        """
+        Drop the trace in progress, it didn't turn out to be a delivery.
+        """
+        if self.active:
+            self.abandoned += 1
+            self._marked = 0
+
+    def elapsed_ms(self, stage: int) -> float:
+        """
+        :return: ms from the first sample to the stage (which has to be marked)
+        """
+        elapsed_ms = time.ticks_diff(self._stamps_ms[stage], self._stamps_ms[FIRST_SAMPLE])
+        if elapsed_ms > _MAX_US_SPAN_MS:
+            return elapsed_ms
+        return time.ticks_diff(self._stamps_us[stage], self._stamps_us[FIRST_SAMPLE]) / 1000
+
+    def breakdown(self) -> dict:
+        """
+        :return: latency_<stage>_ms for every stage the trace in progress has reached so far
+        """
+        breakdown = {}
+        for stage in range(TRIGGERED, len(STAGE_NAMES)):
+            if self._marked & (1 << stage):
+                breakdown[f"latency_{STAGE_NAMES[stage]}_ms"] = round(self.elapsed_ms(stage), 1)
+        return breakdown
+
+    def finish(self) -> dict:
+        """
+        Close the trace in progress (once Home Assistant acknowledged it) and add it to the histogram.
+        :return: its breakdown, None if there was nothing to finish
+        """
+        if not self.active or not self._marked & (1 << HA_ACKNOWLEDGED):
+            return None
+        self._history[self._history_next] = int(self.elapsed_ms(HA_ACKNOWLEDGED))
+        self._history_next = (self._history_next + 1) % len(self._history)
+        if self._history_count < len(self._history):
+            self._history_count += 1
+        self.last = self.breakdown()
+        self.traces += 1
+        self._marked = 0
+        return self.last
+
+    def histogram(self) -> list:
+        """
+        :return: number of the last (up to history_size) deliveries per bucket of HISTOGRAM_BOUNDS_MS,
+            plus one for everything slower
+        """
+        counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        for index in range(self._history_count):
+            total = self._history[index]
+            bucket = 0
+            while bucket < len(HISTOGRAM_BOUNDS_MS) and total > HISTOGRAM_BOUNDS_MS[bucket]:
+                bucket += 1
+            counts[bucket] += 1
+        return counts
+
+    def attributes(self) -> dict:
+        """
+        :return: the breakdown of the trace in progress (or else the last finished one) and the histogram
+        """
+        attributes = self.breakdown() if self.active else dict(self.last)
+        attributes["latency_histogram"] = self.histogram()
+        attributes["latency_histogram_bounds_ms"] = list(HISTOGRAM_BOUNDS_MS)
+        attributes["latency_traces"] = self.traces
+        return attributes
@@ -0,0 +1,141 @@
+"""
+Leveled logging which costs (next to) nothing when a level is switched off.
+Messages are only formatted once we know somebody wants them, so pass the values as
+arguments instead of using f-strings:
+
+    log.debug("Waiting for connection (%s/%s)...", attempts, max_attempts)
+
+Enabled records are printed (up to print_level) and/or kept in a fixed size ring buffer
+in RAM (up to ring_level), which can be dumped over USB serial or flushed to flash when
+something goes wrong. Lower levels are more important, a record is handled when its
+level is <= the configured level (same as the old debug_print and verbose_level).
+"""
+import time
+from array import array
+
+ALWAYS = -1
+INFO = 0
+DEBUG = 1
+
+_NO_ARGUMENT = object()
+
+print_level = 5
+ring_level = -2  # nothing goes to the ring until configure() is called
+_threshold = print_level
+_ring_messages = []
+_ring_ticks = array('L')
+_ring_levels = bytearray()
+_ring_next = 0
+_ring_count = 0
+dropped = 0  # records pushed out of the ring before anyone dumped them
+
+
+def configure(print_level_: int = 5, ring_level_: int = DEBUG, ring_size: int = 64) -> None:
+    global print_level, ring_level, _threshold, _ring_messages, _ring_ticks, _ring_levels, _ring_next, _ring_count
+    print_level = print_level_
+    ring_level = ring_level_
+    _threshold = max(print_level, ring_level)
+    _ring_messages = [None] * ring_size
+    _ring_ticks = array('L', [0] * ring_size)
+    _ring_levels = bytearray(ring_size)
+    _ring_next = 0
+    _ring_count = 0
+
+
+def enabled(level: int) -> bool:
+    """
+    For the rare case where building the arguments themselves is expensive.
+    """
+    return level <= _threshold
+
+
+def _emit(level: int, message, a, b, c) -> None:
+    global _ring_next, _ring_count, dropped
+    if a is not _NO_ARGUMENT:
+        if b is _NO_ARGUMENT:
+            message = message % (a,)
+        elif c is _NO_ARGUMENT:
+            message = message % (a, b)
+        else:
+            message = message % (a, b, c)
+    if level <= print_level:
+        print(message)
+    if level <= ring_level and _ring_messages:
+        if _ring_count == len(_ring_messages):
+            dropped += 1
+        else:
+            _ring_count += 1
+        _ring_messages[_ring_next] = message
+        _ring_ticks[_ring_next] = time.ticks_ms()
+        _ring_levels[_ring_next] = level + 1
+        _ring_next += 1
+        if _ring_next == len(_ring_messages):
+            _ring_next = 0
+
+
+def log(level: int, message, a=_NO_ARGUMENT, b=_NO_ARGUMENT, c=_NO_ARGUMENT) -> None:
+    if level <= _threshold:
+        _emit(level, message, a, b, c)
+
+
+def always(message, a=_NO_ARGUMENT, b=_NO_ARGUMENT, c=_NO_ARGUMENT) -> None:
+    if ALWAYS <= _threshold:
+        _emit(ALWAYS, message, a, b, c)
+
+
+def info(message, a=_NO_ARGUMENT, b=_NO_ARGUMENT, c=_NO_ARGUMENT) -> None:
+    if INFO <= _threshold:
+        _emit(INFO, message, a, b, c)
+
+
+def debug(message, a=_NO_ARGUMENT, b=_NO_ARGUMENT, c=_NO_ARGUMENT) -> None:
+    if DEBUG <= _threshold:
+        _emit(DEBUG, message, a, b, c)
+
+
+def records():
+    """
+    Iterate over the records in the ring, oldest first, as (ticks_ms, level, message).
+    """
+    size = len(_ring_messages)
+    index = _ring_next - _ring_count
+    if index < 0:
+        index += size
+    for _ in range(_ring_count):
+        yield _ring_ticks[index], _ring_levels[index] - 1, _ring_messages[index]
+        index += 1
+        if index == size:
+            index = 0
+
+
+def dump() -> None:
+    """
+    Print the whole ring (e.g. from the REPL over USB serial: import log; log.dump()).
+    """
+    if dropped:
+        print(f"({dropped} older records dropped)")
+    for ticks, level, message in records():
+        print(f"[{ticks}] {level}: {message}")
+
+
+def flush(file_name: str = 'log.txt', max_file_size: int = 16 * 1024) -> None:
+    """
+    Append the ring to a file on flash and empty the ring. The file is started over
+    once it grows past max_file_size, so it can't fill up the flash.
+    """
+    global _ring_count, dropped
+    try:
+        import os
+        mode = 'w' if os.stat(file_name)[6] > max_file_size else 'a'
+    except OSError:
+        mode = 'w'
+    try:
+        with open(file_name, mode) as file:
+            if dropped:
+                file.write(f"({dropped} older records dropped)\n")
+            for ticks, level, message in records():
+                file.write(f"[{ticks}] {level}: {message}\n")
+    except OSError:
+        return
+    _ring_count = 0
+    dropped = 0
@@ -0,0 +1,27 @@
+# Freezes the firmware into a MicroPython build for the Pico W, from a micropython checkout:
+#   make -C ports/rp2 BOARD=RPI_PICO_W FROZEN_MANIFEST=/path/to/mailbox/manifest.py
+# main.py and settings.yaml still go on the filesystem, main.py imports the frozen app.
+include("$(BOARD_DIR)/manifest.py")
+
+module("startup.py", opt=3)
+module("app.py", opt=3)
+module("config.py", opt=3)
+module("log.py", opt=3)
+module("detector.py", opt=3)
+module("samples.py", opt=3)
+module("edges.py", opt=3)
+module("hardware.py", opt=3)
+module("http_client.py", opt=3)
+module("mqtt.py", opt=3)
+module("outbox.py", opt=3)
+module("power.py", opt=3)
+module("wifi.py", opt=3)
+module("timesync.py", opt=3)
+module("latency.py", opt=3)
+module("journal.py", opt=3)
+module("heap.py", opt=3)
+module("indicator.py", opt=3)
+module("sampleclock.py", opt=3)
+module("dualcore.py", opt=3)
+module("hastate.py", opt=3)
+module("statusserver.py", opt=3)
@@ -13,7 +13,8 @@ class Pin:
     IN = "input-pin"
     PULL_UP = "pull-up"
     PULL_DOWN = "pull-down"
-    IRQ_FALLING = "irq-falling"
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
 
     def __init__(
             self,
@@ -59,5 +60,6 @@ class Pin:
             print(f"{self.id} was high (OUT) (will toggle to low)")
             self.low()
 
-    def irq(self, trigger=None, handler=None, wake=None):  # noqa
-        print(f"IRQ trigger: {trigger}, handler: {handler}, wake: {wake}")
+    def irq(self, handler=None, trigger=None, wake=None, hard=False):  # noqa
+        print(f"IRQ trigger: {trigger}, handler: {handler}, wake: {wake}, hard: {hard}")
+        self.handler = handler
@@ -0,0 +1,213 @@
+"""
+Small MQTT 3.1.1 publisher (on top of uasyncio streams) with Home Assistant discovery.
+One connection is kept open for as long as possible (kept alive with PINGREQ), the
+session is persistent (clean session off) and the mailbox state is published as tiny
+retained messages, so an update is a couple of dozen bytes instead of a full HTTP request.
+"""
+import time
+import ujson
+import uasyncio as asyncio
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+
+
+class MQTTException(OSError):
+    pass
+
+
+def _encode_string(value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return len(value).to_bytes(2, 'big') + value
+
+
+def _encode_remaining_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        if length:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def packet(packet_type: int, body: bytes) -> bytes:
+    return bytes((packet_type,)) + _encode_remaining_length(len(body)) + body
+
+
+class MQTTPublisher:
+    def __init__(self,
+                 broker: str,
+                 client_id: str,
+                 port: int = 1883,
+                 user: str = None,
+                 password: str = None,
+                 keepalive_seconds: int = 60,
+                 topic_prefix: str = 'mailbox',
+                 discovery_prefix: str = 'homeassistant',
+                 timeout: float = 10):
+        self.broker = broker
+        self.port = port
+        self.client_id = client_id
+        self.user = user
+        self.password = password
+        self.keepalive_seconds = keepalive_seconds
+        self.timeout = timeout
+        self.discovery_prefix = discovery_prefix
+        self.state_topic = f"{topic_prefix}/{client_id}/state"
+        self.attributes_topic = f"{topic_prefix}/{client_id}/attributes"
+        self.availability_topic = f"{topic_prefix}/{client_id}/availability"
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+        self._packet_id = 0
+        self._last_sent = 0
+        self._discovery_sent = False
+        # counters
+        self.connects = 0
+        self.bytes_sent = 0
+
+    def is_connected(self) -> bool:
+        return self._writer is not None
+
+    async def _write(self, data: bytes) -> None:
+        self._writer.write(data)
+        await self._writer.drain()
+        self.bytes_sent += len(data)
+        self._last_sent = time.ticks_ms()
+
+    async def _read_packet(self) -> tuple:
+        """
+        :return: (packet type, body)
+        """
+        try:
+            header = await self._reader.readexactly(1)
+            length = 0
+            shift = 0
+            while True:
+                byte = (await self._reader.readexactly(1))[0]
+                length |= (byte & 0x7F) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+                if shift > 21:
+                    raise MQTTException("Malformed remaining length from the broker")
+            body = await self._reader.readexactly(length) if length else b''
+        except EOFError:
+            # the broker closed the connection (IncompleteReadError on CPython is an EOFError too)
+            raise MQTTException("Connection closed by the broker")
+        return header[0] & 0xF0, body
+
+    async def _wait_for(self, packet_type: int) -> bytes:
+        while True:
+            received_type, body = await asyncio.wait_for(self._read_packet(), self.timeout)
+            if received_type == packet_type:
+                return body
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.broker, self.port), self.timeout)
+        # clean session off (persistent session), will: availability offline (retained, QoS 1)
+        flags = 0x04 | 0x08 | 0x20
+        payload = _encode_string(self.client_id)
+        payload += _encode_string(self.availability_topic) + _encode_string(b'offline')
+        if self.user:
+            flags |= 0x80
+            payload += _encode_string(self.user)
+            if self.password:
+                flags |= 0x40
+                payload += _encode_string(self.password)
+        body = _encode_string(b'MQTT') + bytes((4, flags)) + self.keepalive_seconds.to_bytes(2, 'big') + payload
+        await self._write(packet(CONNECT, body))
+        connack = await self._wait_for(CONNACK)
+        if len(connack) < 2:
+            raise MQTTException("Malformed CONNACK from the broker")
+        if connack[1] != 0:
+            raise MQTTException(f"Broker refused the connection (return code {connack[1]})")
+        self.connects += 1
+        await self._publish(self.availability_topic, b'online', retain=True)
+        if not self._discovery_sent:
+            await self._publish(f"{self.discovery_prefix}/binary_sensor/{self.client_id}/config",
+                                ujson.dumps(self.discovery_config()), retain=True, qos=1)
+            self._discovery_sent = True
+
+    def discovery_config(self) -> dict:
+        return {
+            "name": "Smart Mailbox",
+            "unique_id": self.client_id,
+            "state_topic": self.state_topic,
+            "json_attributes_topic": self.attributes_topic,
+            "availability_topic": self.availability_topic,
+            "payload_on": "1",
+            "payload_off": "0",
+            "device": {"identifiers": [self.client_id], "name": "Smart Mailbox"}
+        }
+
+    async def _publish(self, topic: str, payload, retain: bool = False, qos: int = 0) -> None:
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        body = _encode_string(topic)
+        if qos:
+            self._packet_id = self._packet_id % 0xFFFF + 1
+            body += self._packet_id.to_bytes(2, 'big')
+        await self._write(packet(PUBLISH | (qos << 1) | (1 if retain else 0), body + payload))
+        if qos:
+            while True:
+                puback = await self._wait_for(PUBACK)
+                if int.from_bytes(puback[:2], 'big') == self._packet_id:
+                    return
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            try:
+                self._writer.close()
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._reader = None
+        self._writer = None
+
+    async def publish(self, topic: str, payload, retain: bool = False, qos: int = 0) -> None:
+        """
+        Publish, (re)connecting first if needed. Raises OSError if the broker can't be reached.
+        """
+        async with self._lock:
+            try:
+                if not self.is_connected():
+                    await self._connect()
+                await self._publish(topic, payload, retain=retain, qos=qos)
+            except (OSError, asyncio.TimeoutError):
+                await self.close()
+                raise
+
+    async def publish_state(self, mail_has_been_delivered: bool, attributes: dict = None) -> None:
+        if attributes is not None:
+            await self.publish(self.attributes_topic, ujson.dumps(attributes), retain=True)
+        await self.publish(self.state_topic, b'1' if mail_has_been_delivered else b'0', retain=True, qos=1)
+
+    async def keepalive_task(self) -> None:
+        """
+        Sends a PINGREQ whenever nothing else has been sent for half the keepalive period,
+        so the broker never drops the connection (and the session) for being idle.
+        Also brings the connection back up if it has been lost.
+        """
+        half_period_ms = self.keepalive_seconds * 500
+        while True:
+            await asyncio.sleep(self.keepalive_seconds / 4)
+            async with self._lock:
+                try:
+                    if not self.is_connected():
+                        await self._connect()
+                    elif time.ticks_diff(time.ticks_ms(), self._last_sent) >= half_period_ms:
+                        await self._write(packet(PINGREQ, b''))
+                        await self._wait_for(PINGRESP)
+                except (OSError, asyncio.TimeoutError):
+                    # try again next round
+                    await self.close()
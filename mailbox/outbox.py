@@ -0,0 +1,84 @@
+"""
+Bounded telemetry outbox which survives reboots.
+Every queued message is written to flash right away, so a flaky access point (or a
+reboot) can delay a notification but not lose it. Only the newest Home Assistant state
+is worth sending, so queueing a new one replaces any Home Assistant state still waiting.
+If flash can't be written (full, failing) the entries are still kept (and sent) from RAM.
+"""
+import os
+import ujson
+import log
+
+TARGET_NTFY = 0
+TARGET_HOME_ASSISTANT = 1
+
+
+class Outbox:
+    def __init__(self, file_name: str = 'outbox.json', capacity: int = 8):
+        self.file_name = file_name
+        self.capacity = capacity
+        self.entries = []
+        self.dropped = 0
+        self.save_failures = 0
+        self.acknowledged = 0  # entries delivered since boot, doubles as the sequence number of the oldest one
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def load(self) -> None:
+        try:
+            with open(self.file_name, 'r') as file:
+                self.entries = [tuple(entry) for entry in ujson.load(file)][-self.capacity:]
+        except (OSError, ValueError):
+            # no outbox yet (or a corrupt one, which we can't do much about)
+            self.entries = []
+
+    def _save(self) -> None:
+        temp_file_name = self.file_name + '.tmp'
+        try:
+            with open(temp_file_name, 'w') as file:
+                ujson.dump(self.entries, file)
+            os.rename(temp_file_name, self.file_name)
+        except OSError as e:
+            # a reboot would lose what is queued, but detection and sending carry on
+            self.save_failures += 1
+            log.info("Could not save the outbox: %s", e)
+
+    def put(self, target: int, mail_has_been_delivered: bool, message: str = None) -> None:
+        entry = (target, mail_has_been_delivered, message)
+        if target == TARGET_HOME_ASSISTANT:
+            # coalesce, keep the one being sent right now (if any) so that it can be acknowledged
+            self.entries = [self.entries[i] for i in range(len(self.entries))
+                            if i == 0 or self.entries[i][0] != TARGET_HOME_ASSISTANT]
+        else:
+            # the same message twice in a row is sent once, anything in between (a reset between
+            # two deliveries) keeps them apart; the head may be on its way already, it doesn't count
+            for i in range(len(self.entries) - 1, 0, -1):
+                if self.entries[i][0] == target:
+                    if self.entries[i] == entry:
+                        return
+                    break
+        self.entries.append(entry)
+        while len(self.entries) > self.capacity:
+            # the oldest one after the head, which may be being sent right now and has the
+            # sequence number (acknowledged) the gateway will see for it
+            self.entries.pop(1)
+            self.dropped += 1
+        self._save()
+
+    def peek(self) -> tuple:
+        """
+        :return: the oldest entry as (target, mail_has_been_delivered, message) or None
+        """
+        if self.entries:
+            return self.entries[0]
+        return None
+
+    def acknowledge(self, entry: tuple) -> None:
+        """
+        Remove an entry (returned by peek()) once it has been delivered.
+        """
+        if self.entries and self.entries[0] is entry:
+            self.entries.pop(0)
+            self.acknowledged += 1
+            self._save()
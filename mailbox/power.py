@@ -0,0 +1,119 @@
+"""
+Duty cycling and the energy budget.
+Between samples the CPU is put in lightsleep (instead of spinning in the event loop) for as
+long as nothing needs it to stay awake: anything timing sensitive (flashing LEDs, talking to
+the network) holds it awake with hold() / release(). The wake source pin and the sensor edge
+IRQs (sensor_capture_mode: irq) wake it up early.
+The counters add up where the time (and so the battery) goes: awake, asleep, radio on.
+They are accumulated a step at a time rather than diffed against the boot tick, since
+ticks_ms() wraps around after a few days and the mailbox is meant to run for weeks.
+"""
+import time
+from machine import lightsleep
+
+
+class PowerManager:
+    def __init__(self, min_sleep_ms: int = 10):
+        """
+        :param min_sleep_ms: shorter sleeps aren't worth going into lightsleep for
+        """
+        self.min_sleep_ms = min_sleep_ms
+        self._holds = 0
+        self._woken_by_pin = False
+        self._last_tick = time.ticks_ms()
+        self._radio_on = False
+        # energy budget
+        self.uptime_ms = 0
+        self.sleep_ms = 0
+        self.radio_on_ms = 0
+        self.wake_ups = 0
+        self.pin_wake_ups = 0
+        self.radio_switch_ons = 0
+
+    def hold(self) -> None:
+        """
+        Keep the CPU awake until the matching release().
+        """
+        self._holds += 1
+
+    def release(self) -> None:
+        if self._holds > 0:
+            self._holds -= 1
+
+    def can_sleep(self, duration_ms: int) -> bool:
+        return self._holds == 0 and duration_ms >= self.min_sleep_ms
+
+    def on_wake_pin(self, pin) -> None:
+        """
+        IRQ handler for the wake source pin (doesn't allocate, safe as a hard IRQ).
+        """
+        self._woken_by_pin = True
+
+    def update(self) -> None:
+        """
+        Add the time since the last update to the counters. Has to be called more often than
+        ticks_ms() wraps (every few days), sleep(), the radio switches and budget() do it already.
+        """
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, self._last_tick)
+        self._last_tick = now
+        self.uptime_ms += elapsed
+        if self._radio_on:
+            self.radio_on_ms += elapsed
+
+    def sleep(self, duration_ms: int = None) -> int:
+        """
+        Lightsleep for duration_ms, or until an interrupt if duration_ms is None.
+        Any enabled pin IRQ ends the sleep early.
+        :return: how long we actually slept (ms)
+        """
+        self._woken_by_pin = False
+        self.update()
+        went_to_sleep_at = self._last_tick
+        if duration_ms is None:
+            lightsleep()
+        else:
+            lightsleep(duration_ms)
+        self.update()
+        slept = time.ticks_diff(self._last_tick, went_to_sleep_at)
+        self.sleep_ms += slept
+        self.wake_ups += 1
+        if self._woken_by_pin:
+            self.pin_wake_ups += 1
+        return slept
+
+    @property
+    def woken_by_pin(self) -> bool:
+        """
+        Whether the wake source pin ended the last sleep.
+        """
+        return self._woken_by_pin
+
+    def radio_switched_on(self) -> None:
+        if not self._radio_on:
+            self.update()
+            self._radio_on = True
+            self.radio_switch_ons += 1
+
+    def radio_switched_off(self) -> None:
+        if self._radio_on:
+            self.update()
+            self._radio_on = False
+
+    def is_radio_on(self) -> bool:
+        return self._radio_on
+
+    def budget(self) -> dict:
+        """
+        :return: where the time went since boot (ms), and how often we woke up or switched the radio on
+        """
+        self.update()
+        return {
+            "uptime_ms": self.uptime_ms,
+            "awake_ms": self.uptime_ms - self.sleep_ms,
+            "sleep_ms": self.sleep_ms,
+            "radio_on_ms": self.radio_on_ms,
+            "wake_ups": self.wake_ups,
+            "pin_wake_ups": self.pin_wake_ups,
+            "radio_switch_ons": self.radio_switch_ons
+        }
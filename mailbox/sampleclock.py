@@ -0,0 +1,122 @@
+"""
+Fixed rate sampling.
+With sampling_clock: loop the sampler task takes a sample, does everything that comes
+with it and then sleeps until the next one is due, so a sample can be late by however
+long the rest of the firmware kept the CPU (a TLS handshake, a WiFi scan, a garbage
+collection). With sampling_clock: timer a machine.Timer reads the sensors at a fixed rate
+into a preallocated ring from interrupt context, whatever else is going on, and the
+sampler task processes what is in the ring behind it. consecutive_*_needed_to_trigger
+then always means the same stretch of time.
+
+Either way every sample is timed against the slot it was due in: how late it was
+(jitter, a running average and the maximum) and how often the sampler fell so far
+behind that samples were skipped or lost (overruns).
+"""
+import time
+from array import array
+from machine import Timer, disable_irq, enable_irq
+import uasyncio as asyncio
+
+# the running average moves 1/16th of the way to every new value, sums would outgrow small ints in interrupt context
+_AVERAGE_SHIFT = 4
+
+
+class SampleClock:
+    def __init__(self, period_ms: int, capacity: int = 32):
+        """
+        :param period_ms: time between two samples
+        :param capacity: samples the timer can take before the sampler task has to catch up
+        """
+        if period_ms < 1:
+            raise ValueError(f"SampleClock needs a period of at least 1 ms, got {period_ms}")
+        if capacity < 1:
+            raise ValueError(f"SampleClock needs a capacity of at least 1, got {capacity}")
+        self.period_ms = period_ms
+        self.capacity = capacity
+        self._samples = bytearray(capacity)
+        self._sampled_us = array('L', [0] * capacity)
+        self._first = 0
+        self._count = 0
+        self._read_sample = None
+        self._due_us = 0
+        self._timer = None
+        self.ready = asyncio.ThreadSafeFlag()
+        self.sample_us = 0  # ticks_us the sample pop() returned last was taken at
+        # stats
+        self.ticks = 0
+        self.jitter_average_us = 0
+        self.jitter_max_us = 0
+        self.overruns = 0
+
+    def note(self, late_us: int) -> None:
+        """
+        Count a sample, taken late_us after it was due.
+        """
+        self.ticks += 1
+        if late_us < 0:
+            late_us = -late_us
+        self.jitter_average_us += (late_us - self.jitter_average_us) >> _AVERAGE_SHIFT
+        if late_us > self.jitter_max_us:
+            self.jitter_max_us = late_us
+
+    def start(self, read_sample) -> None:
+        """
+        Start sampling on the timer.
+        :param read_sample: returns the packed sample, called in interrupt context so it must not allocate
+        """
+        self._read_sample = read_sample
+        self._due_us = time.ticks_add(time.ticks_us(), self.period_ms * 1000)
+        self._timer = Timer(mode=Timer.PERIODIC, period=self.period_ms, callback=self._tick)
+
+    def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.deinit()
+            self._timer = None
+
+    def _tick(self, timer) -> None:
+        # runs in interrupt context, must not allocate
+        now = time.ticks_us()
+        sample = self._read_sample()
+        self.note(time.ticks_diff(now, self._due_us))
+        self._due_us = time.ticks_add(self._due_us, self.period_ms * 1000)
+        if self._count == self.capacity:
+            # the sampler task is too far behind, the oldest sample goes
+            self.overruns += 1
+            self._first += 1
+            if self._first == self.capacity:
+                self._first = 0
+            self._count -= 1
+        index = self._first + self._count
+        if index >= self.capacity:
+            index -= self.capacity
+        self._samples[index] = sample
+        self._sampled_us[index] = now
+        self._count += 1
+        self.ready.set()
+
+    def pending(self) -> int:
+        return self._count
+
+    def pop(self) -> int:
+        """
+        Take the oldest sample out of the ring (which must not be empty).
+        :return: the sample, the time it was taken at is left in sample_us
+        """
+        state = disable_irq()
+        index = self._first
+        sample = self._samples[index]
+        self.sample_us = self._sampled_us[index]
+        self._first += 1
+        if self._first == self.capacity:
+            self._first = 0
+        self._count -= 1
+        enable_irq(state)
+        return sample
+
+    def stats(self) -> dict:
+        return {
+            "sample_jitter_avg_us": self.jitter_average_us,
+            "sample_jitter_max_us": self.jitter_max_us,
+            "sample_overruns": self.overruns,
+            "samples_taken": self.ticks,
+        }
@@ -0,0 +1,88 @@
+"""
+Compact sample history.
+One sample is a single byte where every sensor gets one bit, which means a window of
+thousands of samples fits in the RAM a handful of the old sample dicts used to take.
+"""
+
+# sensor bits in a packed sample
+LID_OPEN = 0x01
+BOTTOM_SENSOR_ACTIVE = 0x02
+TILT_SENSOR_ACTIVE = 0x04
+RESET_SENSOR_ACTIVE = 0x08
+
+
+def pack_sample(lid_open: bool, bottom_sensor_active: bool, tilt_sensor_active: bool,
+                reset_sensor_active: bool) -> int:
+    sample = 0
+    if lid_open:
+        sample |= LID_OPEN
+    if bottom_sensor_active:
+        sample |= BOTTOM_SENSOR_ACTIVE
+    if tilt_sensor_active:
+        sample |= TILT_SENSOR_ACTIVE
+    if reset_sensor_active:
+        sample |= RESET_SENSOR_ACTIVE
+    return sample
+
+
+class SampleRing:
+    """
+    Fixed size ring buffer of packed samples.
+    All memory is allocated up front, appending never allocates and the oldest sample
+    is silently overwritten once the ring is full.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError(f"SampleRing needs a capacity of at least 1, got {capacity}")
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._next = 0  # index the next sample will be written to
+        self._count = 0
+        self.total = 0  # samples appended since start, lets consumers tell how many are new
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, sample: int) -> None:
+        self._buffer[self._next] = sample
+        self._next += 1
+        if self._next == self.capacity:
+            self._next = 0
+        if self._count < self.capacity:
+            self._count += 1
+        self.total += 1
+
+    def clear(self) -> None:
+        self._next = 0
+        self._count = 0
+
+    def last(self, n: int = 1) -> int:
+        """
+        :param n: 1 is the newest sample, 2 the one before that and so on
+        :return: the packed sample
+        """
+        if n < 1 or n > self._count:
+            raise IndexError(f"Only {self._count} samples available, asked for sample -{n}")
+        index = self._next - n
+        if index < 0:
+            index += self.capacity
+        return self._buffer[index]
+
+    def iter_last(self, n: int):
+        """
+        Iterate over the n newest samples, oldest first.
+        """
+        if n > self._count:
+            n = self._count
+        index = self._next - n
+        if index < 0:
+            index += self.capacity
+        for _ in range(n):
+            yield self._buffer[index]
+            index += 1
+            if index == self.capacity:
+                index = 0
+
+    def __iter__(self):
+        return self.iter_last(self._count)
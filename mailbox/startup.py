@@ -0,0 +1,62 @@
+"""
+Boot profile.
+The mailbox is blind from the moment it resets until the first sample, so every phase of
+the startup gets a timestamp (ticks_us, which starts counting at reset) and the whole
+thing is logged as a profile once the first sample is in:
+
+    Boot profile (ms since reset, ms the phase took):
+      main                  212.3   212.3
+      settings              231.9    19.6
+      ...
+      first_sample         1408.0    36.4
+
+The first phase includes everything before main.py runs (MicroPython itself and boot.py).
+"""
+import time
+from array import array
+import log
+
+MAX_PHASES = 16
+
+_names = []
+_ticks_us = array('l', [0] * MAX_PHASES)
+
+
+def mark(phase: str) -> None:
+    """
+    Note that a phase of the startup is done.
+    """
+    if len(_names) < MAX_PHASES:
+        _ticks_us[len(_names)] = time.ticks_us()
+        _names.append(phase)
+
+
+def elapsed_ms(phase: str) -> float:
+    """
+    :return: ms from reset to the end of the phase, None if it wasn't marked
+    """
+    for index in range(len(_names)):
+        if _names[index] == phase:
+            return _ticks_us[index] / 1000
+    return None
+
+
+def profile() -> list:
+    """
+    :return: (phase, ms since reset, ms the phase took) per phase, in order
+    """
+    phases = []
+    previous = 0
+    for index in range(len(_names)):
+        phases.append((_names[index], _ticks_us[index] / 1000, time.ticks_diff(_ticks_us[index], previous) / 1000))
+        previous = _ticks_us[index]
+    return phases
+
+
+def report() -> None:
+    """
+    Log the profile (info), one phase per line.
+    """
+    log.info("Boot profile (ms since reset, ms the phase took):")
+    for phase, since_reset, took in profile():
+        log.info("  %s", f"{phase:<18} {since_reset:>9.1f} {took:>9.1f}")
@@ -0,0 +1,121 @@
+"""
+Local HTTP status endpoint.
+Everything else only ever pushes (to Home Assistant, ntfy, the broker), so this answers
+GET /status (or /) on the local network with the mailbox state, the last sample and the
+counters as JSON, for a quick look without Home Assistant or a USB cable.
+The response is rendered into one byte buffer, and that buffer is served as it is until
+the state changes (invalidate()) or it gets older than max_age_seconds, so a client
+polling it doesn't cost a JSON serialization per request. A request is read in one bounded
+go (at most max_request_bytes, within timeout seconds) and only a couple of clients are
+served at once, everything runs in the uasyncio loop, so a slow or misbehaving client can't
+hold up the sampler.
+"""
+import time
+import ujson
+import uasyncio as asyncio
+
+_NOT_FOUND = b"HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+_NOT_ALLOWED = b"HTTP/1.0 405 Method Not Allowed\r\nAllow: GET\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+_BUSY = b"HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+_PATHS = (b'/', b'/status')
+
+
+class StatusServer:
+    def __init__(self,
+                 port: int = 80,
+                 max_age_seconds: float = 10,
+                 timeout: float = 2,
+                 max_clients: int = 2,
+                 max_request_bytes: int = 1024):
+        """
+        :param max_age_seconds: how long a rendered response is served without a state change
+        :param timeout: seconds a client gets to send its request and take the response
+        """
+        self.port = port
+        self.max_age_ms = int(max_age_seconds * 1000)
+        self.timeout = timeout
+        self.max_clients = max_clients
+        self.max_request_bytes = max_request_bytes
+        self._render = None
+        self._server = None
+        self._response = None
+        self._rendered_at = 0
+        self._clients = 0
+        # counters
+        self.requests = 0
+        self.renders = 0
+        self.rejected = 0
+
+    async def start(self, render) -> None:
+        """
+        :param render: returns the status as a dict, called whenever the response is rendered again
+        """
+        self._render = render
+        self._server = await asyncio.start_server(self._handle, '0.0.0.0', self.port)
+
+    def invalidate(self) -> None:
+        """
+        The state changed, render the response again for the next request.
+        """
+        self._response = None
+
+    def response(self) -> bytes:
+        """
+        :return: the whole HTTP response, rendered again if it is out of date
+        """
+        if self._response is None or time.ticks_diff(time.ticks_ms(), self._rendered_at) >= self.max_age_ms:
+            body = ujson.dumps(self._render()).encode('utf-8')
+            head = (f"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                    f"Cache-Control: no-store\r\nConnection: close\r\n\r\n")
+            self._response = head.encode('utf-8') + body
+            self._rendered_at = time.ticks_ms()
+            self.renders += 1
+        return self._response
+
+    async def _read_request(self, reader) -> bytes:
+        """
+        :return: the response to the request
+        """
+        request = b''
+        while b'\r\n\r\n' not in request and len(request) < self.max_request_bytes:
+            chunk = await reader.read(self.max_request_bytes - len(request))
+            if not chunk:
+                break
+            request += chunk
+        parts = request.split(b'\r\n', 1)[0].split()
+        if len(parts) < 2:
+            raise ValueError("Not an HTTP request")
+        if parts[0] != b'GET':
+            return _NOT_ALLOWED
+        if parts[1].split(b'?', 1)[0] not in _PATHS:
+            return _NOT_FOUND
+        return self.response()
+
+    async def _handle(self, reader, writer) -> None:
+        self.requests += 1
+        busy = self._clients >= self.max_clients
+        self._clients += 1
+        try:
+            if busy:
+                self.rejected += 1
+                response = _BUSY
+            else:
+                response = await asyncio.wait_for(self._read_request(reader), self.timeout)
+            writer.write(response)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            self.rejected += 1
+        finally:
+            self._clients -= 1
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "status_requests": self.requests,
+            "status_renders": self.renders,
+            "status_rejected": self.rejected,
+        }
@@ -0,0 +1,183 @@
+"""
+Wall clock time over NTP.
+Each sync asks a few NTP servers (each one bounded by a timeout) and sets the RTC to the
+median of the answers. The exchange is done on a non-blocking UDP socket which is polled
+from the event loop (ntptime.time() would block the loop, and with it the sampler, for up
+to the timeout per server), only the DNS lookup of each server still blocks.
+How far the RTC was off at each sync gives us an estimate of how much it drifts, which
+tells us how long we can go before it is off by more than we are willing to accept. Only
+then is it worth switching the radio on to sync again.
+"""
+import errno
+import socket
+import struct
+import time
+import uasyncio as asyncio
+from machine import RTC
+
+SECONDS_PER_DAY = 24 * 60 * 60
+NTP_PORT = 123
+# seconds between the NTP epoch (1900) and the one time.time() counts from
+NTP_DELTA = 3155673600 if time.gmtime(0)[0] == 2000 else 2208988800
+# 2024-01-01 as an NTP timestamp, anything before that has wrapped around (in 2036)
+MIN_NTP_TIMESTAMP = 3913056000
+# how often the socket is checked for an answer
+POLL_MS = 10
+
+
+def seconds_left_in_window(second_of_day: int, start_hour: int, end_hour: int) -> int:
+    """
+    :param second_of_day: seconds since midnight
+    :param start_hour: the window starts at the top of this hour (0-23)
+    :param end_hour: and ends at the top of this hour, may be past midnight (e.g. 22 to 6)
+    :return: seconds until the end of the window, 0 if we are not inside it
+    """
+    start = start_hour * 3600
+    end = end_hour * 3600
+    if start == end:
+        return 0
+    if start < end:
+        inside = start <= second_of_day < end
+    else:
+        inside = second_of_day >= start or second_of_day < end
+    if not inside:
+        return 0
+    return (end - second_of_day) % SECONDS_PER_DAY
+
+
+class TimeService:
+    def __init__(self,
+                 servers: list,
+                 timeout: float = 1,
+                 max_error_seconds: float = 30,
+                 utc_offset_hours: float = 0,
+                 default_drift_ppm: float = 100,
+                 max_sync_interval: int = 7 * SECONDS_PER_DAY):
+        """
+        :param servers: NTP servers, asked in order
+        :param timeout: seconds to wait for each server
+        :param max_error_seconds: sync again when the clock is predicted to be off by this much
+        :param utc_offset_hours: for local_time() (fixed, there is no daylight saving time support)
+        :param default_drift_ppm: assumed drift until we have measured it
+        :param max_sync_interval: sync at least this often (seconds), however good the clock seems
+        """
+        self.servers = servers
+        self.timeout = timeout
+        self._request = bytearray(48)
+        self._request[0] = 0x1B  # version 3, client
+        self.max_error_seconds = max_error_seconds
+        self.utc_offset = int(utc_offset_hours * 3600)
+        self.default_drift_ppm = default_drift_ppm
+        self.max_sync_interval = max_sync_interval
+        self.last_sync = None  # RTC time (seconds) right after the last sync
+        self.drift_ppm = None  # measured, None until two syncs far enough apart
+        self.last_offset = 0  # how far off (seconds) the RTC was at the last sync
+        # counters
+        self.syncs = 0
+        self.failed_queries = 0
+
+    def is_synced(self) -> bool:
+        return self.last_sync is not None
+
+    async def _ask(self, server: str) -> int:
+        """
+        :return: the server's NTP time (seconds since the epoch), raises OSError if it doesn't answer in time
+        """
+        address = socket.getaddrinfo(server, NTP_PORT)[0][-1]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.sendto(self._request, address)
+            deadline = time.ticks_add(time.ticks_ms(), int(self.timeout * 1000))
+            while True:
+                try:
+                    reply = sock.recv(48)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                if time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+                    raise OSError(f"No answer from {server} within {self.timeout} seconds")
+                await asyncio.sleep_ms(POLL_MS)
+        finally:
+            sock.close()
+        if len(reply) < 48:
+            raise OSError(f"Short NTP reply from {server}")
+        seconds = struct.unpack('!I', reply[40:44])[0]
+        if seconds < MIN_NTP_TIMESTAMP:
+            seconds += 0x100000000
+        return seconds - NTP_DELTA
+
+    async def _query(self) -> int:
+        """
+        :return: the median NTP time (seconds since the epoch) of the servers that answered
+        """
+        answers = []
+        for server in self.servers:
+            # the DNS lookup blocks, let the other tasks have a go in between servers
+            await asyncio.sleep_ms(0)
+            try:
+                answers.append(await self._ask(server))
+            except (OSError, IndexError):
+                self.failed_queries += 1
+                continue
+            if len(answers) == 3:
+                break
+        if not answers:
+            raise OSError("None of the NTP servers answered")
+        answers.sort()
+        return answers[len(answers) // 2]
+
+    async def sync(self) -> None:
+        """
+        Query the servers and set the RTC (takes up to timeout per server).
+        Raises OSError if none of the servers answered.
+        """
+        ntp_time = await self._query()
+        now = time.time()
+        self.last_offset = ntp_time - now
+        if self.last_sync is not None:
+            elapsed = now - self.last_sync
+            # ntp time comes in whole seconds, so it takes a while before the drift shows
+            if elapsed >= 6 * 60 * 60:
+                drift_ppm = abs(self.last_offset) * 1000000 / elapsed
+                if self.drift_ppm is None:
+                    self.drift_ppm = drift_ppm
+                else:
+                    self.drift_ppm = (self.drift_ppm + drift_ppm) / 2
+        tm = time.gmtime(ntp_time)
+        RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+        self.last_sync = ntp_time
+        self.syncs += 1
+
+    def predicted_error(self) -> float:
+        """
+        :return: how far off (seconds) we expect the clock to be by now
+        """
+        if self.last_sync is None:
+            return float('inf')
+        drift_ppm = self.default_drift_ppm if self.drift_ppm is None else self.drift_ppm
+        return 1 + drift_ppm * (time.time() - self.last_sync) / 1000000
+
+    def seconds_until_resync(self) -> int:
+        if self.last_sync is None:
+            return 0
+        drift_ppm = self.default_drift_ppm if self.drift_ppm is None else self.drift_ppm
+        elapsed = time.time() - self.last_sync
+        until = self.max_sync_interval - elapsed
+        if drift_ppm > 0:
+            until = min(until, (self.max_error_seconds - 1) * 1000000 / drift_ppm - elapsed)
+        return max(0, int(until))
+
+    def needs_sync(self) -> bool:
+        return self.seconds_until_resync() == 0
+
+    def local_time(self) -> tuple:
+        """
+        :return: time.localtime() shifted by utc_offset_hours
+        """
+        return time.localtime(time.time() + self.utc_offset)
+
+    def second_of_day(self) -> int:
+        local = self.local_time()
+        return local[3] * 3600 + local[4] * 60 + local[5]
@@ -0,0 +1,162 @@
+"""
+WiFi connection manager.
+The very first connection scans for the strongest access point with our SSID and goes
+through DHCP as usual, after which the access point (BSSID and channel) and the IP
+configuration are cached on flash. Later connections skip the scan and DHCP by going
+straight for the cached access point with the cached IP configuration, which gets the
+radio on and off again a lot quicker. If that doesn't work out the cache is dropped and we
+do it the slow way, without a scan: scan() blocks the event loop (and the sampler) for a
+couple of seconds, so it is done at most once a boot, and only when nothing is cached.
+Otherwise the driver picks the access point itself while we keep polling.
+Nothing here ever resets the device, a failed connection raises OSError.
+"""
+import os
+import time
+import ujson
+import network
+import uasyncio as asyncio
+from binascii import hexlify, unhexlify
+
+
+class WifiManager:
+    def __init__(self,
+                 ssid: str,
+                 password: str,
+                 cache_file_name: str = 'wifi.json',
+                 timeout: float = 10,
+                 fast_timeout: float = 3):
+        """
+        :param timeout: seconds to wait for a connection the slow way (scan and DHCP)
+        :param fast_timeout: seconds to give the cached access point and IP configuration
+        """
+        self.ssid = ssid
+        self.password = password
+        self.cache_file_name = cache_file_name
+        self.timeout = timeout
+        self.fast_timeout = fast_timeout
+        self.wlan = network.WLAN(network.STA_IF)
+        self._cache = None  # {"ssid": ..., "bssid": hex or None, "channel": ..., "ifconfig": [ip, mask, gateway, dns]}
+        self._scanned = False
+        # counters
+        self.connects = 0
+        self.fast_connects = 0
+        self.failed_fast_connects = 0
+        self.last_associate_ms = 0
+
+    def load_cache(self) -> None:
+        try:
+            with open(self.cache_file_name, 'r') as file:
+                cache = ujson.load(file)
+            if cache.get("ssid") == self.ssid:
+                self._cache = cache
+        except (OSError, ValueError):
+            self._cache = None
+
+    def _save_cache(self) -> None:
+        temp_file_name = self.cache_file_name + '.tmp'
+        try:
+            with open(temp_file_name, 'w') as file:
+                ujson.dump(self._cache, file)
+            os.rename(temp_file_name, self.cache_file_name)
+        except OSError:
+            pass  # we'll just have to do it the slow way next time as well
+
+    def forget(self) -> None:
+        self._cache = None
+        try:
+            os.remove(self.cache_file_name)
+        except OSError:
+            pass
+
+    def isconnected(self) -> bool:
+        return self.wlan.isconnected()
+
+    def _strongest_access_point(self) -> tuple:
+        """
+        :return: (bssid, channel) of the access point with our SSID we hear best, or (None, 0)
+        """
+        self._scanned = True
+        ssid = self.ssid.encode('utf-8')
+        best = None
+        for found_ssid, bssid, channel, rssi, _, _ in self.wlan.scan():
+            if found_ssid == ssid and (best is None or rssi > best[2]):
+                best = (bssid, channel, rssi)
+        if best is None:
+            return None, 0
+        return best[0], best[1]
+
+    async def _wait_for_connection(self, timeout: float) -> bool:
+        deadline = time.ticks_add(time.ticks_ms(), int(timeout * 1000))
+        while not self.wlan.isconnected():
+            if time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+                return False
+            await asyncio.sleep_ms(50)
+        return True
+
+    async def connect(self) -> None:
+        """
+        Connect (switching the radio on if needed), raises OSError if that doesn't work out.
+        """
+        if self.wlan.isconnected():
+            return
+        started_at = time.ticks_ms()
+        self.wlan.active(True)
+        if self._cache is not None:
+            self.wlan.ifconfig(tuple(self._cache["ifconfig"]))
+            if self._cache.get("bssid"):
+                self.wlan.connect(self.ssid, self.password, bssid=unhexlify(self._cache["bssid"]))
+            else:
+                self.wlan.connect(self.ssid, self.password)
+            if await self._wait_for_connection(self.fast_timeout):
+                self.fast_connects += 1
+                self._connected(started_at)
+                return
+            # the access point or the network changed, start over the slow way
+            self.failed_fast_connects += 1
+            self.forget()
+            self.wlan.disconnect()
+            self.wlan.active(False)
+            self.wlan.active(True)
+            # the cached static address might be what didn't work, back to DHCP
+            self.wlan.ifconfig('dhcp')
+            # no scan now, it would keep the event loop busy at a time the network is already flaky
+            self._scanned = True
+
+        if self._scanned:
+            bssid, channel = None, 0
+        else:
+            bssid, channel = self._strongest_access_point()
+        if bssid is None:
+            self.wlan.connect(self.ssid, self.password)
+        else:
+            self.wlan.connect(self.ssid, self.password, bssid=bssid)
+        if not await self._wait_for_connection(self.timeout):
+            self.wlan.disconnect()
+            raise OSError(f"Could not connect to {self.ssid} within {self.timeout} seconds")
+        self._connected(started_at)
+        self._cache = {
+            "ssid": self.ssid,
+            "bssid": hexlify(bssid).decode() if bssid is not None else None,
+            "channel": channel,
+            "ifconfig": list(self.wlan.ifconfig())
+        }
+        self._save_cache()
+
+    def _connected(self, started_at: int) -> None:
+        self.connects += 1
+        self.last_associate_ms = time.ticks_diff(time.ticks_ms(), started_at)
+
+    def disconnect(self) -> None:
+        """
+        Disconnect and switch the radio off.
+        """
+        self.wlan.disconnect()
+        self.wlan.active(False)
+
+    def stats(self) -> dict:
+        return {
+            "wifi_connects": self.connects,
+            "wifi_fast_connects": self.fast_connects,
+            "wifi_failed_fast_connects": self.failed_fast_connects,
+            "wifi_associate_ms": self.last_associate_ms
+        }